@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+#============================================================================================
+#  bench_classifier :
+#    Micro-benchmark of the per-line cost of check_syno_backup.py line classification,
+#    before (StringContains / GetTaskName / GetTimestamp chain) and after (precompiled
+#    classifier), for the DSM 5.0 (synonetbkp.log) and DSM 5.1+ (synobackup.log) formats,
+#    and of the timestamp decoding (split of the line, or fixed offsets with memoized days).
+#
+#  Usage : python benchmark/bench_classifier.py [number of lines]
+#============================================================================================
+
+from __future__ import print_function
+
+import os, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import check_syno_backup as csb
+
+
+#============================================================================================
+# Sample lines of each format (start, end, error, and lines which are not task start/end)
+#============================================================================================
+
+SAMPLES = {
+  50: [ "info\t2015/01/15 01:00:02\tSYSTEM:\tNetwork Backup started to backup task [Daily NAS2].\n",
+        "info\t2015/01/15 01:42:17\tSYSTEM:\tNetwork Backup finished to backup task [Daily NAS2].\n",
+        "err\t2015/01/15 01:42:17\tSYSTEM: Network Backup failed (Destination is offline) [Daily NAS2].\n",
+        "info\t2015/01/15 01:05:44\tSYSTEM:\tUser [admin] logged in from [192.168.1.10].\n" ],
+  51: [ "info\t2016/08/26 04:00:02\tSYSTEM:\t[Local][Sauvegarde locale] Backup task started.\n",
+        "info\t2016/08/26 04:02:43\tSYSTEM:\t[Local][Sauvegarde locale] Backup task finished successfully. [1284 files scanned]\n",
+        "err\t2016/08/26 04:02:43\tSYSTEM:\t[Network][NAS2 copy] Exception occurred while backing up data. (Target is offline.)\n",
+        "info\t2016/08/26 04:01:12\tSYSTEM:\t[Local][Sauvegarde locale] Backup integrity check is running.\n",
+        "info\t2016/08/26 04:01:12\tSYSTEM:\tUser [admin] logged in from [192.168.1.10].\n" ],
+}
+
+
+#============================================================================================
+# Classification as done before the precompiled classifier
+#============================================================================================
+
+def LegacyClassify (line, dsm):
+  if dsm==50 \
+  or (dsm==51 and (   csb.StringContains (line, "[Network to share]") \
+                   or csb.StringContains (line, "[Network to volume]") \
+                   or csb.StringContains (line, "[Local to volume]") \
+                   or csb.StringContains (line, "[Local]") \
+                   or csb.StringContains (line, "[Network]"))) :
+    csb.GetTaskName(line, dsm)
+    starttext = "Network Backup started to backup task" if dsm==50 else "Backup task started."
+    if csb.StringContains (line, starttext) :
+      return csb.LINE_START, csb.GetTaskName(line, dsm), csb.GetTimestamp(line), ""
+    elif csb.StringContains (line, "err") :
+      return csb.LINE_ERROR, csb.GetTaskName(line, dsm), csb.GetTimestamp(line), csb.GetProblemDetails(line, dsm)
+    elif csb.StringContains (line, "finished") :
+      return csb.LINE_FINISHED, csb.GetTaskName(line, dsm), csb.GetTimestamp(line), ""
+  return None
+
+
+#============================================================================================
+# Time one classification method on a list of lines. Returns the cost per line (ns)
+#============================================================================================
+
+def TimePerLine (function, lines, repeat=5):
+  best = min(timeit.repeat(lambda: [function(line) for line in lines], number=1, repeat=repeat))
+  return best * 1e9 / len(lines)
+
+
+#============================================================================================
+# Main
+#============================================================================================
+
+if __name__ == "__main__":
+
+  nblines = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+  print("%-8s %-8s %14s %14s %8s" % ("format", "lines", "before (ns)", "after (ns)", "speedup"))
+  for dsm in sorted(SAMPLES):
+    samples = SAMPLES[dsm]
+    lines = [samples[i % len(samples)] for i in range(nblines)]
+    classify = csb.GetLineClassifier(dsm)
+
+    for line in samples:
+      legacy = LegacyClassify(line, dsm)
+      assert legacy == classify(line), "Classifiers disagree on line : %r" % (line)
+
+    before = TimePerLine(lambda line: LegacyClassify(line, dsm), lines)
+    after = TimePerLine(classify, lines)
+    print("%-8s %-8d %14.0f %14.0f %7.1fx" % ("DSM %d" % (dsm), nblines, before, after, before / after))
+
+  # Timestamps : one day of lines (the day is decoded once)
+
+  lines = ["info\t2016/02/29 %02d:%02d:%02d\tSYSTEM:\t[Local][Backup task 00] Backup task started.\n" % (
+           i // 3600 % 24, i // 60 % 60, i % 60) for i in range(nblines)]
+  for line in lines[:1000]:
+    assert csb.GetTimestamp(line) == csb.DecodeTimestamp(line.split('\t')[1]), "Decoders disagree on line : %r" % (line)
+  before = TimePerLine(csb.GetTimestamp, lines)
+  after = TimePerLine(lambda line: csb.DecodeTimestamp(line[5:24]), lines)
+  print("%-8s %-8d %14.0f %14.0f %7.1fx" % ("dates", nblines, before, after, before / after))
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+#============================================================================================
+#  bench_failures :
+#    Micro-benchmark of the failure counters of check_syno_backup.py (-f, -F,
+#    --w_consecutive, --c_consecutive) : cost of counting a job, and of the window query
+#    (failed jobs and consecutive failures of the last days) for histories of several
+#    lengths. Results are checked against a count over all the jobs.
+#
+#  Usage : python benchmark/bench_failures.py [number of years, comma separated]
+#============================================================================================
+
+from __future__ import print_function
+
+import os, sys, timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+sys.path.insert(0, BENCH_DIR)
+import check_syno_backup as csb
+import generate_logs
+
+TASK = "Backup task 00"
+
+
+#============================================================================================
+# Same result as FailureCounters.window, over all the jobs
+#============================================================================================
+
+def CountWindow (jobs, today, ndays):
+  window = [job for job in jobs if today - ndays < job.end // 86400 <= today]
+  failed = len([job for job in window if job.status != 'OK'])
+  streak = 0
+  for job in reversed(jobs):
+    if job.status == 'OK':
+      break
+    streak += 1
+  return len(window), failed, min(streak, failed)
+
+
+if __name__ == "__main__":
+
+  years = [float(y) for y in sys.argv[1].split(',')] if len(sys.argv) > 1 else [1, 5, 20]
+  today = csb.NowSeconds() // 86400
+  number = 20000
+  failed = False
+
+  for y in years:
+    jobs = generate_logs.MakeJobs(csb, y, outages=True)
+    counters = {}
+    count = min(timeit.repeat(lambda: csb.CountJobs({}, jobs), number=1, repeat=3)) / len(jobs)
+    csb.CountJobs(counters, jobs)
+    taskcounters = counters[TASK]
+
+    # Every window, up to the size of the ring, and the days of the last months
+
+    same = True
+    for ndays in range(1, csb.FAILURE_RING_DAYS):
+      for day in (today, today + 3):
+        same = same and taskcounters.window(day, ndays) == CountWindow(jobs, day, ndays)
+    for cut in range(len(jobs) - 2000, len(jobs), 97):
+      partial = {}
+      csb.CountJobs(partial, jobs[:cut])
+      day = jobs[cut - 1].end // 86400
+      same = same and partial[TASK].window(day, 7) == CountWindow(jobs[:cut], day, 7)
+
+    query = min(timeit.repeat(lambda: taskcounters.window(today, 30), number=number, repeat=3)) / number
+    print("%5.1f years : %6d jobs, count %5.2f us/job, 30 days query %5.2f us, same as full count : %s" % (
+          y, len(jobs), count * 1e6, query * 1e6, same))
+    failed = failed or not same
+
+  if failed:
+    sys.stderr.write("ERROR : failure counters differ from the count over all the jobs\n")
+    sys.exit(1)
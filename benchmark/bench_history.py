@@ -0,0 +1,49 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+#============================================================================================
+#  bench_history :
+#    Micro-benchmark of the duration history of check_syno_backup.py (--history, -b, -B) :
+#    cost of the baseline query (p50 / p95 of the last good runs) and of the append of a
+#    new job, on a history of several years of hourly runs.
+#
+#  Usage : python benchmark/bench_history.py [number of years]
+#============================================================================================
+
+from __future__ import print_function
+
+import os, sys, timeit, tempfile, shutil
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+sys.path.insert(0, BENCH_DIR)
+import check_syno_backup as csb
+import generate_logs
+
+TASK = "Backup task 00"
+
+
+if __name__ == "__main__":
+
+  years = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+  csb.STATE_DIR = tempfile.mkdtemp(prefix="syno_history_")
+  try:
+    jobs = generate_logs.MakeJobs(csb, years)
+    latest = jobs.pop()
+    csb.AppendHistory(TASK, jobs)
+    size = os.path.getsize(csb.HistoryPath(TASK))
+
+    number = 2000
+    query = min(timeit.repeat(lambda: csb.TaskBaseline(TASK, latest), number=number, repeat=3)) / number
+    baseline = csb.TaskBaseline(TASK, latest)
+
+    # Append : the latest job is added once, then each call finds it already recorded
+
+    append = min(timeit.repeat(lambda: csb.AppendHistory(TASK, [latest]), number=number, repeat=3)) / number
+
+    print("history  : %d jobs (%.1f years), %d bytes" % (len(jobs), years, size))
+    print("baseline : p50 %d s, p95 %d s over %d good runs" % (baseline['p50'], baseline['p95'], baseline['runs']))
+    print("query    : %8.1f us" % (query * 1e6))
+    print("append   : %8.1f us" % (append * 1e6))
+  finally:
+    shutil.rmtree(csb.STATE_DIR)
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+#============================================================================================
+#  bench_index :
+#    Benchmark of the SQLite job index of check_syno_backup.py (--index) : ingestion
+#    throughput (all the jobs of a long log, then the jobs of one incremental check), and
+#    latency of the queries of a check (last good job, window of days, runs and failures),
+#    on several years of hourly runs of several tasks.
+#
+#  Usage : python benchmark/bench_index.py [number of years] [number of tasks]
+#============================================================================================
+
+from __future__ import print_function
+
+import os, sys, time, timeit, tempfile, shutil
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+sys.path.insert(0, BENCH_DIR)
+import check_syno_backup as csb
+import generate_logs
+
+TASK = "Backup task 00"
+
+
+def TimeQuery (function, number=200):
+  return min(timeit.repeat(function, number=number, repeat=3)) / number
+
+
+if __name__ == "__main__":
+
+  years = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+  nbtasks = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+  tmpdir = tempfile.mkdtemp(prefix="syno_index_")
+  csb.INDEX_PATH = os.path.join(tmpdir, "jobs.sqlite")
+  try:
+    jobs = generate_logs.MakeJobs(csb, years, nbtasks)
+    latest = jobs[-nbtasks:]
+    stored = jobs[:-nbtasks]
+
+    # Ingestion : all the jobs of the log (first check), then one incremental check
+    # (the new jobs, and the latest jobs kept in the state, already stored)
+
+    start = time.time()
+    csb.IndexJobs(stored)
+    bulk = time.time() - start
+    kept = csb.KeepLatestJobs(stored)
+    start = time.time()
+    csb.IndexJobs(kept + latest)
+    incremental = time.time() - start
+    size = os.path.getsize(csb.INDEX_PATH)
+
+    # Queries of a check : the latest good job only, then the jobs of the last days
+
+    now = csb.NowSeconds()
+    since = now - 90 * 86400
+    window = csb.IndexTable([TASK], since)
+    latestgood = TimeQuery(lambda: csb.IndexTable([TASK], now))
+    days = TimeQuery(lambda: csb.IndexTable([TASK], since), number=20)
+    counts = TimeQuery(lambda: csb.CountRuns(csb.IndexTable([TASK], now - 3 * 86400), TASK, 3))
+    alltasks = TimeQuery(lambda: csb.IndexTable([], now - 3 * 86400), number=20)
+
+    print("index     : %d jobs of %d tasks (%.1f years), %d bytes" % (len(jobs), nbtasks, years, size))
+    print("ingestion : %8.0f jobs/s (%.2f s)" % (len(stored) / bulk, bulk))
+    print("check     : %8.1f ms (%d new jobs, %d already stored)" % (incremental * 1e3, len(latest), len(kept)))
+    print("last good : %8.1f us" % (latestgood * 1e6))
+    print("90 days   : %8.1f us (%d jobs)" % (days * 1e6, len(window)))
+    print("3 days    : %8.1f us (runs and failures)" % (counts * 1e6))
+    print("all tasks : %8.1f us (3 days of %d tasks)" % (alltasks * 1e6, nbtasks))
+  finally:
+    shutil.rmtree(tmpdir)
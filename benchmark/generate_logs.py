@@ -0,0 +1,274 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+#============================================================================================
+#  generate_logs :
+#    Generates a synthetic Synology Backup log, to measure check_syno_backup.py
+#
+#    The log covers the days before now, with a configurable size, number of tasks,
+#    proportion of tasks running in parallel, error rate, and DSM log format :
+#      - 50 : DSM 5.0 and lower (synonetbkp.log)
+#      - 51 : DSM 5.1 / 5.2 (synobackup.log, [Network to share], [Local to volume] ...)
+#      - 6  : DSM 6 (synobackup.log, [Network], [Local] ...)
+#
+#    Also used as a module : rotated copies of a log (RotateLog), and jobs built without
+#    a log for the micro-benchmarks (MakeJobs).
+#
+#  Usage : python benchmark/generate_logs.py -o <dir> [Options]
+#============================================================================================
+
+from __future__ import print_function
+
+import sys, os, getopt, heapq, random
+from datetime import datetime, timedelta
+
+
+#============================================================================================
+# Default values
+#============================================================================================
+
+SIZE_MB = 10             # Size of the generated log
+NB_TASKS = 20            # Number of Backup tasks
+OVERLAP = 0.5            # Proportion of tasks starting at the same time (running in parallel)
+ERROR_RATE = 0.05        # Proportion of failed runs
+HOURLY_RATE = 0.2        # Proportion of tasks running every hour (others run daily)
+LOG_FORMAT = "6"         # DSM log format : 50, 51 or 6
+
+LOG_FILENAMES = {"50": "synonetbkp.log", "51": "synobackup.log", "6": "synobackup.log"}
+BACKUP_TYPES = {"51": ["[Network to share]", "[Local to volume]", "[Network to volume]"],
+                "6": ["[Network]", "[Local]", "[Network to volume]"]}
+
+ERRORS = ["Destination is offline", "Insufficient space on the destination",
+          "Authentication failed", "Connection timed out", "Source folder not found"]
+
+
+#============================================================================================
+# Log line formats
+#============================================================================================
+
+def FormatLine (fmt, level, when, task, event, arg=""):
+
+  ts = "%04d/%02d/%02d %02d:%02d:%02d" % (when.year, when.month, when.day, when.hour, when.minute, when.second)
+  name, backuptype = task
+
+  if fmt == "50":
+    text = { 'start':    "Network Backup started to backup task [%s]." % (name),
+             'finished': "Network Backup finished to backup task [%s]." % (name),
+             'error':    "Network Backup failed (%s) [%s]." % (arg, name),
+             'progress': "Network Backup is copying data of task [%s]." % (name),
+             'system':   "Network Backup service is running." }[event]
+    sep = " " if event == 'error' else "\t"
+    return "%s\t%s\tSYSTEM:%s%s\n" % (level, ts, sep, text)
+
+  if event == 'finished':
+    arg = "[%s files scanned] [%d new files]" % (arg, int(arg) // 10)
+  text = { 'start':    "%s[%s] Backup task started." % (backuptype, name),
+           'finished': "%s[%s] Backup task finished successfully. %s" % (backuptype, name, arg),
+           'error':    "%s[%s] Exception occurred while backing up data. (%s)" % (backuptype, name, arg),
+           'progress': "%s[%s] Backup integrity check is running." % (backuptype, name),
+           'system':   "Backup service is running." }[event]
+  return "%s\t%s\tSYSTEM:\t%s\n" % (level, ts, text)
+
+
+#============================================================================================
+# Generate the events of one day : (timestamp, sequence, line)
+#============================================================================================
+
+def DayEvents (fmt, day, tasks, schedules, rnd, sequence):
+
+  events = []
+  for task, (hourly, offset) in zip(tasks, schedules):
+    starts = [day + timedelta(hours=h, seconds=offset % 3600) for h in range(24)] if hourly \
+             else [day + timedelta(seconds=offset)]
+    for start in starts:
+      duration = timedelta(seconds=int(rnd.lognormvariate(6.5 if hourly else 7.5, 0.8)))
+      events.append((start, sequence, FormatLine(fmt, "info", start, task, 'start')))
+      sequence += 1
+      for i in range(rnd.randint(0, 2)):
+        when = start + timedelta(seconds=rnd.randint(0, duration.seconds))
+        events.append((when, sequence, FormatLine(fmt, "info", when, task, 'progress')))
+        sequence += 1
+      end = start + duration
+      if rnd.random() < ERROR_RATE:
+        events.append((end, sequence, FormatLine(fmt, "err", end, task, 'error', rnd.choice(ERRORS))))
+      else:
+        events.append((end, sequence, FormatLine(fmt, "info", end, task, 'finished', str(rnd.randint(100, 500000)))))
+      sequence += 1
+
+  when = day + timedelta(seconds=rnd.randint(0, 86399))
+  events.append((when, sequence, FormatLine(fmt, "info", when, ("", ""), 'system')))
+  return events, sequence + 1
+
+
+#============================================================================================
+# Generate a log file of (about) the requested size, ending now
+#============================================================================================
+
+def GenerateLog (path, fmt, size, nbtasks, overlap, seed=0):
+
+  rnd = random.Random(seed)
+  types = BACKUP_TYPES.get(fmt, [""])
+  tasks = [("Backup task %02d" % (i), types[i % len(types)]) for i in range(nbtasks)]
+
+  # Parallel tasks all start at 01:00, others are spread over the day
+
+  schedules = []
+  for i in range(nbtasks):
+    hourly = rnd.random() < HOURLY_RATE
+    if rnd.random() < overlap:
+      offset = 3600
+    else:
+      offset = rnd.randint(0, 86399)
+    schedules.append((hourly, offset))
+
+  # Estimate the number of days needed to reach the size
+
+  sample, seq = DayEvents(fmt, datetime(2000, 1, 1), tasks, schedules, random.Random(seed), 0)
+  perday = max(1, sum([len(e[2]) for e in sample]))
+  nbdays = max(1, size // perday + 1)
+  now = datetime.now()
+  today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+  day = today - timedelta(days=nbdays)
+
+  # Events are written in chronological order, up to now ; runs going past midnight stay in the heap
+
+  written = 0
+  nblines = 0
+  heap = []
+  sequence = 0
+  f = open(path, 'w')
+  try:
+    while day <= today:
+      events, sequence = DayEvents(fmt, day, tasks, schedules, rnd, sequence)
+      for event in events:
+        heapq.heappush(heap, event)
+      day = day + timedelta(days=1)
+      while heap and heap[0][0] < min(day, now):
+        line = heapq.heappop(heap)[2]
+        f.write(line)
+        written += len(line)
+        nblines += 1
+  finally:
+    f.close()
+  return written, nblines
+
+
+#============================================================================================
+# Jobs without a log : hourly runs of each task over the given number of years, ending now
+#============================================================================================
+
+# Fixture of the micro-benchmarks (history, index, failure counters) : csb is the
+# imported script. With outages, failures come in runs (destination offline for a
+# while) and some hours have no job. Jobs are returned as the parsers return them : in
+# the order of their end lines (runs of a task may overlap).
+
+def MakeJobs (csb, years, nbtasks=1, outages=False):
+
+  rnd = random.Random(0)
+  now = csb.NowSeconds() // 3600 * 3600
+  jobs = []
+  failing = [0] * nbtasks                  # Failed jobs to come, by task
+  for hour in range(int(years * 365 * 24), 0, -1):
+    for task in range(nbtasks):
+      if outages:
+        if rnd.random() < 0.002:
+          failing[task] = rnd.randint(1, 200)
+        if rnd.random() < 0.001:
+          continue
+      name = "Backup task %02d" % (task)
+      start = now - hour * 3600 + task * 60
+      job = csb.NewJob(name, start)
+      end = start + int(rnd.lognormvariate(6.5, 0.8))
+      if failing[task] > 0 or rnd.random() < ERROR_RATE:
+        message = "Exception occurred while backing up data. (%s)" % (rnd.choice(ERRORS))
+        csb.EndJob(job, (csb.LINE_ERROR, name, end, message))
+      else:
+        csb.EndJob(job, (csb.LINE_FINISHED, name, end, ""))
+      failing[task] = max(0, failing[task] - 1)
+      jobs.append(job)
+  jobs.sort(key=lambda job: job.end)
+  return jobs
+
+
+#============================================================================================
+# Copy (the first lines of) a log as a rotated set : <log>.1.gz, <log>.0 and <log>
+#============================================================================================
+
+def RotateLog (path, outdir, nblines=None):
+  import gzip
+
+  f = open(path, 'rb')
+  try:
+    lines = f.readlines()
+  finally:
+    f.close()
+  if nblines is not None:
+    lines = lines[:nblines]
+
+  basename = os.path.basename(path)
+  third = len(lines) // 3
+  parts = [(basename + ".1.gz", lines[:third]), (basename + ".0", lines[third:2 * third]), (basename, lines[2 * third:])]
+  for filename, part in parts:
+    target = os.path.join(outdir, filename)
+    f = gzip.open(target, 'wb') if filename.endswith('.gz') else open(target, 'wb')
+    try:
+      f.write(b"".join(part))
+    finally:
+      f.close()
+  return os.path.join(outdir, basename)
+
+
+#============================================================================================
+# Main
+#============================================================================================
+
+def usage():
+  print('''Usage : %s -o <dir> [Options]
+      -o<dir>, --output : output directory (the file name depends on the format)
+      -s<n>, --size : size of the log in MB (default %d)
+      -t<n>, --tasks : number of tasks (default %d)
+      -p<x>, --overlap : proportion of tasks running in parallel, 0 to 1 (default %.1f)
+      -e<x>, --errors : proportion of failed runs, 0 to 1 (default %.2f)
+      -f<fmt>, --format : DSM log format : 50, 51 or 6 (default %s)
+      --seed=<n> : random seed''' % (sys.argv[0], SIZE_MB, NB_TASKS, OVERLAP, ERROR_RATE, LOG_FORMAT))
+  sys.exit(1)
+
+
+if __name__ == "__main__":
+
+  outdir = ""
+  seed = 0
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "ho:s:t:p:e:f:", ["help", "output=", "size=", "tasks=", "overlap=", "errors=", "format=", "seed="])
+  except getopt.GetoptError:
+    usage()
+
+  try:
+    for option, value in opts:
+      if option in ("-h", "--help"):
+        usage()
+      elif option in ("-o", "--output"):
+        outdir = value
+      elif option in ("-s", "--size"):
+        SIZE_MB = float(value)
+      elif option in ("-t", "--tasks"):
+        NB_TASKS = int(value)
+      elif option in ("-p", "--overlap"):
+        OVERLAP = float(value)
+      elif option in ("-e", "--errors"):
+        ERROR_RATE = float(value)
+      elif option in ("-f", "--format"):
+        LOG_FORMAT = value
+      elif option == "--seed":
+        seed = int(value)
+  except ValueError:
+    usage()
+
+  if outdir == "" or LOG_FORMAT not in LOG_FILENAMES:
+    usage()
+  if not os.path.isdir(outdir):
+    os.makedirs(outdir)
+
+  path = os.path.join(outdir, LOG_FILENAMES[LOG_FORMAT])
+  size, nblines = GenerateLog(path, LOG_FORMAT, int(SIZE_MB * 1024 * 1024), NB_TASKS, OVERLAP, seed)
+  print("%s : %d bytes, %d lines, %d tasks, DSM format %s" % (path, size, nblines, NB_TASKS, LOG_FORMAT))
@@ -0,0 +1,403 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+#============================================================================================
+#  run_benchmark :
+#    Benchmark suite of check_syno_backup.py
+#
+#    Generates synthetic logs (see generate_logs.py) for each requested size and DSM
+#    format, then measures each stage in a separate process :
+#      - detect  : CheckDSMVersion
+#      - parse   : ParseLogFile (full forward parsing)
+#      - reverse : ParseLogFileReverse (-r)
+#      - mmap    : ParseLogFileFiltered (-m)
+#      - parallel: ParseLogFileParallel (-j0), and check that the result is the same as
+#                  ParseLogFile, with 1, 2, 64 chunks and more chunks than lines (many jobs
+#                  cross chunks), also on rotated sets (.1.gz, .0, live file). The stage
+#                  fails if a result differs
+#      - discover: DiscoverTasks (--discover), and check that it finds the tasks of
+#                  ParseLogFile
+#      - memory  : memory held by the jobs of ParseLogFile (bytes per job : tracemalloc
+#                  under Python 3, sizes of the job records and their values otherwise),
+#                  and by the per-task reducers of a check of all tasks
+#      - cli     : full command line check (python check_syno_backup.py -t ...)
+#      - startup : interpreter startup and import of the script (with -X importtime
+#                  under Python 3.7+ : import time of each module)
+#
+#    Results are written as JSON : wall time, CPU time, lines/sec and peak RSS of
+#    each stage.
+#
+#  Usage : python benchmark/run_benchmark.py [Options]
+#============================================================================================
+
+from __future__ import print_function
+
+import sys, os, getopt, json, time, subprocess, shutil, tempfile, platform
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(BENCH_DIR, '..', 'src', 'check_syno_backup.py')
+sys.path.insert(0, BENCH_DIR)
+import generate_logs
+
+
+#============================================================================================
+# Default values
+#============================================================================================
+
+SIZES_MB = [10]
+FORMATS = ["50", "51", "6"]
+STAGES = ["detect", "parse", "reverse", "mmap", "parallel", "discover", "memory", "cli", "startup"]
+NB_TASKS = 20
+TASK = "Backup task 00"
+
+
+################################################################################
+#                                                                              #
+#                    STAGES (RUN IN A CHILD PROCESS)                           #
+#                                                                              #
+################################################################################
+
+#============================================================================================
+# Import check_syno_backup, with log files in the given directory
+#============================================================================================
+
+def ImportScript (logdir):
+  sys.path.insert(0, os.path.dirname(SCRIPT))
+  import check_syno_backup as csb
+  csb.PATH_LOGFILE_DSM50 = os.path.join(logdir, os.path.basename(csb.PATH_LOGFILE_DSM50))
+  csb.PATH_LOGFILE_DSM51 = os.path.join(logdir, os.path.basename(csb.PATH_LOGFILE_DSM51))
+  return csb
+
+
+#============================================================================================
+# Stages : each one returns a dictionary of values to add to the result
+#============================================================================================
+
+def StageDetect (csb, task):
+  dsm, path = csb.CheckDSMVersion()
+  return {'dsm': dsm}
+
+def StageParse (csb, task):
+  dsm, path = csb.CheckDSMVersion()
+  start = time.time()
+  table = csb.ParseLogFile(path, dsm)
+  return {'wall_s': time.time() - start, 'jobs': len(table)}
+
+def StageReverse (csb, task):
+  dsm, path = csb.CheckDSMVersion()
+  start = time.time()
+  table = csb.ParseLogFileReverse(path, dsm, [task])
+  return {'wall_s': time.time() - start, 'jobs': len(table)}
+
+def StageMmap (csb, task):
+  dsm, path = csb.CheckDSMVersion()
+  start = time.time()
+  table = csb.ParseLogFileFiltered(path, dsm, [task])
+  return {'wall_s': time.time() - start, 'jobs': len(table)}
+
+def JobTuples (table):
+  return [(job.name, job.start, job.end, job.status, job.problem) for job in table]
+
+def StageParallel (csb, task):
+  dsm, path = csb.CheckDSMVersion()
+  start = time.time()
+  table = csb.ParseLogFileParallel(path, dsm, 0)
+  wall = time.time() - start
+
+  # The log, the log as a rotated set, and its first lines as a rotated set (more
+  # chunks than lines) : each one with several numbers of chunks (0 : one per core)
+
+  tempdir = tempfile.mkdtemp(prefix="syno_rotated_")
+  try:
+    os.mkdir(os.path.join(tempdir, 'full'))
+    os.mkdir(os.path.join(tempdir, 'small'))
+    cases = [(path, [0, 1, 2, 64]),
+             (generate_logs.RotateLog(path, os.path.join(tempdir, 'full')), [0, 1, 2, 64]),
+             (generate_logs.RotateLog(path, os.path.join(tempdir, 'small'), 300), [1, 2, 1000])]
+    compared = 0
+    for logpath, chunkcounts in cases:
+      reference = JobTuples(csb.ParseLogFile(logpath, dsm))
+      assert reference, "No job found in %s" % (logpath)
+      for chunks in chunkcounts:
+        result = JobTuples(csb.ParseLogFileParallel(logpath, dsm, 0, chunks))
+        assert result == reference, "Parallel parsing of %s in %d chunks differs from sequential parsing" % (logpath, chunks)
+        compared += 1
+  finally:
+    shutil.rmtree(tempdir)
+  return {'wall_s': wall, 'jobs': len(table), 'compared': compared}
+
+def StageDiscover (csb, task):
+  dsm, path = csb.CheckDSMVersion()
+  start = time.time()
+  tasks = csb.DiscoverTasks(path, dsm)
+  wall = time.time() - start
+  names = sorted(csb.GetTaskNames(csb.ParseLogFile(path, dsm)))
+  return {'wall_s': wall, 'tasks': len(tasks), 'same_as_parse': sorted([name for name, backuptype, ts in tasks]) == names}
+
+def TableSize (table):
+  # Sum of the sizes of the jobs and of their values, each object counted once
+  seen = set()
+  size = sys.getsizeof(table)
+  for job in table:
+    for obj in [job] + [getattr(job, slot) for slot in job.__slots__]:
+      if id(obj) not in seen:
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+  return size
+
+def StageMemory (csb, task):
+  dsm, path = csb.CheckDSMVersion()
+  try:
+    import tracemalloc
+  except ImportError:
+    tracemalloc = None                   # Python 2
+  if tracemalloc:
+    tracemalloc.start()
+  start = time.time()
+  table = csb.ParseLogFile(path, dsm)
+  wall = time.time() - start
+  jobs = len(table)
+  if tracemalloc:
+    held = tracemalloc.get_traced_memory()[0]
+    del table
+    size = held - tracemalloc.get_traced_memory()[0]
+  else:
+    size = TableSize(table)
+    del table
+
+  # Jobs kept by the per-task reducers of a check of all tasks (-a)
+
+  reducers = csb.ParseLogFileReduced(path, dsm, [], csb.NowSeconds() - csb.MAX_CRITICAL_DAYS * 86400)
+  kept = len(csb.ReducedTable(reducers))
+  if tracemalloc:
+    held = tracemalloc.get_traced_memory()[0]
+    del reducers
+    reduced = held - tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+  else:
+    reduced = TableSize(csb.ReducedTable(reducers))
+  return {'wall_s': wall, 'jobs': jobs, 'table_bytes': size, 'bytes_per_job': size / float(max(jobs, 1)),
+          'reduced_jobs': kept, 'reduced_bytes': reduced}
+
+CHILD_STAGES = {'detect': StageDetect, 'parse': StageParse, 'reverse': StageReverse, 'mmap': StageMmap, 'parallel': StageParallel,
+                'discover': StageDiscover, 'memory': StageMemory}
+
+
+#============================================================================================
+# Run one stage in this (child) process, and print its result as JSON
+#============================================================================================
+
+def RunChild (stage, logdir, task):
+  csb = ImportScript(logdir)
+  start = time.time()
+  result = CHILD_STAGES[stage](csb, task)
+  result.setdefault('wall_s', time.time() - start)
+  print(json.dumps(result))
+
+
+################################################################################
+#                                                                              #
+#                        MEASURES (PARENT PROCESS)                             #
+#                                                                              #
+################################################################################
+
+#============================================================================================
+# Run a command, and return its output, wall time, CPU time and peak RSS
+#============================================================================================
+
+def MeasureProcess (command):
+  # Output goes to a temporary file, so that the process can be waited with os.wait4,
+  # which returns the resource usage of that process only
+
+  start = time.time()
+  out = tempfile.TemporaryFile()
+  process = subprocess.Popen(command, stdout=out, stderr=subprocess.STDOUT)
+  pid, status, rusage = os.wait4(process.pid, 0)
+  process.returncode = status
+  wall = time.time() - start
+  out.seek(0)
+  output = out.read().decode('utf-8', 'replace')
+  out.close()
+  return output, { 'process_wall_s': wall,
+                   'cpu_s': rusage.ru_utime + rusage.ru_stime,
+                   'peak_rss_kb': rusage.ru_maxrss }
+
+
+#============================================================================================
+# Count lines and bytes of a log file
+#============================================================================================
+
+def CountLines (path):
+  lines = 0
+  f = open(path, 'rb')
+  try:
+    while True:
+      block = f.read(1024 * 1024)
+      if not block:
+        break
+      lines += block.count(b'\n')
+  finally:
+    f.close()
+  return lines, os.path.getsize(path)
+
+
+#============================================================================================
+# Parse the output of -X importtime : self and cumulative import time of each module (us)
+#============================================================================================
+
+def ParseImportTime (output):
+  modules = {}
+  for line in output.splitlines():
+    if not line.startswith('import time:'):
+      continue
+    fields = line[len('import time:'):].split('|')
+    try:
+      modules[fields[2].strip()] = (int(fields[0]), int(fields[1]))
+    except (ValueError, IndexError):
+      pass                     # Header line
+  return modules
+
+
+#============================================================================================
+# Measure the startup : interpreter alone, then interpreter and import of the script
+#============================================================================================
+
+def RunStartup (python):
+
+  importcode = "import sys; sys.path.insert(0, %r); import check_syno_backup" % (os.path.dirname(os.path.abspath(SCRIPT)))
+  output, baseline = MeasureProcess([python, '-c', 'pass'])
+  version = subprocess.check_output([python, '-c', 'import sys; print(sys.version_info[:2] >= (3, 7))']).decode().strip()
+
+  if version == 'True':
+    output, result = MeasureProcess([python, '-X', 'importtime', '-c', importcode])
+    modules = ParseImportTime(output)
+    result['import_us'] = modules.get('check_syno_backup', (0, 0))[1]
+    result['imports_total_us'] = sum([m[0] for m in modules.values()])
+    result['slowest_imports'] = sorted([(m[0], name) for name, m in modules.items()], reverse=True)[:5]
+  else:
+    output, result = MeasureProcess([python, '-c', importcode])
+  result['wall_s'] = result['process_wall_s']
+  result['interpreter_wall_s'] = baseline['process_wall_s']
+  return result
+
+
+#============================================================================================
+# Measure one stage on one log
+#============================================================================================
+
+def RunStage (python, stage, logdir, task):
+
+  if stage == 'cli':
+    output, result = MeasureProcess([python, SCRIPT, '-L', logdir, '-t', task])
+    result['wall_s'] = result['process_wall_s']
+    result['output'] = output.strip()
+  elif stage == 'startup':
+    result = RunStartup(python)
+  else:
+    output, result = MeasureProcess([python, os.path.abspath(__file__), '--child=' + stage, logdir, task])
+    try:
+      result.update(json.loads(output.strip().splitlines()[-1]))
+    except:
+      result['error'] = output.strip()
+  return result
+
+
+#============================================================================================
+# Main
+#============================================================================================
+
+def usage():
+  print('''Usage : %s [Options]
+      -s<list>, --sizes : sizes of the logs in MB, comma separated (default %s)
+      -f<list>, --formats : DSM log formats, comma separated (default %s)
+      -t<n>, --tasks : number of tasks in the logs (default %d)
+      -p<x>, --overlap : proportion of tasks running in parallel (default %.1f)
+      -e<x>, --errors : proportion of failed runs (default %.2f)
+      -S<list>, --stages : stages to measure (default %s)
+      -d<dir>, --workdir : directory for the generated logs (kept, and reused if present)
+      -o<file>, --output : write the JSON results to <file> (default : standard output)
+      --python=<exe> : Python interpreter used to run the stages (default : this one)''' % (
+      sys.argv[0], ",".join([str(s) for s in SIZES_MB]), ",".join(FORMATS), NB_TASKS,
+      generate_logs.OVERLAP, generate_logs.ERROR_RATE, ",".join(STAGES)))
+  sys.exit(1)
+
+
+if __name__ == "__main__":
+
+  if len(sys.argv) == 4 and sys.argv[1].startswith('--child='):
+    RunChild(sys.argv[1][len('--child='):], sys.argv[2], sys.argv[3])
+    sys.exit(0)
+
+  workdir = ""
+  outfile = ""
+  python = sys.executable
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "hs:f:t:p:e:S:d:o:", ["help", "sizes=", "formats=", "tasks=", "overlap=", "errors=", "stages=", "workdir=", "output=", "python="])
+    for option, value in opts:
+      if option in ("-h", "--help"):
+        usage()
+      elif option in ("-s", "--sizes"):
+        SIZES_MB = [float(v) for v in value.split(',')]
+      elif option in ("-f", "--formats"):
+        FORMATS = value.split(',')
+      elif option in ("-t", "--tasks"):
+        NB_TASKS = int(value)
+      elif option in ("-p", "--overlap"):
+        generate_logs.OVERLAP = float(value)
+      elif option in ("-e", "--errors"):
+        generate_logs.ERROR_RATE = float(value)
+      elif option in ("-S", "--stages"):
+        STAGES = value.split(',')
+      elif option in ("-d", "--workdir"):
+        workdir = value
+      elif option in ("-o", "--output"):
+        outfile = value
+      elif option == "--python":
+        python = value
+  except (getopt.GetoptError, ValueError):
+    usage()
+
+  tempdir = workdir == ""
+  if tempdir:
+    workdir = tempfile.mkdtemp(prefix="syno_bench_")
+
+  results = []
+  failed = False
+  try:
+    for fmt in FORMATS:
+      for size in SIZES_MB:
+        logdir = os.path.join(workdir, "dsm%s_%gMB_%dtasks" % (fmt, size, NB_TASKS))
+        path = os.path.join(logdir, generate_logs.LOG_FILENAMES[fmt])
+        if not os.path.exists(path):
+          os.makedirs(logdir)
+          generate_logs.GenerateLog(path, fmt, int(size * 1024 * 1024), NB_TASKS, generate_logs.OVERLAP)
+        lines, nbytes = CountLines(path)
+
+        for stage in STAGES:
+          result = RunStage(python, stage, logdir, TASK)
+          result.update({'stage': stage, 'format': fmt, 'log_bytes': nbytes, 'log_lines': lines, 'tasks': NB_TASKS})
+          if result.get('wall_s') and stage != 'startup':
+            result['lines_per_s'] = lines / result['wall_s']
+          results.append(result)
+          sys.stderr.write("DSM %-3s %8.1f MB  %-8s %8.3f s  %10.0f lines/s  %8d KB\n" % (
+                           fmt, nbytes / 1048576.0, stage, result.get('wall_s', 0), result.get('lines_per_s', 0), result['peak_rss_kb']))
+          if 'error' in result:
+            sys.stderr.write("ERROR : stage %s failed\n%s\n" % (stage, result['error']))
+            failed = True
+  finally:
+    if tempdir:
+      shutil.rmtree(workdir)
+
+  report = { 'python': subprocess.check_output([python, '-c', 'import sys; print(sys.version.split()[0])']).decode().strip(),
+             'platform': platform.platform(),
+             'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+             'results': results }
+  text = json.dumps(report, indent=2, sort_keys=True)
+  if outfile:
+    f = open(outfile, 'w')
+    f.write(text + "\n")
+    f.close()
+  else:
+    print(text)
+  if failed:
+    sys.exit(1)
@@ -33,8 +33,16 @@
 # Imports (ensure all modules are installed on your system) 
 #============================================================================================
 
-import sys, getopt, string, time, os
-from datetime import timedelta, datetime
+# Runs with Python 2.6+ and Python 3. Only the modules needed by every check are imported
+# here : the others (getopt, re, json, mmap, socket ...) are imported by the functions
+# using them, to keep the startup time low.
+
+from __future__ import print_function
+
+import sys, time, os
+from datetime import timedelta, datetime, date
+
+PY3 = sys.version_info[0] >= 3
 
 
 #============================================================================================
@@ -79,9 +87,47 @@ VERSION_HISTORY = '''
  
 - 3.0 (26/08/2016) :
   - First Github public release
+
+- 3.1 (in progress) :
+  - Incremental parsing : with -s, the position in the log file is saved, and next runs only parse new lines
+  - Several tasks can be checked with a single log pass (repeated -t, or -a for all tasks),
+    with multi-line output or passive check results (-P)
+  - Reverse parsing (-r) : the log is read from the end, and reading stops at the last good result
+  - Log rotation : rotated files (synobackup.log.0, .1, ... also compressed .gz / .xz) are read
+    with the live file. With -r, older files are only opened if needed
+  - Filtered parsing (-m) : the log is memory-mapped, only lines containing the task name(s) are parsed
+  - DSM version detection only reads the beginning and the end of the log files, and is cached
+    in the state directory (-s)
+  - Debug levels (-d, -dd, -ddd or --trace-level), debug output to a file (--trace-file). Debug messages
+    are no more formatted when debug is disabled
+  - Log directory can be changed (-L). Benchmark suite with a synthetic log generator (see benchmark/)
+  - Faster parsing : lines are classified, and task name / date extracted, in one pass with precompiled
+    regular expressions (see benchmark/bench_classifier.py)
+  - Daemon mode (--daemon) : the log is followed in memory (across rotations), checks run with -S
+    ask the daemon for their jobs over a Unix socket instead of parsing the log
+  - Result cache (--cache-ttl, with -s) : repeated checks reuse the jobs found by a previous check,
+    as long as the log file is unchanged. Thresholds and age are computed again at each check
+  - Python 3 compatibility (Python 2.6+ still supported). Modules only needed by some options are
+    imported when used. Can be shipped as a precompiled zipapp (see tools/build_zipapp.py)
+  - Duration history (--history, with -s) : usual execution time (p50 / p95) of each task, and
+    thresholds relative to it (-b, -B)
+  - Batch mode (--batch) : logs collected from several NAS are checked in parallel worker processes
+  - Parallel parsing (-j) : large log files are split into chunks, parsed in worker processes
+  - Performance data on every result (not only OK) : age of the last good result, runs and failures,
+    and cost of the check (lines and bytes parsed, parse time, peak memory)
+  - Jobs are compact records (Job class) : less memory used with years of jobs in the log
+  - Faster date decoding. Backup task lines with an unreadable date are ignored and counted (bad_timestamps)
+  - Prometheus exporter mode (--prometheus) : metrics of all tasks written to a node_exporter textfile
+  - Job index (--index) : jobs stored in a SQLite database, also those of rotated logs. --runs lists
+    the runs of the last days
+  - Log parsed as a pipeline of generators, jobs reduced per task : memory does not grow with the age of the log
+  - Profiling mode (--profile) : time, CPU time, lines and bytes of each stage, optional cProfile statistics
+  - Single-flight (--single-flight) : concurrent checks wait for the first one and reuse its jobs
+  - Discovery mode (--discover) : task names, backup types and last time seen, from a name index
+  - Failure checks (-f, -F, --w_consecutive, --c_consecutive) : ratio of failed jobs and consecutive failures
+    over the last days, from daily counters per task
       
 TODO:
-  - Does not work in case of log rotation (/etc/synolog/synobackup.log.0)
   - Check version rotation completion / errors
   - Documentation for Nagios / NRPE installation
 '''
@@ -99,6 +145,9 @@ MAX_CRITICAL_DAYS = 3
 MAX_WARNING_MINUTES = 60
 MAX_CRITICAL_MINUTES = 180
 
+# Directory for persistent data between runs (empty : nothing is saved, full scan each time)
+STATE_DIR = ""
+
 
 #============================================================================================
 # Nagios return codes 
@@ -131,31 +180,75 @@ def usage():
 
 def helptext():
     
-  print "\n%s v%s (%s) - (c) %s" % (ProgramName, Version, VersionDate, AuthorName) 
+  print ("\n%s v%s (%s) - (c) %s" % (ProgramName, Version, VersionDate, AuthorName))
    
   text = '''
   This is free software. This program comes with ABSOLUTELY NO WARRANTY.
   
   Scans Synology Backup logs for a specific job, then returns information
   about completion of the last occurrence of that job.'''
-  print text
-  print '\nUsage : %s [Options] -t "task" [Switches]  '% (ProgramName)
+  print (text)
+  print ('\nUsage : %s [Options] -t "task" [Switches]  '% (ProgramName))
  
   text = '''
   Required arguments is :
-      -t , --task : task name
+      -t , --task : task name (can be repeated to check several tasks in one pass)
+   or -a , --all-tasks : check all tasks found in the log
   Valid options are : 
       -h, --help : Displays this help text
       -l, --licensing : Displays licensing information
-      -d, --debug : Displays debug / debugging information     
+      -d, --debug : Displays debug / debugging information (repeat for more details : -dd, -ddd)
+      --trace-level=<n> : debug level (1 : main steps, 2 : each job, 3 : each line of the log)
+      --trace-file=<file> : write debug information to <file> instead of standard output
+      -r, --reverse : read the log from the end, and stop at the last good result of the task(s)
+      -m, --mmap : search the memory-mapped log for the task name(s), parse only these lines
+      -j<n>, --jobs : parse large log files in <n> processes (0 : one per core)
+      -P<host>, --passive : print passive check results for <host> (Nagios external commands)
+      --passive-prefix=<text> : prefix of service descriptions for passive results
+      --batch=<dir> : check the logs collected from several NAS, one subdirectory of <dir> per host
+                 (parsed in parallel). With -P, %%s in <host> is replaced by the subdirectory name
+      --daemon : stay resident, follow the log and answer checks on a Unix socket (see -S)
+      -S<file>, --socket : Unix socket of the daemon (default : %s in the -s directory,
+                 or in %s). Without --daemon, the jobs are asked to the daemon (if it
+                 is run by root, by the same user or by the owner of the socket directory), and the
+                 log is parsed only if it does not answer. Only the user and group of the daemon
+                 can use the socket
+      --index=<file> : store the jobs in a SQLite database (with -s, only the jobs of the new lines
+                 are parsed), and read the jobs of the tasks from it : it keeps the jobs of rotated logs
+      --runs=<n> : print every run of the tasks over the last <n> days (from the index, if any).
+                 With -s, -r or -S, only the latest jobs are kept : --index is needed
+      --profile : write the time, CPU time, lines and bytes of each stage of the check to stderr
+      --profile-file=<file> : write the profile to <file> instead of stderr
+      --cprofile=<file> : with the profile, save cProfile statistics to <file> (see pstats)
+      --single-flight : concurrent checks parse the log once : the first one parses it for all
+                 tasks (-r and -m are ignored), the others wait and reuse its jobs
+      --discover=<format> : list the tasks found in the log, with their backup type and last time
+                 seen, then exit. Format : json, lld (Zabbix low-level discovery) or nagios
+      --prometheus=<file> : write the metrics of the tasks (all tasks without -t) to a Prometheus
+                 textfile (node_exporter textfile collector), then exit
   Valid switches are :
       -w<n> , --warning: warning if las result is older than <n> days
       -c<n>, --critical : critical if last result is older than <n> days 
       -W<n> , --w_execution: warning if execution time is longer than <n> minutes
       -C<n> , --c_execution: critical if execution time is longer than <n> minutes
+      -b<x> , --w_baseline: warning if execution time is longer than <x> times the usual one (p50)
+      -B<x> , --c_baseline: critical if execution time is longer than <x> times the usual one (p50)
+      -f<n> , --w_failures: warning if more than <n> %% of the jobs of the window failed
+      -F<n> , --c_failures: critical if more than <n> %% of the jobs of the window failed
+      --w_consecutive=<n> : warning if the last <n> jobs (or more) of the window failed
+      --c_consecutive=<n> : critical if the last <n> jobs (or more) of the window failed
+      --failure-window=<n> : window of the failure checks : last <n> days, today included (default : %d,
+                 at most %d)
+      --history : with -s, record the jobs in a history file per task, and report the usual
+                 execution time (p50 / p95 of the last %d good runs). Implied by -b / -B
+      -s<dir> , --state-dir: save parsing position in <dir>, next runs only parse new lines
+                 (-r, -m and -j are then ignored)
+      --cache-ttl=<n> : with -s, reuse the jobs found by a previous check during <n> seconds,
+                 as long as the log file is unchanged (thresholds are applied again)
+      -L<dir> , --log-dir: directory of the log files (default : /var/log/synolog)
 
  '''
-  print text
+  print (text % (DAEMON_SOCKET, DAEMON_SOCKET_DIR % (os.getuid()), FAILURE_WINDOW, FAILURE_RING_DAYS - 1, HISTORY_WINDOW))
   
   sys.exit(NAGIOS_CODES["UNKNOWN"])
 
@@ -165,8 +258,8 @@ def helptext():
 #============================================================================================
 
 def licensing():
-  print
-  print "  %s v%s (%s) - (c) %s" % (ProgramName, Version, VersionDate, AuthorName)
+  print ()
+  print ("  %s v%s (%s) - (c) %s" % (ProgramName, Version, VersionDate, AuthorName))
   
   Licensing = '''
   This is free software: you can redistribute it and/or modify
@@ -182,9 +275,9 @@ def licensing():
   You should have received a copy of the GNU General Public License
   along with this program.  If not, see <http://www.gnu.org/licenses/>.
   '''
-  print Licensing
-  print  "Type %s -h for Help" % (ProgramName)
-  print
+  print (Licensing)
+  print ("Type %s -h for Help" % (ProgramName))
+  print ()
   
   sys.exit(NAGIOS_CODES["UNKNOWN"])
   
@@ -193,20 +286,49 @@ def licensing():
 # Print debug/verbose information
 #============================================================================================
 
+# Trace levels : each -d (or -v) switch enables one more level (or use --trace-level).
+# Messages are only formatted when their level is enabled. Inside loops, calls are
+# guarded by "if TRACE_LEVEL >= ..." so that nothing is done when tracing is disabled.
+
+TRACE_SUMMARY = 1     # Main steps of the check
+TRACE_JOB = 2         # Each job found in the log
+TRACE_LINE = 3        # Each line of the log
+
+TRACE_LEVEL = 0       # Current trace level (0 : no trace)
+TRACE_OUTPUT = None   # Trace file (--trace-file), None for standard output
+
+def Trace (level, text, *args):
+  if level <= TRACE_LEVEL:
+    if args:
+      text = text % args
+    WriteText (TRACE_OUTPUT or sys.stdout, "%s\n" % (text))
+
 def PrintDebug (text):
-  if debug: 
-    print text
+  if TRACE_LEVEL >= TRACE_SUMMARY: 
+    WriteText (TRACE_OUTPUT or sys.stdout, "%s\n" % (text))
         
         
 #============================================================================================
 # Print the return message and exits with the specified return code 
 #============================================================================================
 
-def nagios_return(code, message):
+def nagios_return(code, message, perfdata=""):
     
-  print code + ": " + message
+  WriteText (sys.stdout, code + ": " + AddPerfData (message, perfdata) + "\n")
   sys.exit(NAGIOS_CODES[code])
 
+
+#============================================================================================
+# Append performance data to a message, after its "|" (added if there is none yet)
+#============================================================================================
+
+def AddPerfData (message, perfdata):
+  if perfdata == "":
+    return message
+  if "|" in message:
+    return message + " " + perfdata
+  return message + "|" + perfdata
+
         
 ################################################################################
 #                                                                              #
@@ -232,7 +354,7 @@ def StringAfter(s, separator):
 
 def StringBetween(s, sep1, sep2):
   try:
-    tmp = s[string.find(s , sep1)+1:string.find(s, sep2)]
+    tmp = s[s.find(sep1)+1:s.find(sep2)]
   except:
     tmp = ''
   return tmp
@@ -244,8 +366,8 @@ def StringBetween(s, sep1, sep2):
 
 def StringContains (s, sub):
   flag = False
-  if s<>"":
-    if string.find(s, sub)<>-1:
+  if s!="":
+    if s.find(sub)!=-1:
       flag= True 
   return flag       
 
@@ -270,14 +392,46 @@ def StringNormalize (s):
   
   
 #===============================================================================
-# Display a datetime in readable form
+# Convert log text from / to bytes, and write it
+#===============================================================================
+
+# Log lines are processed as native strings. Under Python 3, files are read as bytes
+# and decoded as latin-1 : each byte gives one character, so that the length of a line
+# is its size in the file, and any byte sequence (UTF-8 task names ...) is written
+# back unchanged. Command line arguments are converted the same way.
+
+def LogText (data):
+  if PY3:
+    return data.decode('latin-1')
+  return data
+
+def LogBytes (text):
+  if PY3:
+    return text.encode('latin-1')
+  return text
+
+def ArgText (arg):
+  if PY3:
+    return os.fsencode(arg).decode('latin-1')
+  return arg
+
+def WriteText (f, text):
+  if PY3:
+    f = getattr(f, 'buffer', f)       # Binary layer of standard output
+    text = text.encode('latin-1', 'replace')
+  f.write(text)
+
+
+#===============================================================================
+# Display a time (see DateToSeconds) in readable form
 #===============================================================================
   
 # Change according to your country / habits. 
 # Here : DD/MM/YYYY HH:MM:SS
   
-def DisplayDateTime (dt):
+def DisplayDateTime (seconds):
   try:
+    dt = SecondsToDate (seconds)
     dd = "%02d" % (dt.day)
     mm = "%02d" % (dt.month)
     yy = "%s" % dt.year
@@ -290,6 +444,135 @@ def DisplayDateTime (dt):
   return ret  
 
  
+################################################################################
+#                                                                              #
+#                   LOG FILE SET (ROTATED / COMPRESSED LOGS)                   #
+#                                                                              # 
+################################################################################    
+
+# When syslog rotates the log, older lines are moved to synobackup.log.0, then to
+# synobackup.log.1, .2, ... which may be compressed (.gz, .xz). These files are read
+# as one stream, from the oldest to the newest, and are opened only when needed.
+
+# Lines and bytes given to the parser in this run, and Backup task lines ignored because
+# their date is unreadable (performance data of the check)
+STATS = {'lines': 0, 'bytes': 0, 'bad_timestamps': 0}
+
+ROTATED_EXTENSIONS = ['', '.gz', '.xz']    # By order of preference, if several files have the same number
+
+
+#============================================================================================
+# Return the list of existing log files, from the oldest rotated file to the live file
+#============================================================================================
+
+def GetLogFileSet (path):
+
+  files = []
+  directory, basename = os.path.split(path)
+  rotated = {}
+  try:
+    for filename in os.listdir(directory or '.'):
+      if not filename.startswith(basename + '.'):
+        continue
+      number, dot, extension = filename[len(basename)+1:].partition('.')
+      if not number.isdigit() or dot + extension not in ROTATED_EXTENSIONS:
+        continue
+      number = int(number)
+      previous = rotated.get(number)
+      if previous is None or ROTATED_EXTENSIONS.index(dot + extension) < ROTATED_EXTENSIONS.index(previous[1]):
+        rotated[number] = (filename, dot + extension)
+  except:
+    PrintDebug ("Exception listing rotated log files of %s" % (path))
+
+  for number in sorted(rotated, reverse=True):
+    files.append(os.path.join(directory, rotated[number][0]))
+  if os.path.exists(path):
+    files.append(path)
+  return files
+
+
+#============================================================================================
+# Return True if a log file is compressed
+#============================================================================================
+
+def IsCompressed (path):
+  return path.endswith('.gz') or path.endswith('.xz')
+
+
+#============================================================================================
+# Open a log file, decompressing it on the fly if needed
+#============================================================================================
+
+def OpenLogFile (path):
+
+  if path.endswith('.gz'):
+    import gzip
+    return gzip.open(path, 'rb')
+
+  if path.endswith('.xz'):
+    try:
+      import lzma
+    except ImportError:
+      from backports import lzma       # Python 2 : pip install backports.lzma
+    return lzma.open(path, 'rb')
+
+  return open(path, 'rb')
+
+
+#============================================================================================
+# Read the lines of a set of log files, as one stream, from the oldest to the newest
+#============================================================================================
+
+def ReadLogLines (files):
+
+  for path in files:
+    PrintDebug ("Reading log file %s" % (path))
+    try:
+      f = OpenLogFile(path)
+    except:
+      PrintDebug ("Exception opening log file %s. Skipped" % (path))
+      continue
+    try:
+      for line in f:
+        yield LogText(line)
+    finally:
+      f.close()
+
+
+#============================================================================================
+# Read the lines of a set of log files, from the newest to the oldest
+#============================================================================================
+
+# Plain files are read backwards by blocks. Compressed files cannot be read backwards :
+# they are decompressed as a stream, and only the lines accepted by 'keep' are kept in
+# memory to be returned in reverse order. Older files are opened only if the caller
+# asks for more lines.
+
+def ReadLogLinesReverse (files, keep=None):
+
+  for path in reversed(files):
+    PrintDebug ("Reading log file %s backwards" % (path))
+    try:
+      f = OpenLogFile(path)
+    except:
+      PrintDebug ("Exception opening log file %s. Skipped" % (path))
+      continue
+    try:
+      if IsCompressed(path):
+        lines = []
+        for line in f:                 # map() would build a list of all the lines in Python 2
+          line = LogText(line)
+          if keep is None or keep(line):
+            lines.append(line)
+        while lines:
+          yield lines.pop()
+      else:
+        for line in ReadLinesReverse (f, REVERSE_BLOCK_SIZE):
+          yield line
+    finally:
+      f.close()
+
+
 ################################################################################
 #                                                                              #
 #                          LOG FILE PROCESSING                                 #
@@ -305,7 +588,7 @@ def GetTaskName(line, dsm):
     line2 = line if dsm==50 else StringAfter (line, "]")
     name = StringBetween (line2, '[', ']')
   except:
-    PrintDebug("GetTaskName : Exception processing line")
+    Trace (TRACE_LINE, "GetTaskName : Exception processing line")
     name="<Unknown>"
   return name
 
@@ -337,31 +620,76 @@ def GetProblemDetails (line, dsm):
 # Extract date and time from a task line
 #============================================================================================
 
-#    return a datetime type  (year, month , day, hour, minute, second)
-#    Ex: datetime(1000, 1, 2, 3, 4, 5) is 2 january 1000 03:04:05
+# Times are seconds since 01/01/1970, in the local time of the log, as if it were UTC :
+# differences are the same as with datetime objects, which are only built to display a
+# date (see DisplayDateTime).
+#
+# Thousands of lines share the same day : the seconds of each day are computed once.
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+DAY_SECONDS = {}          # "YYYY/MM/DD" -> seconds at 00:00:00 of that day
+
+
+def DaySeconds (y, mo, d):
+  return (date(y, mo, d).toordinal() - EPOCH_ORDINAL) * 86400
+
+
+def TimeSeconds (day, h, mi, s):
+  if h > 23 or mi > 59 or s > 59:
+    raise ValueError("time out of range")
+  return day + h * 3600 + mi * 60 + s
+
+
+#    Fast path : ts is "YYYY/MM/DD HH:MM:SS" (digits checked by the line classifier,
+#    any separator between date and time). Returns None if the date is not valid.
+
+def DecodeTimestamp (ts):
+  try:
+    day = DAY_SECONDS.get(ts[:10])
+    if day is None:
+      day = DAY_SECONDS[ts[:10]] = DaySeconds (int(ts[0:4]), int(ts[5:7]), int(ts[8:10]))
+    return TimeSeconds (day, int(ts[11:13]), int(ts[14:16]), int(ts[17:19]))
+  except ValueError:
+    return None
+
+
+#    Any other layout : "<level> Y/M/D H:M:S ...". Returns None if there is no valid date.
 
-def GetDateTime(line):
+def GetTimestamp (line):
   try:
-    s1 =string.split(line)
+    s1 = line.split()
     
-    s2=string.split(s1[1],"/")
+    s2 = s1[1].split("/")
     y = int(s2[0])
     mo = int(s2[1])
     d = int(s2[2])
     
-    s3=string.split(s1[2],":")
+    s3 = s1[2].split(":")
     h = int(s3[0])
     mi = int(s3[1])
     s = int(s3[2])
     
-    PrintDebug ('Year: %d, Month: %d, Day: %d, Hour: %d, Minute: %d, Second: %d' % (y,mo,d,h,mi,s))
-    time=datetime(y,mo,d,h,mi,s) 
+    if TRACE_LEVEL >= TRACE_LINE:
+      Trace (TRACE_LINE, 'Year: %d, Month: %d, Day: %d, Hour: %d, Minute: %d, Second: %d', y,mo,d,h,mi,s)
+    return TimeSeconds (DaySeconds (y, mo, d), h, mi, s)
   
-  except:
-    PrintDebug("Exception : Unable to extract date and time")
-    time=datetime(1000, 1, 1, 1, 1,1)  
+  except (ValueError, IndexError):
+    Trace (TRACE_LINE, "Exception : Unable to extract date and time")
+    return None
+
+
+#============================================================================================
+#  Times : conversion to datetime (for display), current time
+#============================================================================================
+
+EPOCH = datetime(1970, 1, 1)
 
-  return time #type datetime  (year, month , day, hour, minute, second)
+def SecondsToDate (seconds):
+  return EPOCH + timedelta(seconds=seconds)
+
+def NowSeconds ():
+  now = time.localtime()
+  return TimeSeconds (DaySeconds (now.tm_year, now.tm_mon, now.tm_mday), now.tm_hour, now.tm_min, min(now.tm_sec, 59))
 
 
 #============================================================================================
@@ -376,371 +704,3263 @@ PATH_LOGFILE_DSM51 = "/var/log/synolog/synobackup.log"
 # If synobackup.log is present, and contains "[Network to share]" jobs, then we are under DSM 5.1
 # If synobackup.log is absent, or does not contain "[Network to share]", then we are under DSM <5.1, we must use synonetbkp.log
 
+# Only the beginning and the end of each file are read to find Backup log data. The result
+# is saved in the state directory (if any) with the inode, date and size of the files, so
+# next runs do not read them at all.
+
+DETECT_HEAD_SIZE = 64 * 1024          # Bytes read at the beginning of each file
+DETECT_TAIL_SIZE = 256 * 1024         # Bytes read at the end of each file
+DSM_CACHE_FILENAME = "check_syno_backup.dsm"
+
 
 def CheckDSMVersion():
 
-  DSM = 0
-  
-  # Check if we are under DSM 5.1+
-  
-  PATH = PATH_LOGFILE_DSM51
-  PrintDebug ("Checking existence of file %s" % (PATH))
-  try:
-    if os.path.exists(PATH):
-      PrintDebug ("Found %s log file " % (PATH))
-      try:
-        f = open (PATH, 'r')    
-        for line in f:
-          if    StringContains (line, "[Network to share]") \
-             or StringContains (line, "[Network to volume]") \
-             or StringContains (line, "[Local to volume]")  \
-             or StringContains (line, "[Local]") \
-             or StringContains (line, "[Network]"):
-            DSM=51
-            PrintDebug ("File %s contains Backup log data." % (PATH))
-            return DSM, PATH  
-        PrintDebug ("File %s is readable, but it does not contain NetBackup data" % (PATH))
-        f.close()        
-      except:
-        PrintDebug ("Exception reading file %s" % (PATH))      
-    else:
-      PrintDebug ("File %s not found." % (PATH))   
-  except:
-    PrintDebug ("Exception checking file path for %s" % (PATH))      
-    
-  # Check if we are under DSM <5.1
-  
-  PATH = PATH_LOGFILE_DSM50  
-  PrintDebug ("Checking existence of file %s" % (PATH))  
-  try:
-    if os.path.exists(PATH):
-      PrintDebug ("Found %s log file" % (PATH))
-      try:
-        f = open (PATH, 'r')    
-        for line in f:
-          if StringContains (line, "Network Backup started to backup task"):
-            DSM=50
-            PrintDebug ("File %s contains NetBackup log data." % (PATH))
-            return DSM, PATH  
-        PrintDebug ("File %s is readable, but it does not contain NetBackup data" % (PATH))
-        f.close()        
-      except:
-        PrintDebug ("Exception reading file %s" % (PATH))      
-    else:
-      PrintDebug ("File %s not found." % (PATH))   
-      
-  except:
-    PrintDebug ("Exception checking file path for %s. Check unix path and rights" % (PATH))      
+  starttime = time.time()
+  cachepath = StatePath(DSM_CACHE_FILENAME) if STATE_DIR else ""
   
-  # None of them found or readable
+  if cachepath:
+    DSM, PATH = LoadDSMCache(cachepath)
+    if DSM != 0:
+      PrintDebug ("DSM version %d read from cache %s in %.1f ms" % (DSM, cachepath, (time.time() - starttime) * 1000))
+      return DSM, PATH
+
+  DSM, PATH, files = DetectDSMVersion()
+  PrintDebug ("DSM version detection took %.1f ms" % ((time.time() - starttime) * 1000))
   
-  PrintDebug ("Unable to check presence of log files %s or %s" % (PATH_LOGFILE_DSM50, PATH_LOGFILE_DSM51))
-  PATH=""
+  if cachepath and DSM != 0:
+    SaveDSMCache(cachepath, DSM, PATH, files)
   return DSM, PATH
 
 
 #============================================================================================
-#  Parse log file and extract informations about log jobs
+# Read the beginning and the end of a log file
 #============================================================================================
-    
-# Returns a table. Each element is a dictionnary type, containing informations about a job.
-# Keys are : 'name','start', 'duration', 'status', 'error'
-# 'status' can take only two values: 'OK' or 'CRITICAL'
 
-def ParseLogFile (path, dsm):
-    
-  TABLE_FINISHED = []    # Table of finished tasks
-  TABLE_PROCESSING = []  # Temporary table for processing tasks
+def ReadFileSample (path):
 
-  PrintDebug ("Parsing file %s with DSM version %d" % (path, dsm))
-     
+  f = OpenLogFile(path)
   try:
-    f = open(path, 'r')    
-    
-    for line in f:
-    
-      PrintDebug ('--------------------------------------------------------------')
-      PrintDebug ("Processing line:")
-      PrintDebug (line)
-      
-      # ===== Is it a NetBackup task ? (DSM5.0 and lower log contains only NetBackup tasks, but DSM >5.1 contains other backup types)
-      
-      if dsm==50 \
-      or (dsm==51 and (   StringContains (line, "[Network to share]") \
-                       or StringContains (line, "[Network to volume]") \
-                       or StringContains (line, "[Local to volume]") \
-                       or StringContains (line, "[Local]") \
-                       or StringContains (line, "[Network]"))) :
-      
-        PrintDebug ("    OK, this is a recognised Backup task line")
-      
-        name = GetTaskName(line, dsm)
-        PrintDebug ("    Found task name : %s" % (name))
-      
-        # ---------- Is it the beginning of a task ?
-        
-        starttext = "Network Backup started to backup task" if dsm==50 else "Backup task started."
-        if StringContains (line, starttext) :
-          
-          PrintDebug ("    -> This is task start")
-          starttime = GetDateTime(line)
-          name = GetTaskName(line, dsm)
-          PrintDebug ("       Task [%s] started at : %s" % (name, DisplayDateTime(starttime))) 
-
-          status = 'UNKNOWN'
-          problem = "None"
-          endtime = datetime(3000, 1, 1, 1, 1,1)
-          duration = 0          
-          
-          # Is the task already in the processing table ?
+    data = f.read(DETECT_HEAD_SIZE)
+    if not IsCompressed(path):
+      size = os.fstat(f.fileno()).st_size
+      if size > DETECT_HEAD_SIZE:
+        f.seek(max(DETECT_HEAD_SIZE, size - DETECT_TAIL_SIZE))
+        data = data + b'\n' + f.read(DETECT_TAIL_SIZE)
+  finally:
+    f.close()
+  return LogText(data)
 
-          Found = False
-          for t in TABLE_PROCESSING:
-            if t['name'] == name:
 
-              # If found, update that task data
-              
-              PrintDebug ('       WARNING, found previously started task [%s]. Updating data.' % name)              
-              t['start'] = starttime
-              t['end'] = endtime
-              t['duration'] = duration
-              t['status'] = status
-              t['error'] = problem
-              Found = True
-          
-          # If not found, create new dictionary entry in the processing table
+#============================================================================================
+# Search Backup log data in a sample of a log file and of its rotated files
+#============================================================================================
 
-          if not (Found) :          
-            dct = dict([('name', name), ('start',starttime), ('end', endtime), ('duration', duration), ('status', status), ('error', problem)] )
-            TABLE_PROCESSING.append(dct)
-            PrintDebug ("       Added task [%s] to the processing table" % name)
-            
-            
-        #  ---------- is it an error line ?
-        
-        elif StringContains (line, "err") :
-          
-          PrintDebug ("    -> This is an error line")
-          name = GetTaskName(line, dsm)
-          
-          # Is this task in our processing table ?
-          
-          for t in TABLE_PROCESSING:
-            if t['name'] == name:
-              PrintDebug ('       Found previously started task [%s]' % name)      
-              
-              # Add to the finished tasks table
-
-              t2 = t
-              t2['status'] = 'CRITICAL'
-              t2['problem'] = GetProblemDetails (line, dsm) 
-              t2['end'] = GetDateTime (line)
-              t2['duration'] = t2['end'] - t2['start']
-              TABLE_FINISHED.append(t2)
-              TABLE_PROCESSING.remove (t)
-              PrintDebug ('       Added to the finished tasks list with CRITICAL status')
-              break
-            
-            
-        # ---------- Is it the end of a task ?
-          
-        elif StringContains (line, "finished") :
-          
-          PrintDebug ("    -> This the normal end of a task")
-          name = GetTaskName(line, dsm)
+def LogFileSampleContains (path, patterns):
 
-          # Is this task in our processing table ?
-          
-          for t in TABLE_PROCESSING:
-            if t['name'] == name:
-              PrintDebug ('       Found previously started task [%s]' % name)      
-              
-              # Add to the finished tasks table
-
-              t2 = t
-              t2['status'] = 'OK'
-              t2['problem'] = "Task finished successfully" 
-              t2['end'] = GetDateTime (line)
-              t2['duration'] = t2['end'] - t2['start']
-              TABLE_FINISHED.append(t2)
-              TABLE_PROCESSING.remove (t)
-              PrintDebug ('       Added to the finished tasks list with OK status')
-              break             
-    
-      PrintDebug ('----- Tasks being processed : %d ----- Tasks finished : %d -----' % (len (TABLE_PROCESSING), len(TABLE_FINISHED)))
-      
-    PrintDebug ('--------------------------------------------------------------')
-    f.close()
-  except:
-    PrintDebug ("Exception parsing log file %s" %(path))
-      
-  # return a table of finished tasks (each task is a dict)   
-  
-  return TABLE_FINISHED
+  for filename in reversed(GetLogFileSet(path)):
+    data = ReadFileSample(filename)
+    for pattern in patterns:
+      if pattern in data:
+        PrintDebug ("File %s contains Backup log data." % (filename))
+        return True
+  return False
 
 
 #============================================================================================
-# Find the most recent task with given name whose status is OK 
+# Detect DSM version from the content of the log files
 #============================================================================================
 
-def FindLatestTask (table, taskname):
-    
-  lastdate= datetime(1200,4,4,4,4,4)  # datetime(years, months, days, hours, minutes, secondes)
+# Returns version number, path to the right log file, and the list of files checked
 
-  exists = False     # Flag if we found some task with the specified name
-  found = {}         # contains last good task found (empty if none)
+def DetectDSMVersion():
+
+  files = []
+
+  for DSM, PATH, patterns in [(51, PATH_LOGFILE_DSM51, BACKUP_TYPES_DSM51),
+                              (50, PATH_LOGFILE_DSM50, ["Network Backup started to backup task"])]:
+    files.append(PATH)
+    PrintDebug ("Checking existence of file %s" % (PATH))
+    try:
+      if os.path.exists(PATH):
+        PrintDebug ("Found %s log file " % (PATH))
+        try:
+          if LogFileSampleContains (PATH, patterns):
+            return DSM, PATH, files
+          PrintDebug ("File %s is readable, but it does not contain NetBackup data" % (PATH))
+        except:
+          PrintDebug ("Exception reading file %s" % (PATH))      
+      else:
+        PrintDebug ("File %s not found." % (PATH))   
+    except:
+      PrintDebug ("Exception checking file path for %s. Check unix path and rights" % (PATH))      
   
-  PrintDebug ("Searching for latest occurrence of task %s " % (taskname))
-  try:      
-    for dct in table:
-      if dct['name'] == taskname :
-        exists = True
-        if dct['status'] == 'OK':
-          if dct['start'] > lastdate:
-            lastdate = dct ['start']
-            found = dct
-  except:
-    found = {}
-    PrintDebug ("Exception - Unable to locate latest Backup task")            
-              
-  return exists, found            
+  # None of them found or readable
+  
+  PrintDebug ("Unable to check presence of log files %s or %s" % (PATH_LOGFILE_DSM50, PATH_LOGFILE_DSM51))
+  return 0, "", files
 
 
 #============================================================================================
-# Debug : Print list of task names found  
+# Return the inode, modification time and size of a file (None if it does not exist)
 #============================================================================================
-              
-def PrintTaskNames (table):
 
-  listnames = []  
-  PrintDebug ('List of Backup tasks found in log :')
+def FileSignature (path):
   try:
-    for dic in table:
-      if dic['name'] not in listnames:
-        listnames.append(dic['name'])
-        PrintDebug( "   " + dic['name'])
+    st = os.stat(path)
+    return [st.st_ino, int(st.st_mtime), st.st_size]
+  except OSError:
+    return None
+
+
+#============================================================================================
+# Load / save the detected DSM version
+#============================================================================================
+
+# The cached version is valid as long as the detected log file has the same inode and has
+# not been truncated (new lines do not change the format), and the other files checked
+# (without Backup log data) have not changed at all.
+
+def LoadDSMCache (cachepath):
+
+  cache = LoadState(cachepath)
+  if cache is None:
+    return 0, ""
+  try:
+    PATH = StateString(cache['path'])
+    for path in cache['files']:
+      cached = cache['files'][path]
+      current = FileSignature(StateString(path))
+      if cached is None or current is None:
+        valid = cached == current
+      elif StateString(path) == PATH:
+        valid = current[0] == cached[0] and current[2] >= cached[2]
+      else:
+        valid = current == cached
+      if not valid:
+        PrintDebug ("File %s has changed since DSM version was detected" % (path))
+        return 0, ""
+    return cache['dsm'], PATH
   except:
-    PrintDebug ("Exception printing list of tasks")
+    PrintDebug ("Exception reading DSM version cache %s. Ignored" % (cachepath))
+  return 0, ""
+
+
+def SaveDSMCache (cachepath, DSM, PATH, files):
 
+  signatures = {}
+  for path in files:
+    signatures[path] = FileSignature(path)
+  SaveState(cachepath, { 'version': STATE_VERSION, 'dsm': DSM, 'path': PATH, 'files': signatures })
 
 
 #============================================================================================
-# Debug : Print all tasks found within the last nbday days
+#  Classify a line : beginning, error or normal end of a Backup task
 #============================================================================================
 
-def PrintTasksSince (table, taskname, nbday):
-    
-  print "List of Backup tasks since %d days :" % (nbday)
+# Each DSM log format has its own classifier, built once with precompiled regular
+# expressions. In one pass, it returns a record (kind, name, time, message), kind being
+# one of LINE_START, LINE_ERROR, LINE_FINISHED, or None if the line is not a Backup task
+# start/end line. The message is only extracted for error lines. Time is in seconds
+# (see DecodeTimestamp).
+#
+# Lines that do not have the usual layout are processed with GetTaskName, GetTimestamp
+# and GetProblemDetails, so the result is always the same as with these functions.
+#
+# Task lines with an unreadable date are ignored (None), and counted in STATS.
+
+LINE_START = 'start'
+LINE_ERROR = 'error'
+LINE_FINISHED = 'finished'
+
+# Backup types found in DSM 5.1+ log lines (DSM5.0 and lower log contains only NetBackup tasks)
+
+BACKUP_TYPES_DSM51 = ["[Network to share]", "[Network to volume]", "[Local to volume]", "[Local]", "[Network]"]
+
+LINE_CLASSIFIERS = {}
+
+
+def MakeLineClassifier (dsm):
+
+  import re
   
-  try:
-    for dic in table:
-      if dic['name'] == taskname:
-        if dic['start'] > datetime.now()-timedelta(days=nbday):
-          print "  Task: %s, started: %s, status: %s, execution time: %s" % (dic['name'], DisplayDateTime(dic['start']), dic['status'], str(dic['duration']))
-  except:
-    PrintDebug("Exception during  display of last tasks")
+  # "<level> YYYY/MM/DD HH:MM:SS ..." then the task name between brackets (DSM 5.0), or
+  # the backup type between brackets, then the task name between brackets (DSM 5.1+)
+
+  timestamp = r'\S+\s+(\d\d\d\d/\d\d/\d\d\s\d\d:\d\d:\d\d)\s'
+  if dsm == 50:
+    starttext = "Network Backup started to backup task"
+    backuptype = None
+    layout = re.compile(timestamp + r'[^\[\]]*\[([^\]]*)\]')
+  else:
+    starttext = "Backup task started."
+    backuptype = re.compile('|'.join([re.escape(t) for t in BACKUP_TYPES_DSM51]))
+    layout = re.compile(timestamp + r'[^\]]*\][^\[\]]*\[([^\]]*)\]')
+
+  def classify (line):
+    if backuptype is not None and backuptype.search(line) is None:
+      return None
+    if starttext in line:
+      kind = LINE_START
+    elif "err" in line:
+      kind = LINE_ERROR
+    elif "finished" in line:
+      kind = LINE_FINISHED
+    else:
+      return None
+
+    m = layout.match(line)
+    if m is None:
+      name = GetTaskName (line, dsm)
+      when = GetTimestamp (line)
+      message = GetProblemDetails (line, dsm) if kind == LINE_ERROR else ""
+    else:
+      ts, name = m.groups()
+      when = DecodeTimestamp (ts)
+      if kind != LINE_ERROR:
+        message = ""
+      elif dsm == 50:
+        message = GetProblemDetails (line, dsm)
+      else:
+        message = line[m.end():]
+
+    if when is None:
+      STATS['bad_timestamps'] += 1
+      if TRACE_LEVEL >= TRACE_LINE:
+        Trace (TRACE_LINE, "    Ignored : unreadable date in Backup task line")
+      return None
+    return (kind, name, when, message)
+
+  return classify
 
 
 #============================================================================================
-# Debug : Print details of a task
+#  Return the line classifier of a DSM log format
 #============================================================================================
 
-def PrintTaskDetails (task):
+def GetLineClassifier (dsm):
+  classify = LINE_CLASSIFIERS.get(dsm)
+  if classify is None:
+    classify = LINE_CLASSIFIERS[dsm] = MakeLineClassifier (dsm)
+  return classify
+
+
+def ClassifyLine (line, dsm):
+  return GetLineClassifier(dsm) (line)
+
 
-  print "========== Details of task =========="
-  print "  Task name  : %s" % task['name']
-  print "  Start time : %s" % DisplayDateTime(task['start'])
-  print "  End time   : %s" % DisplayDateTime(task['end'])
-  print "  Duration   : %s" % task['duration']
-  print "  Status     : %s" % task['status']
-  print "  Details    : %s" % task['error']
-  print "===="
-          
- 
 #============================================================================================
-# Test task, and compare with threshold values
+#  A job : one run of a task
 #============================================================================================
 
-def CheckThreshold(task):
+# Jobs of years of logs are kept in memory : a job is a compact record (no per-instance
+# dictionary), its task name is shared with the other jobs of the task, times are
+# seconds (see DecodeTimestamp), and status is one of 'OK', 'CRITICAL' (finished) or
+# 'UNKNOWN' (still running).
 
-  message = ""
-  code = 'UNKNOWN'              # Overall Nagios return code
-  code_age = 'UNKNOWN'          # Partial return code about the age of the last good task
-  code_duration = 'UNKNOWN'     # Partial return code about the duration of the last good task
+try:
+  from sys import intern as Intern        # Python 3
+except ImportError:
+  Intern = intern
 
+class Job (object):
 
-  # Is the last good task recent enough ?
+  __slots__ = ('name', 'start', 'end', 'status', 'problem')
+
+  def __init__ (self, name, start, end=None, status='UNKNOWN', problem=None):
+    self.name = name
+    self.start = start
+    self.end = end
+    self.status = status
+    self.problem = problem
+
+  @property
+  def duration (self):
+    if self.end is None:
+      return 0
+    return self.end - self.start
+
+  def __repr__ (self):
+    return "Job(%r, %r, %r, %r, %r)" % (self.name, self.start, self.end, self.status, self.problem)
+
+
+#============================================================================================
+#  Create a new job, or complete a job with the record of its end line 
+#============================================================================================
+
+def NewJob (name, starttime):
+  return Job (Intern(name), starttime)
+
+
+# The error message is the end of the log line : its spaces and newline are stripped
+# once here, for the state, the index and the outputs.
+
+def EndJob (job, record):
+  kind, name, when, message = record
+  if kind == LINE_ERROR:
+    job.status = 'CRITICAL'
+    job.problem = message.strip()
+  else:
+    job.status = 'OK'
+    job.problem = "Task finished successfully" 
+  job.end = when
   
-  taskdate = DisplayDateTime (lasttask['end'])
-  age_timedelta = datetime.now()-lasttask['end']     # Age of the latest task
-  age_days = age_timedelta.total_seconds() / 86400       # Age in days  
-  PrintDebug (" The last task is %d days old "% (age_days))
+
+#============================================================================================
+#  Process one line of the log file
+#============================================================================================
+
+# Updates the processing table (started tasks) and the finished table (completed tasks)
+# according to the content of the line.
+
+def ParseLine (line, dsm, TABLE_PROCESSING, TABLE_FINISHED):
+
+  if TRACE_LEVEL >= TRACE_LINE:
+    Trace (TRACE_LINE, '--------------------------------------------------------------')
+    Trace (TRACE_LINE, "Processing line:")
+    Trace (TRACE_LINE, line)
   
-  if age_days > MAX_CRITICAL_DAYS:
-    code_age = 'CRITICAL'
-    message = "[CRIT] Last good result (%s) is more than %d days old" % (taskdate, MAX_CRITICAL_DAYS)
+  record = ClassifyLine (line, dsm)
   
-  elif age_days > MAX_WARNING_DAYS:
-    code_age = 'WARNING'
-    message = "[WARN] Last good result (%s) is more than %d days old" % (taskdate, MAX_WARNING_DAYS)
+  if record is not None:
   
-  elif age_days < 0 :
-    code_age = 'UNKNOWN'
-    message = message + "Task date error, older than now"
+    kind, name, when, message = record
+    if TRACE_LEVEL >= TRACE_LINE:
+      Trace (TRACE_LINE, "    OK, this is a recognised Backup task line")
+      Trace (TRACE_LINE, "    Found task name : %s", name)
   
-  else :
-    code_age = 'OK'
-    message = "Last good result (%s) is within the last %d days" % (taskdate, MAX_WARNING_DAYS) 
+    # ---------- Is it the beginning of a task ?
+    
+    if kind == LINE_START:
+      
+      if TRACE_LEVEL >= TRACE_JOB:
+        Trace (TRACE_LINE, "    -> This is task start")
+        Trace (TRACE_JOB, "       Task [%s] started at : %s", name, DisplayDateTime(when))
+
+      # Is the task already in the processing table ?
+
+      Found = False
+      for t in TABLE_PROCESSING:
+        if t.name == name:
+
+          # If found, update that task data
+          
+          if TRACE_LEVEL >= TRACE_JOB:
+            Trace (TRACE_JOB, '       WARNING, found previously started task [%s]. Updating data.', name)
+          t.start = when
+          Found = True
+      
+      # If not found, create new dictionary entry in the processing table
+
+      if not (Found) :          
+        TABLE_PROCESSING.append(NewJob (name, when))
+        if TRACE_LEVEL >= TRACE_LINE:
+          Trace (TRACE_LINE, "       Added task [%s] to the processing table", name)
+        
+        
+    #  ---------- is it an error line, or the end of a task ?
+    
+    else:
+      
+      if TRACE_LEVEL >= TRACE_LINE:
+        if kind == LINE_ERROR:
+          Trace (TRACE_LINE, "    -> This is an error line")
+        else:
+          Trace (TRACE_LINE, "    -> This the normal end of a task")
+      
+      # Is this task in our processing table ?
+      
+      for t in TABLE_PROCESSING:
+        if t.name == name:
+          
+          # Add to the finished tasks table
+
+          EndJob (t, record)
+          TABLE_FINISHED.append(t)
+          TABLE_PROCESSING.remove (t)
+          if TRACE_LEVEL >= TRACE_JOB:
+            Trace (TRACE_JOB, '       Task [%s] finished at : %s with %s status', name, DisplayDateTime(when), t.status)
+          break
+
+  if TRACE_LEVEL >= TRACE_LINE:
+    Trace (TRACE_LINE, '----- Tasks being processed : %d ----- Tasks finished : %d -----', len (TABLE_PROCESSING), len(TABLE_FINISHED))
+
+
+################################################################################
+#                                                                              #
+#                  STREAMING PARSING (PER-TASK REDUCERS)                       #
+#                                                                              # 
+################################################################################    
+
+# The log is parsed as a pipeline of generators : lines, then records of the Backup task
+# lines (ClassifyLines), then finished jobs (PairJobs). Jobs are given to a reducer per
+# task, which keeps only what a check needs : the last good job, the last job, the jobs
+# of the last days (runs and failures of the performance data), and counters. Memory
+# depends on the number of tasks, not on the age of the log.
+
+
+#============================================================================================
+#  Lines -> records of the Backup task lines (other lines are skipped)
+#============================================================================================
+
+def ClassifyLines (lines, dsm):
+
+  classify = GetLineClassifier (dsm)
+  for line in lines:
+    STATS['lines'] += 1
+    STATS['bytes'] += len(line)
+    if TRACE_LEVEL >= TRACE_LINE:
+      Trace (TRACE_LINE, "Processing line:")
+      Trace (TRACE_LINE, line)
+    record = classify (line)
+    if record is not None:
+      yield record
+
+
+#============================================================================================
+#  Records -> finished jobs, in the order of their end line
+#============================================================================================
+
+# Same pairing as ParseLine : a task has at most one job running. A start line of a
+# running task restarts it, an end line of a task which is not running is ignored.
+
+def PairJobs (records):
+
+  running = {}
+  for record in records:
+    kind, name, when = record[0], record[1], record[2]
+    if kind == LINE_START:
+      if name in running:
+        if TRACE_LEVEL >= TRACE_JOB:
+          Trace (TRACE_JOB, '       WARNING, found previously started task [%s]. Updating data.', name)
+        running[name].start = when
+      else:
+        running[name] = NewJob (name, when)
+      if TRACE_LEVEL >= TRACE_JOB:
+        Trace (TRACE_JOB, "       Task [%s] started at : %s", name, DisplayDateTime(when))
+    elif name in running:
+      job = running.pop(name)
+      EndJob (job, record)
+      if TRACE_LEVEL >= TRACE_JOB:
+        Trace (TRACE_JOB, '       Task [%s] finished at : %s with %s status', name, DisplayDateTime(when), job.status)
+      yield job
+
+
+#============================================================================================
+#  Finished jobs of a log file (and of its rotated files)
+#============================================================================================
+
+def ParseJobs (path, dsm):
+  if PROFILE is not None:
+    lines = ProfileIterator ('read', ReadLogLines (GetLogFileSet(path)), True)
+    records = ProfileIterator ('classify', ClassifyLines (lines, dsm))
+    return ProfileIterator ('pair', PairJobs (records))
+  return PairJobs (ClassifyLines (ReadLogLines (GetLogFileSet(path)), dsm))
+
+
+#============================================================================================
+#  Reducer of the jobs of a task
+#============================================================================================
+
+# Keeps the last good job (the first one, if several have the same start time : see
+# FindLatestTask), the last job, the jobs ended since 'since', and the number of good
+# and failed jobs. Jobs are numbered in the order of the log ('seq'), so that the table
+# of a reducer lists them in the same order as the whole table.
+
+class TaskReducer (object):
+
+  __slots__ = ('name', 'latestgood', 'latest', 'recent', 'successes', 'failures')
+
+  def __init__ (self, name):
+    self.name = name
+    self.latestgood = None     # (seq, job)
+    self.latest = None         # (seq, job)
+    self.recent = []           # [(seq, job)] ended since 'since'
+    self.successes = 0
+    self.failures = 0
+
+  def add (self, seq, job, since):
+    if job.status == 'OK':
+      self.successes += 1
+      if self.latestgood is None or job.start > self.latestgood[1].start:
+        self.latestgood = (seq, job)
+    else:
+      self.failures += 1
+    if self.latest is None or job.start >= self.latest[1].start:
+      self.latest = (seq, job)
+    if job.end >= since:
+      self.recent.append((seq, job))
+
+  def jobs (self):
+    kept = dict(self.recent)
+    for entry in (self.latestgood, self.latest):
+      if entry is not None:
+        kept[entry[0]] = entry[1]
+    return [kept[seq] for seq in sorted(kept)]
+
+
+#============================================================================================
+#  Reduce jobs, per task
+#============================================================================================
+
+# Only the jobs of the given tasks are kept (all tasks if empty). Returns the reducers,
+# in order of the first job of each task.
+
+def ReduceJobs (jobs, tasknames, since):
+
+  wanted = dict([(name, True) for name in tasknames])
+  reducers = {}
+  order = []
+  seq = 0
+  for job in jobs:
+    seq += 1
+    reducer = reducers.get(job.name)
+    if reducer is None:
+      if wanted and job.name not in wanted:
+        continue
+      reducer = reducers[job.name] = TaskReducer (job.name)
+      order.append(reducer)
+    reducer.add (seq, job, since)
+  return order
+
+
+# Table of the jobs kept by the reducers : same result as the whole table for the checks
+# (FindLatestTask, GetTaskNames, CountRuns and PrintTasksSince since 'since').
+
+def ReducedTable (reducers):
+  table = []
+  for reducer in reducers:
+    table.extend(reducer.jobs())
+  return table
+
+
+#============================================================================================
+#  Parse log file and extract informations about log jobs
+#============================================================================================
+    
+# Returns a table. Each element is a Job : 'name', 'start', 'end', 'duration', 'status',
+# 'problem'. 'status' can take only two values: 'OK' or 'CRITICAL'
+
+def ParseLogFile (path, dsm):
+    
+  TABLE_FINISHED = []    # Table of finished tasks
+
+  PrintDebug ("Parsing file %s (and rotated files) with DSM version %d" % (path, dsm))
+     
+  try:
+    for job in ParseJobs (path, dsm):
+      TABLE_FINISHED.append(job)
+    PrintDebug ('--------------------------------------------------------------')
+  except:
+    PrintDebug ("Exception parsing log file %s" %(path))
+      
+  return TABLE_FINISHED
+
+
+# Returns the reducers of the given tasks (all tasks if empty), see ReduceJobs
+
+def ParseLogFileReduced (path, dsm, tasknames, since):
+
+  PrintDebug ("Parsing file %s (and rotated files) with DSM version %d, jobs kept since %s" % (path, dsm, DisplayDateTime(since)))
+
+  def jobs ():
+    try:
+      for job in ParseJobs (path, dsm):
+        yield job
+    except:
+      PrintDebug ("Exception parsing log file %s" %(path))
+
+  if PROFILE is None:
+    return ReduceJobs (jobs(), tasknames, since)
+  start = ProfileStart()
+  reducers = ReduceJobs (jobs(), tasknames, since)
+  ProfileStop ('reduce', start, len(reducers))
+  return reducers
+
+
+################################################################################
+#                                                                              #
+#                  REVERSE PARSING (NEWEST LINES FIRST)                        #
+#                                                                              # 
+################################################################################    
+
+# With -r, the log file is read backwards, from the end, by large blocks. End lines
+# (finished / error) are paired with their start line in reverse order, and reading stops
+# as soon as the latest good occurrence of each requested task has been found.
+
+REVERSE_BLOCK_SIZE = 1024 * 1024
+
+
+#============================================================================================
+# Read lines of an opened file, from the last one to the first one
+#============================================================================================
+
+def ReadLinesReverse (f, blocksize=REVERSE_BLOCK_SIZE):
+
+  f.seek(0, 2)
+  position = f.tell()
+  buf = b''
+  
+  while position > 0:
+    size = min(blocksize, position)
+    position -= size
+    f.seek(position)
+    buf = f.read(size) + buf
+
+    # Before 'limit', the beginning of the buffer may be an incomplete line : it is kept
+    # until the previous block has been read (except at the beginning of the file)
+
+    if position > 0:
+      limit = buf.find(b'\n') + 1
+      if limit == 0:
+        continue              # Line longer than a block
+    else:
+      limit = 0
+
+    end = len(buf)
+    while True:
+      nl = buf.rfind(b'\n', limit, end - 1)
+      if nl == -1:
+        break
+      yield LogText(buf[nl+1:end])
+      end = nl + 1
+    if end > limit:
+      yield LogText(buf[limit:end])
+    buf = buf[:limit]
+
+
+#============================================================================================
+#  Parse log file backwards, until the latest good job of each task is found
+#============================================================================================
+
+# Returns a table of the jobs found while scanning (only for the requested task names),
+# in the same format as ParseLogFile. FindLatestTask gives the same result on that table
+# as on the full table.
+
+def ParseLogFileReverse (path, dsm, tasknames):
+
+  TABLE_FINISHED = []    # Table of finished tasks (newest first)
+  PENDING = {}           # Record of the latest end line of each task not yet paired with its start line
+  remaining = {}         # Tasks whose latest good job has not been found yet
+  for name in tasknames:
+    remaining[name] = True
+
+  PrintDebug ("Parsing file %s backwards with DSM version %d" % (path, dsm))
+  
+  # Lines of compressed files are kept in memory : only those naming a requested task,
+  # found by a substring search. Each line is classified once, in the loop below.
+
+  classify = GetLineClassifier (dsm)
+  patterns = [TaskPattern(name) for name in tasknames]
+  def keep (line):
+    for pattern in patterns:
+      if pattern in line:
+        return True
+    return False
+
+  nblines = 0
+  try:
+    lines = ReadLogLinesReverse (GetLogFileSet(path), keep)
+    try:
+      for line in lines:
+        nblines += 1
+        STATS['bytes'] += len(line)
+        record = classify (line)
+        if record is None or record[1] not in remaining:
+          continue
+        kind, name, when, message = record
+
+        if kind != LINE_START:
+          PENDING[name] = record     # An end line closes the nearest previous start line
+
+        elif name in PENDING:
+          job = NewJob (name, when)
+          EndJob (job, PENDING.pop(name))
+          TABLE_FINISHED.append(job)
+          if TRACE_LEVEL >= TRACE_JOB:
+            Trace (TRACE_JOB, "Found task [%s] started at %s with %s status", name, DisplayDateTime(job.start), job.status)
+
+          if job.status == 'OK':
+            del remaining[name]
+            if not remaining:
+              break
+    finally:
+      lines.close()           # Closes the current file, older files are never opened
+  except:
+    PrintDebug ("Exception parsing log file %s" %(path))
+
+  STATS['lines'] += nblines
+  PrintDebug ("%d lines read backwards, %d jobs found" % (nblines, len(TABLE_FINISHED)))
+  
+  return TABLE_FINISHED
+
+
+################################################################################
+#                                                                              #
+#                  FILTERED PARSING (MEMORY-MAPPED LOG FILE)                   #
+#                                                                              # 
+################################################################################    
+
+# With -m, the log file is memory-mapped, and searched for "[task name]" with fast
+# byte searches. Only the lines containing one of the requested task names are given
+# to ParseLine : all other lines are never copied nor decoded.
+
+
+#============================================================================================
+# Return the search pattern of a task name (task names appear between brackets)
+#============================================================================================
+
+def TaskPattern (taskname):
+  return "[" + taskname + "]"
+
+
+#============================================================================================
+# Return the start offsets of the lines containing a pattern, in increasing order
+#============================================================================================
+
+def FindLineStarts (m, pattern):
+
+  position = m.find(pattern)
+  while position != -1:
+    start = m.rfind(b'\n', 0, position) + 1
+    end = m.find(b'\n', position)
+    yield start
+    if end == -1:
+      break
+    position = m.find(pattern, end)
+
+
+#============================================================================================
+# Read the lines of a file containing at least one of the patterns, in file order
+#============================================================================================
+
+def ReadMatchingLinesMmap (path, patterns):
+
+  import mmap, heapq
   
+  f = open(path, 'rb')
+  try:
+    if os.fstat(f.fileno()).st_size == 0:
+      return
+    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      previous = -1
+      for start in heapq.merge(*[FindLineStarts(m, LogBytes(p)) for p in patterns]):
+        if start == previous:
+          continue                 # Line containing several patterns
+        previous = start
+        end = m.find(b'\n', start)
+        yield LogText(m[start:] if end == -1 else m[start:end+1])
+    finally:
+      m.close()
+  finally:
+    f.close()
+
+
+#============================================================================================
+# Read the lines of a set of log files containing at least one of the patterns
+#============================================================================================
+
+# Plain files are memory-mapped. Compressed files are read as a stream and filtered.
+
+def ReadMatchingLines (files, patterns):
+
+  for path in files:
+    if IsCompressed(path):
+      for line in ReadLogLines ([path]):
+        for p in patterns:
+          if p in line:
+            yield line
+            break
+    else:
+      PrintDebug ("Searching memory-mapped log file %s" % (path))
+      try:
+        for line in ReadMatchingLinesMmap (path, patterns):
+          yield line
+      except:
+        PrintDebug ("Exception reading log file %s. Skipped" % (path))
+
+
+#============================================================================================
+#  Parse only the lines of the log file about the requested tasks
+#============================================================================================
+
+# Returns a table of the jobs of the requested tasks, in the same format as ParseLogFile.
+
+def ParseLogFileFiltered (path, dsm, tasknames):
+
+  TABLE_FINISHED = []    # Table of finished tasks
+  TABLE_PROCESSING = []  # Temporary table for processing tasks
+
+  PrintDebug ("Parsing file %s (and rotated files) with DSM version %d, only lines about %s" % (path, dsm, ", ".join(tasknames)))
+
+  patterns = [TaskPattern(name) for name in tasknames]
+  nblines = 0
+  try:
+    for line in ReadMatchingLines (GetLogFileSet(path), patterns):
+      nblines += 1
+      STATS['bytes'] += len(line)
+      ParseLine (line, dsm, TABLE_PROCESSING, TABLE_FINISHED)
+  except:
+    PrintDebug ("Exception parsing log file %s" %(path))
+
+  STATS['lines'] += nblines
+  PrintDebug ("%d matching lines parsed, %d jobs found" % (nblines, len(TABLE_FINISHED)))
+
+  return TABLE_FINISHED
+
+
+################################################################################
+#                                                                              #
+#                  PARALLEL PARSING (CHUNKS OF A LARGE LOG)                    #
+#                                                                              # 
+################################################################################    
+
+# With -j, the log files are split into ranges of whole lines, parsed by worker
+# processes. For each task, only one job can be running at a time (see ParseLine) : in
+# a chunk, only the first end line of a task not started in that chunk depends on the
+# previous chunks. Workers return the jobs finished in their chunk, these end lines
+# (in order), and the jobs still running at the end of the chunk. The results are then
+# merged in the order of the chunks, giving the same table as ParseLogFile.
+
+PARALLEL_MIN_CHUNK = 16 * 1024 * 1024     # Files are not split in smaller chunks
+
+
+#============================================================================================
+# Split a file into ranges of whole lines : [(start, end), ...], None is the end of file
+#============================================================================================
+
+def SplitLogFile (path, count):
+
+  size = os.path.getsize(path)
+  bounds = [0]
+  f = open(path, 'rb')
+  try:
+    for i in range(1, count):
+      f.seek(max(size * i // count, bounds[-1]))
+      f.readline()                     # Go to the beginning of the next line
+      position = f.tell()
+      if position >= size:
+        break
+      if position > bounds[-1]:
+        bounds.append(position)
+  finally:
+    f.close()
+  return list(zip(bounds, bounds[1:] + [None]))
+
+
+#============================================================================================
+# Read the lines of a range of a file
+#============================================================================================
+
+def ReadChunkLines (path, start, end):
+
+  if IsCompressed(path):
+    for line in ReadLogLines ([path]):
+      yield line
+    return
+
+  f = open(path, 'rb')
+  try:
+    f.seek(start)
+    position = start
+    for line in f:
+      if end is not None and position >= end:
+        break
+      position += len(line)
+      yield LogText(line)
+  finally:
+    f.close()
+
+
+#============================================================================================
+# Parse one chunk (run in a worker process)
+#============================================================================================
+
+# Returns (entries, running, lines, bytes, bad timestamps) : entries are the finished jobs (Job) and
+# the end lines of jobs started before the chunk (record), in the order of the log ;
+# running is, for each task started in the chunk, its job still running at the end
+# (None if finished).
+
+def ParseChunk (args):
+
+  path, start, end, dsm = args
+  classify = GetLineClassifier(dsm)
+  entries = []
+  running = {}
+  closed = {}           # Tasks whose end line before any start line is already in entries
+  nblines = nbbytes = 0
+  badtimestamps = STATS['bad_timestamps']
+
+  for line in ReadChunkLines (path, start, end):
+    nblines += 1
+    nbbytes += len(line)
+    record = classify (line)
+    if record is None:
+      continue
+    kind, name = record[0], record[1]
+
+    if kind == LINE_START:
+      running[name] = NewJob (name, record[2])
+    elif running.get(name) is not None:
+      job = running[name]
+      EndJob (job, record)
+      entries.append(job)
+      running[name] = None
+    elif name not in running and name not in closed:
+      closed[name] = True
+      entries.append(record)
+
+  # Counted by the caller, also when the chunk is parsed in this process
+  badtimestamps, STATS['bad_timestamps'] = STATS['bad_timestamps'] - badtimestamps, badtimestamps
+  return entries, running, nblines, nbbytes, badtimestamps
+
+
+#============================================================================================
+#  Parse log file in worker processes
+#============================================================================================
+
+# Same result as ParseLogFile. 'workers' is the number of processes (0 : one per core),
+# 'chunks' the number of chunks of each plain file (default : one per worker, but
+# chunks are not smaller than PARALLEL_MIN_CHUNK). Compressed files are one chunk.
+
+def ParseLogFileParallel (path, dsm, workers, chunks=0):
+  import multiprocessing
+
+  TABLE_FINISHED = []    # Table of finished tasks
+  RUNNING = {}           # Job running at the end of the previous chunks, by task name
+
+  if workers <= 0:
+    workers = multiprocessing.cpu_count()
+
+  try:
+    specs = []
+    for filename in GetLogFileSet(path):
+      if IsCompressed(filename):
+        specs.append((filename, 0, None, dsm))
+      else:
+        count = chunks or max(1, min(workers, os.path.getsize(filename) // PARALLEL_MIN_CHUNK))
+        specs.extend([(filename, start, end, dsm) for start, end in SplitLogFile(filename, count)])
+
+    PrintDebug ("Parsing file %s (and rotated files) with DSM version %d, %d chunks in %d processes" % (path, dsm, len(specs), workers))
+
+    if workers == 1 or len(specs) == 1:
+      results = [ParseChunk(spec) for spec in specs]
+    else:
+      pool = multiprocessing.Pool(min(workers, len(specs)))
+      try:
+        results = pool.map(ParseChunk, specs, chunksize=1)
+      finally:
+        pool.close()
+        pool.join()
+
+    # Merge the chunks, in the order of the log
+
+    for entries, running, nblines, nbbytes, badtimestamps in results:
+      STATS['lines'] += nblines
+      STATS['bytes'] += nbbytes
+      STATS['bad_timestamps'] += badtimestamps
+      for entry in entries:
+        if isinstance(entry, Job):
+          TABLE_FINISHED.append(entry)
+        elif entry[1] in RUNNING:
+          job = RUNNING.pop(entry[1])
+          EndJob (job, entry)
+          TABLE_FINISHED.append(job)
+      for name in running:
+        if running[name] is None:
+          RUNNING.pop(name, None)
+        else:
+          RUNNING[name] = running[name]
+  except:
+    PrintDebug ("Exception parsing log file %s" %(path))
+
+  return TABLE_FINISHED
+
+
+################################################################################
+#                                                                              #
+#                   INCREMENTAL PARSING (PERSISTENT STATE FILE)                #
+#                                                                              # 
+################################################################################    
+
+# When a state directory is given (-s), the position reached in the log file is saved
+# between runs, with the tasks still being processed, the latest jobs of each task and
+# its failure counters (see FailureCounters). The next run only parses the lines appended since then. A full rescan is done when
+# the log file has been rotated (new inode) or truncated (smaller size, or content
+# before the saved offset has changed).
+
+STATE_FILENAME = "check_syno_backup.state"
+STATE_VERSION = 3
+STATE_SIGNATURE_SIZE = 64      # Number of bytes before the offset kept to detect rewrites
+
+
+#============================================================================================
+# Return the full path of a file stored in the state directory
+#============================================================================================
+
+def StatePath (filename):
+  return os.path.join(STATE_DIR, filename)
+
+
+#============================================================================================
+# Convert a job to / from a serializable dictionary
+#============================================================================================
+
+def StateString (s):
+  # json returns unicode strings, log lines are processed as byte strings.
+  # Strings are saved as latin-1, so that any byte sequence is restored unchanged.
+  if not PY3 and isinstance(s, unicode):
+    s = s.encode('latin-1')
+  return s
+
+def JobToState (job):
+  return { 'name': job.name, 'start': job.start, 'end': job.end, 'status': job.status, 'problem': job.problem }
+
+def JobFromState (dct):
+  problem = dct['problem']
+  if problem is not None:
+    problem = StateString(problem)
+  return Job (Intern(StateString(dct['name'])), dct['start'], dct['end'], StateString(dct['status']), problem)
+
+
+#============================================================================================
+# Keep only the latest job, and the latest good job, of each task
+#============================================================================================
+
+def KeepLatestJobs (table):
+
+  latest = {}
+  latestgood = {}
+  for job in table:
+    name = job.name
+    if name not in latest or job.start >= latest[name].start:
+      latest[name] = job
+    if job.status == 'OK':
+      if name not in latestgood or job.start >= latestgood[name].start:
+        latestgood[name] = job
+
+  kept = []
+  for job in table:
+    if latest.get(job.name) is job or latestgood.get(job.name) is job:
+      kept.append(job)
+  return kept
+
+
+#============================================================================================
+# Serialize to JSON (strings are saved as latin-1, see StateString)
+#============================================================================================
+
+def JsonDumps (obj):
+  import json
+  if PY3:
+    return json.dumps(obj)
+  return json.dumps(obj, encoding='latin-1')
+
+
+#============================================================================================
+# Load / save the state file
+#============================================================================================
+
+def LoadState (statepath):
+  import json
+  try:
+    f = open(statepath, 'r')
+    try:
+      state = json.load(f)
+    finally:
+      f.close()
+    if state.get('version') != STATE_VERSION:
+      PrintDebug ("State file %s has an unsupported version. Ignored" % (statepath))
+      return None
+    return state
+  except IOError:
+    PrintDebug ("No state file %s" % (statepath))
+  except:
+    PrintDebug ("Exception reading state file %s. Ignored" % (statepath))
+  return None
+
+
+def SaveState (statepath, state):
+  tmppath = "%s.%d.tmp" % (statepath, os.getpid())
+  try:
+    f = open(tmppath, 'w')
+    try:
+      f.write(JsonDumps(state))
+    finally:
+      f.close()
+    os.rename(tmppath, statepath)     # Atomic replacement, concurrent readers never see a partial file
+    PrintDebug ("State saved to %s" % (statepath))
+  except:
+    PrintDebug ("Exception writing state file %s" % (statepath))
+    try:
+      os.remove(tmppath)
+    except:
+      pass
+
+
+#============================================================================================
+# Read the bytes just before an offset (used to check that the file was not rewritten)
+#============================================================================================
+
+def ReadSignature (f, offset):
+  import binascii
+  start = max(0, offset - STATE_SIGNATURE_SIZE)
+  f.seek(start)
+  return binascii.hexlify(f.read(offset - start)).decode('ascii')
+
+
+#============================================================================================
+# Find the file and the position where parsing can resume
+#============================================================================================
+
+# Returns (index in the file set, offset), or None if a full scan is needed. After a
+# rotation, the file parsed by the previous run is found by its inode among the rotated
+# (uncompressed) files.
+
+def FindResumePosition (files, state):
+
+  for index in range(len(files)-1, -1, -1):
+    path = files[index]
+    if IsCompressed(path):
+      continue
+    try:
+      st = os.stat(path)
+      if st.st_ino != state['inode']:
+        continue
+      if state['offset'] > st.st_size:
+        PrintDebug ("Log file %s has been truncated, full scan" % (path))
+        return None
+      f = open(path, 'rb')
+      try:
+        signature = ReadSignature(f, state['offset'])
+      finally:
+        f.close()
+      if signature != StateString(state['signature']):
+        PrintDebug ("Log file %s has been rewritten, full scan" % (path))
+        return None
+      if index < len(files)-1:
+        PrintDebug ("Log file has been rotated to %s" % (path))
+      return index, state['offset']
+    except:
+      PrintDebug ("Exception checking log file %s" % (path))
+      
+  PrintDebug ("Log file parsed by previous run not found (rotated and compressed ?), full scan")
+  return None
+
+
+#============================================================================================
+#  Parse log file, resuming from the position saved by the previous run
+#============================================================================================
+
+# Same result as ParseLogFile, except that jobs older than the latest job and the
+# latest good job of each task are not returned (they are not kept in the state file).
+
+def ParseLogFileIncremental (path, dsm, statepath):
+
+  TABLE_FINISHED = []    # Table of finished tasks
+  TABLE_PROCESSING = []  # Temporary table for processing tasks
+  counters = {}          # Failure counters of the tasks (see FailureCounters)
+  first, offset = 0, 0
+
+  PrintDebug ("Parsing file %s with DSM version %d, state file %s" % (path, dsm, statepath))
+
+  files = GetLogFileSet(path)
+  if path not in files:
+    PrintDebug ("Log file %s not found" %(path))
+    return TABLE_FINISHED
+
+  try:
+    state = LoadState(statepath)
+
+    # Can we resume from the previous position ?
+
+    if state is None:
+      PrintDebug ("No usable state, full scan of %s" % (path))
+    elif StateString(state['path']) != path or state['dsm'] != dsm:
+      PrintDebug ("State file refers to another log file, full scan of %s" % (path))
+    else:
+      resume = FindResumePosition(files, state)
+      if resume is not None:
+        first, offset = resume
+        TABLE_PROCESSING = [JobFromState(j) for j in state['processing']]
+        TABLE_FINISHED = [JobFromState(j) for j in state['finished']]
+        counters = CountersFromState(state['counters'])
+        PrintDebug ("Resuming %s at offset %d" % (files[first], offset))
+    counted = len(TABLE_FINISHED)      # Jobs of the state, already counted
+
+    # Parse the rotated files (if any) up to their end
+
+    if first < len(files)-1:
+      for line in ReadRotatedLines (files[first:-1], offset):
+        STATS['lines'] += 1
+        STATS['bytes'] += len(line)
+        ParseLine (line, dsm, TABLE_PROCESSING, TABLE_FINISHED)
+      offset = 0
+
+    # Parse the new lines of the live file. A trailing incomplete line is left for the next run.
+
+    f = open(path, 'rb')
+    try:
+      st = os.fstat(f.fileno())
+      f.seek(offset)
+      while True:
+        line = LogText(f.readline())
+        if not line.endswith('\n'):
+          break
+        offset += len(line)
+        STATS['lines'] += 1
+        STATS['bytes'] += len(line)
+        ParseLine (line, dsm, TABLE_PROCESSING, TABLE_FINISHED)
+      signature = ReadSignature(f, offset)
+    finally:
+      f.close()
+
+    PrintDebug ('--------------------------------------------------------------')
+    if HistoryEnabled():
+      RecordHistory (TABLE_FINISHED)      # Older jobs are dropped below
+    if IndexEnabled():
+      IndexJobs (TABLE_FINISHED)
+    CountJobs (counters, TABLE_FINISHED[counted:])
+    TASK_COUNTERS.update(counters)
+    TABLE_FINISHED = KeepLatestJobs(TABLE_FINISHED)
+
+    state = { 'version': STATE_VERSION,
+              'path': path,
+              'dsm': dsm,
+              'inode': st.st_ino,
+              'size': st.st_size,
+              'offset': offset,
+              'signature': signature,
+              'processing': [JobToState(j) for j in TABLE_PROCESSING],
+              'finished': [JobToState(j) for j in TABLE_FINISHED],
+              'counters': CountersToState(counters) }
+    SaveState(statepath, state)
+
+  except:
+    PrintDebug ("Exception parsing log file %s" %(path))
+
+  return TABLE_FINISHED
+
+
+#============================================================================================
+# Read the lines of rotated files, the first one from an offset
+#============================================================================================
+
+def ReadRotatedLines (files, offset):
+
+  for path in files:
+    if offset > 0:
+      PrintDebug ("Reading log file %s from offset %d" % (path, offset))
+      f = open(path, 'rb')
+      try:
+        f.seek(offset)
+        for line in f:
+          yield LogText(line)
+      finally:
+        f.close()
+      offset = 0
+    else:
+      for line in ReadLogLines ([path]):
+        yield line
+
+
+################################################################################
+#                                                                              #
+#                     RESULT CACHE (REPEATED CHECKS)                           #
+#                                                                              # 
+################################################################################    
+
+# Retries, rechecks and service dependencies often run the same check several times in
+# a few minutes. With --cache-ttl and a state directory (-s), the latest job and the
+# latest good job of each checked task are cached. A cached task is reused while it is
+# younger than the TTL, and while the log file is unchanged (same inode, size and mtime).
+# Jobs are cached, not results : thresholds are applied again, and the age of the last
+# good job is computed at the time of the check.
+
+CACHE_FILENAME = "check_syno_backup.cache"
+CACHE_TTL = 0                  # Time to live of cached jobs, in seconds (0 : no cache)
+
+
+#============================================================================================
+# Load the cache, or return an empty one if the log file has changed
+#============================================================================================
+
+def LoadResultCache (cachepath, path):
+
+  signature = FileSignature(path)
+  cache = LoadState(cachepath)
+  if cache is not None and (StateString(cache['path']) != path or cache['signature'] != signature):
+    PrintDebug ("Log file %s has changed, cached results are discarded" % (path))
+    cache = None
+
+  if cache is None:
+    return { 'version': STATE_VERSION, 'path': path, 'signature': signature, 'tasks': {}, 'all': None }
+
+  tasks = {}
+  for name in cache['tasks']:
+    tasks[StateString(name)] = cache['tasks'][name]
+  cache['tasks'] = tasks
+  return cache
+
+
+#============================================================================================
+# Return the cached jobs of the tasks to check, or None if one of them is missing / expired
+#============================================================================================
+
+def CacheEntryValid (entry, now):
+  return entry is not None and 0 <= now - entry['time'] < CACHE_TTL
+
+def GetCachedJobs (cache, tasknames, alltasks):
+
+  now = time.time()
+  if alltasks:
+    if not CacheEntryValid(cache['all'], now):
+      return None
+    tasknames = [StateString(name) for name in cache['all']['names']]
+
+  table = []
+  for name in tasknames:
+    entry = cache['tasks'].get(name)
+    if not CacheEntryValid(entry, now):
+      PrintDebug ("No valid cached result for task [%s]" % (name))
+      return None
+    table.extend([JobFromState(j) for j in entry['jobs']])
+
+  PrintDebug ("Using cached jobs (log file unchanged)")
+  return table
+
+
+#============================================================================================
+# Store the jobs of the checked tasks in the cache
+#============================================================================================
+
+def SaveResultCache (cachepath, cache, table, tasknames, alltasks):
+
+  now = time.time()
+  if alltasks:
+    tasknames = GetTaskNames(table)
+    cache['all'] = { 'time': now, 'names': tasknames }
+
+  jobs = {}
+  for job in KeepLatestJobs(table):
+    jobs.setdefault(job.name, []).append(JobToState(job))
+  for name in tasknames:
+    cache['tasks'][name] = { 'time': now, 'jobs': jobs.get(name, []) }
+
+  SaveState(cachepath, cache)
+
+
+################################################################################
+#                                                                              #
+#                 SINGLE-FLIGHT (CONCURRENT CHECKS OF A BURST)                 #
+#                                                                              # 
+################################################################################    
+
+# Nagios often schedules all the services of a NAS in the same second. With
+# --single-flight, the first check takes a lock on the log file and parses it for all
+# tasks ; it saves a summary of the jobs (see ReduceJobs) in the state directory (-s),
+# or in /tmp. The other checks wait for the lock, then reuse the summary : the log is
+# parsed once per burst, whatever the number of services.
+#
+# A summary is reused if its parse started less than SINGLE_FLIGHT_AGE seconds ago. If the
+# check holding the lock dies, the lock is released : the next check finds no recent
+# summary, and parses the log itself. A check does not wait more than SINGLE_FLIGHT_WAIT
+# seconds for the lock.
+
+SINGLE_FLIGHT_AGE = 30         # Maximum age of a reused summary, in seconds
+SINGLE_FLIGHT_WAIT = 30        # Maximum wait for the lock, in seconds (NRPE timeout is usually 60 s)
+SINGLE_FLIGHT_POLL = 0.1       # Interval between two attempts to take the lock
+SUMMARY_FILENAME = "check_syno_backup.summary"
+
+
+#============================================================================================
+# Summary file : in the state directory, or in /tmp (one per user)
+#============================================================================================
+
+def SummaryPath ():
+  if STATE_DIR:
+    return StatePath(SUMMARY_FILENAME)
+  return "/tmp/check_syno_backup.%d.summary" % (os.getuid())
+
+
+#============================================================================================
+# Load the jobs of a recent summary of the log, or return None
+#============================================================================================
+
+# 'since' : the summary must have all the jobs ended since then. Summaries written by
+# another user are ignored (/tmp is shared), and so are summaries of a log file which
+# has been rotated or truncated since it was parsed. Lines appended since then are
+# accepted : the NAS writes to the log while the checks pile up, and the summary is
+# younger than SINGLE_FLIGHT_AGE.
+
+def LoadSummary (summarypath, path, dsm, since, now):
+
+  try:
+    if os.stat(summarypath).st_uid != os.getuid():
+      PrintDebug ("Summary %s belongs to another user. Ignored" % (summarypath))
+      return None
+  except OSError:
+    return None
+
+  summary = LoadState(summarypath)
+  if summary is None:
+    return None
+  if StateString(summary['path']) != path or summary['dsm'] != dsm or summary['since'] > since:
+    PrintDebug ("Summary %s does not match this check. Ignored" % (summarypath))
+    return None
+  if not 0 <= now - summary['time'] < SINGLE_FLIGHT_AGE:
+    PrintDebug ("Summary %s is too old" % (summarypath))
+    return None
+  signature = summary.get('signature')
+  current = FileSignature(path)
+  if signature is None or current is None or signature[0] != current[0] or signature[2] > current[2]:
+    PrintDebug ("Log file %s has been rotated or truncated since summary %s was saved. Ignored" % (path, summarypath))
+    return None
+  STATS['bad_timestamps'] = summary['bad_timestamps']     # Found by the check which parsed the log
+  return [JobFromState(j) for j in summary['jobs']]
+
+
+# 'signature' : of the log file before it was parsed
+
+def SaveSummary (summarypath, path, dsm, since, started, signature, table):
+  SaveState (summarypath, { 'version': STATE_VERSION, 'path': path, 'dsm': dsm, 'since': since,
+                            'time': started, 'signature': signature, 'bad_timestamps': STATS['bad_timestamps'],
+                            'jobs': [JobToState(j) for j in table] })
+
+
+#============================================================================================
+# Jobs of the given tasks (all tasks if empty)
+#============================================================================================
+
+def SelectJobs (table, tasknames):
+  if tasknames == []:
+    return table
+  wanted = dict([(name, True) for name in tasknames])
+  return [job for job in table if job.name in wanted]
+
+
+#============================================================================================
+# Return the jobs of the tasks, parsed by this check or by a concurrent one
+#============================================================================================
+
+# 'parse' parses the log for all tasks, and returns a table.
+
+def SingleFlight (path, dsm, since, tasknames, parse):
+  import fcntl
+
+  summarypath = SummaryPath()
+  start = time.time()
+  table = LoadSummary (summarypath, path, dsm, since, start)
+  if table is not None:
+    PrintDebug ("Using the jobs parsed by a concurrent check (%s)" % (summarypath))
+    return SelectJobs (table, tasknames)
+
+  try:
+    lock = open(path, 'rb')
+  except IOError:
+    return SelectJobs (parse(), tasknames)
+
+  try:
+    while True:
+      try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        break
+      except (IOError, OSError):
+        if time.time() - start > SINGLE_FLIGHT_WAIT:
+          PrintDebug ("Log file %s still locked by another check after %d s, parsing it" % (path, SINGLE_FLIGHT_WAIT))
+          return SelectJobs (parse(), tasknames)
+        time.sleep(SINGLE_FLIGHT_POLL)
+
+    # Lock taken : the check which held it may have saved a summary
+
+    table = LoadSummary (summarypath, path, dsm, since, time.time())
+    if table is not None:
+      PrintDebug ("Using the jobs parsed by a concurrent check, after %.1f s" % (time.time() - start))
+    else:
+      started = time.time()
+      signature = FileSignature(path)
+      table = ReducedTable (ReduceJobs (parse(), [], since))
+      SaveSummary (summarypath, path, dsm, since, started, signature, table)
+    return SelectJobs (table, tasknames)
+  finally:
+    lock.close()                  # Releases the lock
+
+
+################################################################################
+#                                                                              #
+#                  FAILURE COUNTERS (DAILY BUCKETS PER TASK)                   #
+#                                                                              # 
+################################################################################    
+
+# The last good job of a task hides its failures : a task failing 9 nights out of 10
+# is OK. With -f / -F, the ratio of failed jobs over the last FAILURE_WINDOW days is
+# checked, and with --w_consecutive / --c_consecutive, the number of consecutive failed
+# jobs (up to the latest one, within the window).
+#
+# The good and failed jobs of each task are counted per day (end time of the job), in a
+# ring of FAILURE_RING_DAYS buckets. Each bucket holds the numbers of jobs counted up to
+# the end of its day : the jobs of a window are the difference between two buckets,
+# whatever the number of jobs and days counted. Days without jobs are filled when a
+# later job is counted.
+#
+# With -s and with the daemon, the counters are filled by the parsing, and kept between
+# runs (the state and the daemon only keep the latest jobs of each task). Otherwise,
+# they are filled from the jobs of the window, which are then kept by the parsing.
+
+FAILURE_WARNING = 0            # Warning if more than this % of the jobs of the window failed (0 : no check)
+FAILURE_CRITICAL = 0           # Critical if more than this % of the jobs of the window failed (0 : no check)
+CONSECUTIVE_WARNING = 0        # Warning if at least this number of consecutive jobs failed (0 : no check)
+CONSECUTIVE_CRITICAL = 0       # Critical if at least this number of consecutive jobs failed (0 : no check)
+FAILURE_WINDOW = 7             # Window of the failure checks, in days (up to today)
+FAILURE_RING_DAYS = 64         # Number of daily buckets : the window is at most FAILURE_RING_DAYS-1 days
+
+TASK_COUNTERS = {}             # Task name -> FailureCounters, filled by the parsing (-s, daemon)
+
+
+#============================================================================================
+#  Good and failed jobs of a task, per day
+#============================================================================================
+
+class FailureCounters (object):
+
+  __slots__ = ('days', 'successes', 'failures', 'first', 'last', 'streak')
+
+  def __init__ (self):
+    self.days = [None] * FAILURE_RING_DAYS     # Day of each bucket (seconds // 86400)
+    self.successes = [0] * FAILURE_RING_DAYS   # Good jobs counted up to the end of the day
+    self.failures = [0] * FAILURE_RING_DAYS    # Failed jobs counted up to the end of the day
+    self.first = None                          # First day counted
+    self.last = None                           # Last day counted
+    self.streak = 0                            # Consecutive failed jobs, up to the latest one
+
+  # Count a job. A job ended before the last day counted (clock set back) is counted
+  # in the last day.
+
+  def add (self, day, failed):
+    if self.last is None:
+      self.first = day
+      self.fill (day, day, 0, 0)
+    elif day > self.last:
+      slot = self.last % FAILURE_RING_DAYS
+      self.fill (max(self.last + 1, day - FAILURE_RING_DAYS + 1), day, self.successes[slot], self.failures[slot])
+    slot = self.last % FAILURE_RING_DAYS
+    if failed:
+      self.failures[slot] += 1
+      self.streak += 1
+    else:
+      self.successes[slot] += 1
+      self.streak = 0
+
+  def fill (self, first, last, successes, failures):
+    for day in range(first, last + 1):
+      slot = day % FAILURE_RING_DAYS
+      self.days[slot] = day
+      self.successes[slot] = successes
+      self.failures[slot] = failures
+    self.last = last
+
+  # Good and failed jobs counted up to the end of a day (at most FAILURE_RING_DAYS-1
+  # days before the last day counted)
+
+  def total (self, day):
+    if self.last is None or day < self.first:
+      return 0, 0
+    slot = min(day, self.last) % FAILURE_RING_DAYS
+    return self.successes[slot], self.failures[slot]
+
+  # (jobs, failed jobs, consecutive failed jobs) of the last 'ndays' days, up to 'today'.
+  # Failed jobs of the streak are the latest failed jobs : those of the window are the
+  # failed jobs of the window, if there are fewer.
+
+  def window (self, today, ndays):
+    if self.last is not None:
+      today = max(today, self.last)          # Jobs ended in the future are counted today
+    ndays = min(ndays, FAILURE_RING_DAYS - 1)
+    ok1, failed1 = self.total(today)
+    ok0, failed0 = self.total(today - ndays)
+    failed = failed1 - failed0
+    return ok1 - ok0 + failed, failed, min(self.streak, failed)
+
+  # Saved as the buckets of the days counted (at most FAILURE_RING_DAYS), oldest first
+
+  def ToState (self):
+    if self.last is None:
+      return None
+    slots = [day % FAILURE_RING_DAYS for day in range(max(self.first, self.last - FAILURE_RING_DAYS + 1), self.last + 1)]
+    return { 'first': self.first, 'last': self.last, 'streak': self.streak,
+             'successes': [self.successes[slot] for slot in slots],
+             'failures': [self.failures[slot] for slot in slots] }
+
+  @staticmethod
+  def FromState (dct):
+    counters = FailureCounters()
+    if dct is not None:
+      counters.first = dct['first']
+      counters.streak = dct['streak']
+      counters.fill (dct['last'] + 1 - len(dct['successes']), dct['last'], 0, 0)
+      for day, successes, failures in zip(range(dct['last'] + 1 - len(dct['successes']), dct['last'] + 1),
+                                          dct['successes'], dct['failures']):
+        slot = day % FAILURE_RING_DAYS
+        counters.successes[slot] = successes
+        counters.failures[slot] = failures
+    return counters
+
+
+#============================================================================================
+#  Count finished jobs, in order, in the counters of their tasks
+#============================================================================================
+
+def CountJobs (counters, jobs):
+  for job in jobs:
+    taskcounters = counters.get(job.name)
+    if taskcounters is None:
+      taskcounters = counters[job.name] = FailureCounters()
+    taskcounters.add (job.end // 86400, job.status != 'OK')
+
+
+def CountersToState (counters, tasknames=None):
+  return dict([(name, counters[name].ToState()) for name in counters if tasknames is None or name in tasknames])
+
+def CountersFromState (dct):
+  return dict([(Intern(StateString(name)), FailureCounters.FromState(c)) for name, c in dct.items()])
+
+
+#============================================================================================
+#  Failure checks
+#============================================================================================
+
+def FailureChecksEnabled ():
+  return FAILURE_WARNING > 0 or FAILURE_CRITICAL > 0 or CONSECUTIVE_WARNING > 0 or CONSECUTIVE_CRITICAL > 0
+
+
+# Number of days of jobs needed by the checks (0 : no failure check)
+
+def FailureDays ():
+  if FailureChecksEnabled():
+    return FAILURE_WINDOW
+  return 0
+
+
+# (jobs, failed jobs, consecutive failed jobs) of a task in the window : from the
+# counters filled by the parsing if any, otherwise from the table
+
+def TaskFailures (table, taskname):
+  counters = TASK_COUNTERS.get(taskname)
+  if counters is None:
+    counters = {}
+    CountJobs (counters, [job for job in table if job.name == taskname])
+    counters = counters.get(taskname, FailureCounters())
+  return counters.window (NowSeconds() // 86400, FAILURE_WINDOW)
+
+
+# Threshold of the performance data (empty if no check)
+
+def PerfThreshold (value):
+  if value > 0:
+    return "%g" % (value)
+  return ""
+
+
+# Returns (code, message) of the failure checks, message starting with ", "
+
+def CheckFailures (runs, failed, consecutive):
+
+  ratio = 100.0 * failed / runs if runs > 0 else 0.0
+  text = "%d of %d jobs failed in the last %d days" % (failed, runs, FAILURE_WINDOW)
+  if FAILURE_CRITICAL > 0 and ratio > FAILURE_CRITICAL:
+    return 'CRITICAL', ", [CRIT] %s (%d%%)" % (text, ratio)
+  if CONSECUTIVE_CRITICAL > 0 and consecutive >= CONSECUTIVE_CRITICAL:
+    return 'CRITICAL', ", [CRIT] Last %d jobs failed" % (consecutive)
+  if FAILURE_WARNING > 0 and ratio > FAILURE_WARNING:
+    return 'WARNING', ", [WARN] %s (%d%%)" % (text, ratio)
+  if CONSECUTIVE_WARNING > 0 and consecutive >= CONSECUTIVE_WARNING:
+    return 'WARNING', ", [WARN] Last %d jobs failed" % (consecutive)
+  return 'OK', ", %s" % (text)
+
+
+#============================================================================================
+#  Load the counters saved by the incremental parsing (checks which did not parse the log)
+#============================================================================================
+
+def LoadCounters (statepath):
+  state = LoadState(statepath)
+  if state is not None and 'counters' in state:
+    TASK_COUNTERS.update(CountersFromState(state['counters']))
+
+
+################################################################################
+#                                                                              #
+#                   DURATION HISTORY (PER-TASK BASELINE)                       #
+#                                                                              # 
+################################################################################    
+
+# With --history (or -b / -B) and a state directory (-s), the end time, duration and
+# status of the jobs seen by the checks are appended to a history file per task, made of
+# fixed-width records. The usual duration of a task (p50 / p95 of its last good runs) is
+# computed from the last records of the file only : the cost of a check does not depend
+# on the length of the history. With -b / -B, the last good run is compared with a
+# multiple of its usual duration (p50).
+
+HISTORY = False                # Record the jobs in the history files
+BASELINE_WARNING = 0           # Warning if duration is more than this factor x p50 (0 : no check)
+BASELINE_CRITICAL = 0          # Critical if duration is more than this factor x p50 (0 : no check)
+HISTORY_WINDOW = 30            # Number of previous good runs used to compute p50 / p95
+HISTORY_MIN_RUNS = 5           # Minimum number of previous good runs to compare with the baseline
+BASELINE_MIN_SECONDS = 60      # Baselines shorter than this are rounded up (avoids alerts on short tasks)
+HISTORY_FORMAT = "<qIB"        # Record : end time (see DecodeTimestamp), duration (seconds), status (Nagios code)
+
+
+#============================================================================================
+# History file of a task (task names may contain any character : the file name is a hash)
+#============================================================================================
+
+def HistoryEnabled ():
+  return STATE_DIR != "" and (HISTORY or BASELINE_WARNING > 0 or BASELINE_CRITICAL > 0)
+
+def HistoryPath (taskname):
+  import hashlib
+  return StatePath("check_syno_backup.%s.history" % (hashlib.md5(LogBytes(taskname)).hexdigest()))
+
+
+#============================================================================================
+# Append the jobs of a task more recent than the last record of its history
+#============================================================================================
+
+# Concurrent checks of a task append in turn : the file is locked from the read of its
+# last record to the end of the write, so that a job is never recorded twice.
+
+def AppendHistory (taskname, table):
+  import struct, fcntl
+
+  record = struct.Struct(HISTORY_FORMAT)
+  jobs = []
+  for job in table:
+    if job.name == taskname:
+      seconds = job.duration
+      if 0 <= seconds <= 0xFFFFFFFF:        # Not recorded : jobs with an unreadable date
+        jobs.append((job.end, seconds, NAGIOS_CODES[job.status]))
+  jobs.sort()
+
+  f = os.fdopen(os.open(HistoryPath(taskname), os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+  try:
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)     # Released by close
+    size = os.fstat(f.fileno()).st_size
+    size -= size % record.size           # Incomplete last record (interrupted write) is dropped
+    last = 0
+    if size > 0:
+      f.seek(size - record.size)
+      last = record.unpack(f.read(record.size))[0]
+
+    data = [record.pack(*job) for job in jobs if job[0] > last]
+    if data:
+      f.seek(size)
+      f.truncate()
+      f.write(b"".join(data))
+  finally:
+    f.close()
+  return len(data)
+
+
+# Jobs of all tasks : done by the incremental parsing, which only keeps the latest jobs
+
+def RecordHistory (table):
+  for name in GetTaskNames(table):
+    try:
+      AppendHistory(name, table)
+    except:
+      PrintDebug ("Exception updating history of task [%s]" % (name))
+
+
+#============================================================================================
+# Read the last records of the history of a task (oldest first)
+#============================================================================================
+
+def ReadHistory (taskname, count):
+  import struct
+
+  record = struct.Struct(HISTORY_FORMAT)
+  try:
+    f = open(HistoryPath(taskname), 'rb')
+  except IOError:
+    return []
+  try:
+    size = os.fstat(f.fileno()).st_size
+    size -= size % record.size
+    start = max(0, size - count * record.size)
+    f.seek(start)
+    data = f.read(size - start)
+  finally:
+    f.close()
+  return [record.unpack_from(data, offset) for offset in range(0, len(data), record.size)]
+
+
+#============================================================================================
+# Usual duration of a task before a given job : p50 / p95 of the previous good runs
+#============================================================================================
+
+# Returns a dictionary ('runs', 'p50', 'p95', durations in seconds), or None if there
+# is no previous good run in the history.
+
+def Percentile (values, q):
+  return values[min(len(values) - 1, int(q * len(values)))]
+
+def TaskBaseline (taskname, task):
+
+  end = task.end
+  records = ReadHistory(taskname, HISTORY_WINDOW * 2)
+  durations = sorted([r[1] for r in records if r[0] < end and r[2] == NAGIOS_CODES['OK']][-HISTORY_WINDOW:])
+  if not durations:
+    return None
+  return { 'runs': len(durations), 'p50': Percentile(durations, 0.5), 'p95': Percentile(durations, 0.95) }
+
+
+#============================================================================================
+# Record the jobs of a task, and return its baseline before the given job (or None)
+#============================================================================================
+
+def UpdateHistory (taskname, table, task):
+
+  try:
+    added = AppendHistory(taskname, table)
+    if task is None:
+      return None
+    baseline = TaskBaseline(taskname, task)
+    if baseline is not None:
+      PrintDebug ("History of task [%s] : %d jobs added, p50 %d s, p95 %d s over %d good runs" % (taskname, added, baseline['p50'], baseline['p95'], baseline['runs']))
+    return baseline
+  except:
+    PrintDebug ("Exception updating history of task [%s]" % (taskname))
+    return None
+
+
+#============================================================================================
+# Find the most recent task with given name whose status is OK 
+#============================================================================================
+
+def FindLatestTask (table, taskname):
+    
+  exists = False     # Flag if we found some task with the specified name
+  found = None       # contains last good task found (None if none)
+  
+  PrintDebug ("Searching for latest occurrence of task %s " % (taskname))
+  try:      
+    for job in table:
+      if job.name == taskname :
+        exists = True
+        if job.status == 'OK':
+          if found is None or job.start > found.start:
+            found = job
+  except:
+    found = None
+    PrintDebug ("Exception - Unable to locate latest Backup task")            
+              
+  return exists, found            
+
+
+#============================================================================================
+# Return the list of task names found, in order of first appearance
+#============================================================================================
+
+def GetTaskNames (table):
+
+  listnames = []
+  seen = {}
+  for job in table:
+    if job.name not in seen:
+      seen[job.name] = True
+      listnames.append(job.name)
+  return listnames
+
+
+#============================================================================================
+# Debug : Print list of task names found  
+#============================================================================================
+              
+def PrintTaskNames (table):
+
+  PrintDebug ('List of Backup tasks found in log :')
+  try:
+    for name in GetTaskNames(table):
+      PrintDebug( "   " + name)
+  except:
+    PrintDebug ("Exception printing list of tasks")
+
+
+
+#============================================================================================
+# Debug : Print all tasks found within the last nbday days
+#============================================================================================
+
+def PrintTasksSince (table, taskname, nbday):
+    
+  PrintDebug ("List of Backup tasks since %d days :" % (nbday))
+  
+  try:
+    since = NowSeconds() - nbday * 86400
+    for job in table:
+      if job.name == taskname:
+        if job.start > since:
+          PrintDebug ("  Task: %s, started: %s, status: %s, execution time: %s" % (job.name, DisplayDateTime(job.start), job.status, str(timedelta(seconds=job.duration))))
+  except:
+    PrintDebug("Exception during  display of last tasks")
+
+
+#============================================================================================
+# Debug : Print details of a task
+#============================================================================================
+
+def PrintTaskDetails (task):
+
+  PrintDebug ("========== Details of task ==========")
+  PrintDebug ("  Task name  : %s" % task.name)
+  PrintDebug ("  Start time : %s" % DisplayDateTime(task.start))
+  PrintDebug ("  End time   : %s" % DisplayDateTime(task.end))
+  PrintDebug ("  Duration   : %s" % timedelta(seconds=task.duration))
+  PrintDebug ("  Status     : %s" % task.status)
+  PrintDebug ("  Details    : %s" % task.problem)
+  PrintDebug ("====")
+          
+ 
+#============================================================================================
+# Test task, and compare with threshold values
+#============================================================================================
+
+def CheckThreshold(task, perflabel='execution_time', baseline=None, failures=None):
+
+  message = ""
+  code = 'UNKNOWN'              # Overall Nagios return code
+  code_age = 'UNKNOWN'          # Partial return code about the age of the last good task
+  code_duration = 'UNKNOWN'     # Partial return code about the duration of the last good task
+  code_baseline = 'OK'          # Partial return code about the duration, compared with the history of the task
+  code_failures = 'OK'          # Partial return code about the failed jobs of the window
+
+
+  # Is the last good task recent enough ?
+  
+  taskdate = DisplayDateTime (task.end)
+  age_days = (NowSeconds() - task.end) / 86400.0       # Age of the latest task, in days
+  PrintDebug (" The last task is %d days old "% (age_days))
+  
+  if age_days > MAX_CRITICAL_DAYS:
+    code_age = 'CRITICAL'
+    message = "[CRIT] Last good result (%s) is more than %d days old" % (taskdate, MAX_CRITICAL_DAYS)
+  
+  elif age_days > MAX_WARNING_DAYS:
+    code_age = 'WARNING'
+    message = "[WARN] Last good result (%s) is more than %d days old" % (taskdate, MAX_WARNING_DAYS)
+  
+  elif age_days < 0 :
+    code_age = 'UNKNOWN'
+    message = message + "Task date error, older than now"
+  
+  else :
+    code_age = 'OK'
+    message = "Last good result (%s) is within the last %d days" % (taskdate, MAX_WARNING_DAYS) 
+  
+
+  # Is the duration of the last good task within the accepted bounds ?
+
+  duration = task.duration / 60.0      # Duration in minutes
+  
+  if duration > MAX_CRITICAL_MINUTES:
+    code_duration = 'CRITICAL'
+    message = message + ", [CRIT] Execution time (%d min) is more than %d minutes" % (duration, MAX_CRITICAL_MINUTES)
+
+  elif duration > MAX_WARNING_MINUTES:
+    code_duration = 'WARNING'
+    message = message + ", [WARN] Execution time (%d min) is more than %d minutes" % (duration, MAX_WARNING_MINUTES)
+  
+  elif duration <  0:
+    code_duration = 'UNKNOWN'
+    message = message + ", Error, execution time is negative"
+  
+  else:
+    code_duration = 'OK'
+    message = message + ", Execution time (%d min) is within bounds" % (duration)
+    
+
+  # Is the duration usual for this task (compared with its previous good runs) ?
+
+  if baseline is not None:
+    seconds = task.duration
+    reference = max(baseline['p50'], BASELINE_MIN_SECONDS)
+    if baseline['runs'] < HISTORY_MIN_RUNS:
+      pass
+    elif BASELINE_CRITICAL > 0 and seconds > BASELINE_CRITICAL * reference:
+      code_baseline = 'CRITICAL'
+      message = message + ", [CRIT] Execution time is more than %g x usual (%d min)" % (BASELINE_CRITICAL, baseline['p50'] / 60)
+    elif BASELINE_WARNING > 0 and seconds > BASELINE_WARNING * reference:
+      code_baseline = 'WARNING'
+      message = message + ", [WARN] Execution time is more than %g x usual (%d min)" % (BASELINE_WARNING, baseline['p50'] / 60)
+    message = message + ", usual execution time %d min (p50), %d min (p95)" % (baseline['p50'] / 60, baseline['p95'] / 60)
+
+  # Did too many of the recent jobs fail ?
+
+  if failures is not None:
+    code_failures, text = CheckFailures (*failures)
+    message = message + text
+      
+  # Final response code
+      
+  if code_age =='CRITICAL' or code_duration =='CRITICAL' or code_baseline == 'CRITICAL' or code_failures == 'CRITICAL':
+    code ='CRITICAL' 
+  
+  elif code_age == 'WARNING' or code_duration == 'WARNING' or code_baseline == 'WARNING' or code_failures == 'WARNING':
+    code ='WARNING'
+
+  elif code_age == 'UNKNOWN' or code_duration == 'UNKNOWN':
+    code ='UNKNOWN'
+
+  elif code_age == 'OK' and code_duration == 'OK':
+    code ='OK'
+      
+  else:
+    code ='UNKNOWN'
+    message = "Error in check logic. This should not happen. See source code."
+  
+  
+  # Add performance data to the output string (whatever the result, so that graphs have no gaps)
+  
+  perfdata = "|'%s'=%dm;%d;%d;%d;%d" % (perflabel, duration, MAX_WARNING_MINUTES, MAX_CRITICAL_MINUTES, 0, 0)
+  if baseline is not None:
+    perfdata = perfdata + " '%s_p50'=%dm;;;0; '%s_p95'=%dm;;;0;" % (perflabel, baseline['p50'] / 60, perflabel, baseline['p95'] / 60)
+  message = message + perfdata   
+       
+  return code, message
+  
+
+#============================================================================================
+# Check one task : find its last good occurrence, and compare with threshold values
+#============================================================================================
+
+def EvaluateTask(table, taskname, perfprefix=''):
+
+  exists, lasttask = ProfileCall ('find', FindLatestTask, table, taskname)
+  baseline = None
+  if exists and HistoryEnabled():
+    baseline = UpdateHistory (taskname, table, lasttask)
+  failures = None
+  if exists and FailureChecksEnabled():
+    failures = TaskFailures (table, taskname)
+  
+  if exists == False:
+    code = "UNKNOWN"
+    message = "Did not find any Backup task with name [%s]" %(taskname)
+    
+  elif lasttask is None:
+    code = "CRITICAL"
+    message = "Task [%s] found in the log, but all occurrences are FAILED" %(taskname)
+  
+  else:
+    if TRACE_LEVEL >= TRACE_SUMMARY:
+      PrintTasksSince(table, taskname, MAX_CRITICAL_DAYS )
+      PrintDebug ("")
+      PrintDebug ("Last occurrence of task :")
+      PrintTaskDetails (lasttask)
+      
+    # Check if task duration is within bounds    
+  
+    code, message = CheckThreshold (lasttask, perfprefix + 'execution_time', baseline, failures)
+
+  # Performance data : age of the last good result, runs and failures in the last days
+
+  perfdata = TaskPerfData (table, taskname, lasttask, perfprefix, failures)
+  return code, AddPerfData (message, perfdata)
+
+
+#============================================================================================
+# Performance data of a task : age of the last good result, runs and failures
+#============================================================================================
+
+# Runs and failures are counted over the last 'ndays' days, today included (end time of
+# the jobs), in the table if it holds all the jobs of these days. With -s, the daemon
+# or -r, it only holds the latest jobs of each task : they are then counted in the
+# failure counters kept by the parsing (see FailureCounters), or in the duration
+# history. Returns None if none of them has the jobs of these days.
+
+TABLE_COMPLETE = True          # The table holds all the jobs of the last days (see main)
+
+def CountRuns (table, taskname, ndays):
+
+  today = NowSeconds() // 86400
+  if TABLE_COMPLETE:
+    jobs = [job for job in table if job.name == taskname and job.end // 86400 > today - ndays]
+    return len(jobs), len([job for job in jobs if job.status != 'OK'])
+
+  counters = TASK_COUNTERS.get(taskname)
+  if counters is not None and ndays < FAILURE_RING_DAYS:
+    runs, failures, consecutive = counters.window (today, ndays)
+    return runs, failures
+
+  if HistoryEnabled():
+    since = (today - ndays + 1) * 86400
+    try:
+      count = 64
+      while True:
+        records = ReadHistory(taskname, count)
+        if len(records) < count or records[0][0] < since:
+          break
+        count = count * 4
+      records = [r for r in records if r[0] >= since]
+      return len(records), len([r for r in records if r[2] != NAGIOS_CODES['OK']])
+    except:
+      PrintDebug ("Exception reading history of task [%s]" % (taskname))
+
+  PrintDebug ("Runs and failures of task [%s] are unknown : only its latest jobs were kept" % (taskname))
+  return None
+
+
+# Performance data are left out when they are unknown (no gap is better than a wrong value)
+
+def TaskPerfData (table, taskname, lasttask, perfprefix, windowfailures=None):
+
+  now = NowSeconds()
+  perfdata = []
+  if lasttask is not None:
+    perfdata.append("'%slast_good_age'=%ds;%d;%d;0;" % (perfprefix, now - lasttask.end, MAX_WARNING_DAYS * 86400, MAX_CRITICAL_DAYS * 86400))
+  counts = CountRuns (table, taskname, MAX_CRITICAL_DAYS)
+  if counts is not None:
+    perfdata.append("'%sruns'=%d;;;0; '%sfailures'=%d;;;0;" % (perfprefix, counts[0], perfprefix, counts[1]))
+  if windowfailures is not None:
+    jobs, failed, consecutive = windowfailures
+    perfdata.append("'%sfailure_ratio'=%.1f%%;%s;%s;0;100 '%sconsecutive_failures'=%d;%s;%s;0;" % (
+                    perfprefix, 100.0 * failed / jobs if jobs > 0 else 0.0, PerfThreshold(FAILURE_WARNING), PerfThreshold(FAILURE_CRITICAL),
+                    perfprefix, consecutive, PerfThreshold(CONSECUTIVE_WARNING), PerfThreshold(CONSECUTIVE_CRITICAL)))
+  return " ".join(perfdata)
+
+
+#============================================================================================
+# Performance data of the check itself : lines and bytes parsed, time, peak memory,
+# task lines ignored (unreadable date)
+#============================================================================================
+
+# Peak memory is the largest resident size of this process and of its worker processes
+# (ru_maxrss is in KB on Linux).
+
+def PeakMemory ():
+  try:
+    import resource
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  except:
+    return 0
+
+def CheckPerfData (parsetime):
+  return "'lines'=%dc 'bytes'=%dB 'parse_time'=%.3fs 'peak_memory'=%dKB 'bad_timestamps'=%dc" % (
+         STATS['lines'], STATS['bytes'], parsetime, PeakMemory(), STATS['bad_timestamps'])
+
+
+################################################################################
+#                                                                              #
+#                        JOB INDEX (SQLITE DATABASE)                           #
+#                                                                              # 
+################################################################################    
+
+# With --index=<file>, the jobs found by each check are stored in a SQLite database,
+# indexed by task name and start time (and by end time, for the counts of runs). Jobs
+# already stored are ignored : with -s, only the jobs of the new lines are parsed and
+# stored. The jobs of the checked tasks are then read from the index : last good job,
+# last job, and all the jobs of the last days (-c, or --runs). The index keeps the jobs
+# of rotated logs, which are no longer in the log files.
+#
+# Task names and messages are stored as the bytes of the log (BLOB), so that Python 2
+# and Python 3 find the same names. Status is a Nagios code (0 : OK, 2 : failed).
+
+INDEX_PATH = ""                # SQLite database of the jobs (empty : no index)
+
+INDEX_SCHEMA = [
+  "CREATE TABLE IF NOT EXISTS jobs (name BLOB NOT NULL, start INTEGER NOT NULL, end INTEGER NOT NULL, "
+                                   "status INTEGER NOT NULL, problem BLOB, PRIMARY KEY (name, start))",
+  "CREATE INDEX IF NOT EXISTS jobs_end ON jobs (name, end)",
+]
+
+INDEX_COLUMNS = "name, start, end, status, problem"
+
+
+#============================================================================================
+# Open the index (created if needed)
+#============================================================================================
+
+def IndexEnabled ():
+  return INDEX_PATH != ""
+
+def OpenIndex ():
+  import sqlite3
+  conn = sqlite3.connect(INDEX_PATH, timeout=30)      # Waits for concurrent checks
+  for sql in INDEX_SCHEMA:
+    conn.execute(sql)
+  return conn
+
+
+#============================================================================================
+# Convert task names and messages to / from the index
+#============================================================================================
+
+def IndexBlob (text):
+  return LogBytes(text) if PY3 else buffer(text)
+
+def IndexText (value):
+  return LogText(bytes(value))
+
+def JobFromIndex (row):
+  name, start, end, status, problem = row
+  if status == NAGIOS_CODES['OK']:
+    return Job (Intern(IndexText(name)), start, end, 'OK', "Task finished successfully")
+  return Job (Intern(IndexText(name)), start, end, 'CRITICAL', IndexText(problem))
+
+
+#============================================================================================
+# Store the finished jobs of a table (jobs already stored are ignored)
+#============================================================================================
+
+def IndexJobs (table):
+
+  try:
+    conn = OpenIndex()
+    try:
+      before = conn.total_changes
+      conn.executemany("INSERT OR IGNORE INTO jobs (%s) VALUES (?, ?, ?, ?, ?)" % (INDEX_COLUMNS),
+                       [(IndexBlob(job.name), job.start, job.end, NAGIOS_CODES[job.status],
+                         None if job.status == 'OK' else IndexBlob(job.problem)) for job in table])
+      conn.commit()
+      PrintDebug ("Index %s : %d jobs added" % (INDEX_PATH, conn.total_changes - before))
+    finally:
+      conn.close()
+  except:
+    PrintDebug ("Exception updating index %s" % (INDEX_PATH))
+
+
+#============================================================================================
+# Read the jobs of the given tasks (all tasks if empty) from the index
+#============================================================================================
+
+# For each task : the last good job, the last job, and the jobs ended since 'since'.
+# Returns a table (ordered by start time), or None if the index can't be read.
+
+def IndexTable (tasknames, since):
+
+  select = "SELECT %s FROM jobs WHERE name = ?" % (INDEX_COLUMNS)
+  queries = [ select + " AND status = %d ORDER BY start DESC LIMIT 1" % (NAGIOS_CODES['OK']),
+              select + " ORDER BY start DESC LIMIT 1",
+              select + " AND end >= ?" ]
+  try:
+    conn = OpenIndex()
+    try:
+      if tasknames == []:
+        tasknames = [IndexText(row[0]) for row in conn.execute("SELECT DISTINCT name FROM jobs")]
+      rows = {}
+      for name in tasknames:
+        key = IndexBlob(name)
+        for query, args in zip(queries, [(key,), (key,), (key, since)]):
+          for row in conn.execute(query, args):
+            rows[(name, row[1])] = row
+    finally:
+      conn.close()
+  except:
+    PrintDebug ("Exception reading index %s" % (INDEX_PATH))
+    return None
+
+  table = [JobFromIndex(rows[key]) for key in sorted(rows, key=lambda key: key[1])]
+  PrintDebug ("Index %s : %d jobs of %d tasks read" % (INDEX_PATH, len(table), len(tasknames)))
+  return table
+
+
+#============================================================================================
+# Print every run of the given tasks over the last nbday days, then exit (--runs)
+#============================================================================================
+
+def PrintRuns (table, tasknames, nbday):
+
+  since = NowSeconds() - nbday * 86400
+  for job in sorted(table, key=lambda job: job.start):
+    if job.start > since and (tasknames == [] or job.name in tasknames):
+      WriteText (sys.stdout, "%s\t%s\t%s\t%s\t%s\n" % (job.name, DisplayDateTime(job.start), timedelta(seconds=job.duration), job.status, job.problem))
+  sys.exit(NAGIOS_CODES['OK'])
+
+
+################################################################################
+#                                                                              #
+#                        MULTIPLE TASKS OUTPUT                                 #
+#                                                                              # 
+################################################################################    
+
+# Order of severity used to compute the overall return code of several tasks
+
+NAGIOS_SEVERITY = ['OK', 'UNKNOWN', 'WARNING', 'CRITICAL']
+
+
+#============================================================================================
+# Print one line per task (Nagios multi-line output), and exits with the worst code
+#============================================================================================
+
+# First line is a summary. Performance data of all tasks (and of the check itself, if
+# given) is written after the last line.
+
+def nagios_return_multi(results, checkperfdata=""):
+
+  worst = 'OK'
+  count = {}
+  lines = []
+  perfdata = []
+  for taskname, code, message in results:
+    if NAGIOS_SEVERITY.index(code) > NAGIOS_SEVERITY.index(worst):
+      worst = code
+    count[code] = count.get(code, 0) + 1
+    text, sep, perf = message.partition('|')
+    lines.append("[%s] %s: %s" % (taskname, code, text))
+    if perf:
+      perfdata.append(perf)
+
+  summary = "%d tasks checked" % (len(results))
+  for code in reversed(NAGIOS_SEVERITY):
+    if code in count:
+      summary = summary + ", %d %s" % (count[code], code)
+
+  if checkperfdata:
+    perfdata.append(checkperfdata)
+  if perfdata:
+    lines[-1] = lines[-1] + "|" + " ".join(perfdata)
+
+  WriteText (sys.stdout, worst + ": " + summary + "\n")
+  for line in lines:
+    WriteText (sys.stdout, line + "\n")
+  sys.exit(NAGIOS_CODES[worst])
+
+
+#============================================================================================
+# Print one passive check result per task, in Nagios external command format
+#============================================================================================
+
+# Output can be appended to the Nagios command file (nagios.cmd), or sent with any
+# passive check transport. The service description is the task name, with an optional prefix.
+
+def PassiveResult(now, host, prefix, taskname, code, message):
+  return "[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s%s;%d;%s\n" % (now, host, prefix, taskname, NAGIOS_CODES[code], message)
+
+def PrintPassiveResults(results, host, prefix):
+
+  now = int(time.time())
+  for taskname, code, message in results:
+    WriteText (sys.stdout, PassiveResult(now, host, prefix, taskname, code, message))
+  sys.exit(NAGIOS_CODES['OK'])
+
+
+################################################################################
+#                                                                              #
+#                      PROMETHEUS TEXTFILE EXPORTER                            #
+#                                                                              # 
+################################################################################    
+
+# With --prometheus, the metrics of each task are written to a file read by the textfile
+# collector of node_exporter (--collector.textfile.directory, files named *.prom). A run
+# from cron serves every dashboard, instead of each one parsing the log.
+
+PROMETHEUS_METRICS = [
+  ('last_success_timestamp_seconds', "End time of the last good job of the task (Unix time)."),
+  ('last_duration_seconds', "Execution time of the last job of the task."),
+  ('last_status', "Status of the last job of the task (0 : OK, 2 : failed)."),
+  ('successes', "Number of good jobs of the task in the log."),
+  ('failures', "Number of failed jobs of the task in the log."),
+]
+
+
+#============================================================================================
+# Unix time of a time of the log (see DecodeTimestamp), which is in local time
+#============================================================================================
+
+def UnixTime (seconds):
+  return int(time.mktime(time.gmtime(seconds)[:8] + (-1,)))
+
+
+#============================================================================================
+# Metrics of each task
+#============================================================================================
+
+# Returns { task name : { metric : value } }, from the reducers of the tasks (see
+# ReduceJobs). The last good job is the one of FindLatestTask.
+
+def TaskMetrics (reducers):
+
+  metrics = {}
+  for reducer in reducers:
+    latest = reducer.latest[1]
+    m = metrics[reducer.name] = { 'successes': reducer.successes, 'failures': reducer.failures,
+                                  'last_duration_seconds': latest.duration,
+                                  'last_status': NAGIOS_CODES[latest.status] }
+    if reducer.latestgood is not None:
+      m['last_success_timestamp_seconds'] = UnixTime(reducer.latestgood[1].end)
+  return metrics
+
+
+#============================================================================================
+# Format the metrics of the given tasks (all tasks if empty) in Prometheus text format
+#============================================================================================
+
+def PrometheusLabel (value):
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def FormatPrometheus (metrics, tasknames):
+
+  lines = []
+  for metric, helptext in PROMETHEUS_METRICS:
+    lines.append("# HELP syno_backup_%s %s" % (metric, helptext))
+    lines.append("# TYPE syno_backup_%s gauge" % (metric))
+    for name in tasknames:
+      if metric in metrics.get(name, {}):
+        lines.append('syno_backup_%s{task="%s"} %d' % (metric, PrometheusLabel(name), metrics[name][metric]))
+
+  lines.append("# HELP syno_backup_export_timestamp_seconds Time of the export (Unix time).")
+  lines.append("# TYPE syno_backup_export_timestamp_seconds gauge")
+  lines.append("syno_backup_export_timestamp_seconds %d" % (time.time()))
+  return "\n".join(lines) + "\n"
+
+
+#============================================================================================
+# Write the metrics to the textfile, then exit
+#============================================================================================
+
+# The file is replaced atomically : node_exporter never reads a partial file (the
+# temporary file does not end with .prom, so it is not collected).
+
+def ExportPrometheus (promfile, reducers, tasknames):
+
+  metrics = TaskMetrics (reducers)
+  if tasknames == []:
+    tasknames = [reducer.name for reducer in reducers]
+  text = FormatPrometheus (metrics, tasknames)
+
+  tmppath = "%s.%d.tmp" % (promfile, os.getpid())
+  try:
+    f = open(tmppath, 'wb')
+    try:
+      f.write(LogBytes(text))
+    finally:
+      f.close()
+    os.rename(tmppath, promfile)
+  except (IOError, OSError) as err:
+    try:
+      os.remove(tmppath)
+    except OSError:
+      pass
+    nagios_return('UNKNOWN', "Unable to write Prometheus textfile %s : %s" % (promfile, err))
+
+  nagios_return('OK', "%d tasks exported to %s" % (len(tasknames), promfile))
+
+
+################################################################################
+#                                                                              #
+#                       TASK DISCOVERY (NAME INDEX)                            #
+#                                                                              # 
+################################################################################    
+
+# With --discover, the tasks found in the log are listed, with their backup type and
+# the time of their last line, to create the services of the monitoring system. No job
+# is built : the log is read by blocks of lines, the task lines of a block are found by
+# one regular expression, and a name index keeps, for each task, its type and the
+# timestamp of its last line (a string : "YYYY/MM/DD HH:MM:SS" strings are in
+# chronological order). Timestamps are only decoded for the output.
+#
+# With -s, the name index is saved, and the next run only reads the new lines (as the
+# incremental parsing). Tasks of rotated logs stay known.
+
+NAMES_FILENAME = "check_syno_backup.names"
+DISCOVERY_FORMATS = ['json', 'lld', 'nagios']
+DISCOVERY_BLOCK_SIZE = 1024 * 1024      # Bytes of lines read at once
+
+
+#============================================================================================
+# Return a function giving [(timestamp, backup type, task name)] of the task lines of a block
+#============================================================================================
+
+# Same layout and keywords as the line classifier (see MakeLineClassifier), for several
+# lines : the expressions do not cross line ends, and only the start, error and end lines
+# of the tasks are found. DSM 5.0 logs only contain Network Backup tasks, whose name is
+# in the first brackets of their lines.
+
+def MakeNameScanner (dsm):
+
+  import re
+
+  timestamp = r'\S+[^\S\n]+(\d\d\d\d/\d\d/\d\d[^\S\n]\d\d:\d\d:\d\d)[^\S\n]'
+  starttext = "Network Backup started to backup task" if dsm == 50 else "Backup task started."
+  keywords = r'(?=[^\n]*(?:' + re.escape(starttext) + r'|err|finished))'
+  if dsm == 50:
+    layout = re.compile('^' + keywords + timestamp + r'[^\[\]\n]*\[([^\]\n]*)\]', re.M)
+    def scan (block):
+      return [(ts, "[Network]", name) for ts, name in layout.findall(block)]
+  else:
+    backuptypes = dict([(t, True) for t in BACKUP_TYPES_DSM51])
+    layout = re.compile('^' + keywords + timestamp + r'[^\[\]\n]*(\[[^\]\n]*\])[^\[\]\n]*\[([^\]\n]*)\]', re.M)
+    def scan (block):
+      return [found for found in layout.findall(block) if found[1] in backuptypes]
+
+  return scan
+
+
+#============================================================================================
+# Return a function adding a block of lines of the log to the name index
+#============================================================================================
+
+# names : { task name : [backup type, timestamp] }, order : names by first appearance
+
+def NameIndexer (dsm, names, order):
+
+  scan = MakeNameScanner (dsm)
+
+  def index (block):
+    STATS['lines'] += block.count('\n')
+    STATS['bytes'] += len(block)
+    for ts, backuptype, name in scan (block):
+      entry = names.get(name)
+      if entry is None:
+        names[Intern(name)] = [backuptype, ts]
+        order.append(name)
+      elif ts >= entry[1]:
+        entry[0] = backuptype
+        entry[1] = ts
+
+  return index
+
+
+#============================================================================================
+# Group lines in blocks of about DISCOVERY_BLOCK_SIZE bytes
+#============================================================================================
+
+def ReadBlocks (lines):
+
+  block = []
+  size = 0
+  for line in lines:
+    if not line.endswith('\n'):
+      line += '\n'               # Last line of a rotated file
+    block.append(line)
+    size += len(line)
+    if size >= DISCOVERY_BLOCK_SIZE:
+      yield ''.join(block)
+      block = []
+      size = 0
+  if block:
+    yield ''.join(block)
+
+
+#============================================================================================
+# Return the tasks of the log : [(task name, backup type, timestamp)], by first appearance
+#============================================================================================
+
+# With a state file, the lines read by the previous run are skipped (see
+# ParseLogFileIncremental). After a rotation to a compressed file, the whole log is read
+# again, and the index is merged with the saved one.
+
+def DiscoverTasks (path, dsm, statepath=None):
+
+  names = {}
+  order = []
+  first, offset = 0, 0
+  files = GetLogFileSet(path)
+  if path not in files:
+    PrintDebug ("Log file %s not found" %(path))
+    return []
+
+  state = None
+  if statepath is not None:
+    state = LoadState(statepath)
+    if state is not None and (StateString(state['path']) != path or state['dsm'] != dsm):
+      PrintDebug ("Name index refers to another log file, full scan of %s" % (path))
+      state = None
+    if state is not None:
+      for name, backuptype, ts in state['tasks']:
+        name = StateString(name)
+        names[name] = [StateString(backuptype), StateString(ts)]
+        order.append(name)
+      resume = FindResumePosition(files, state)
+      if resume is not None:
+        first, offset = resume
+        PrintDebug ("Resuming %s at offset %d" % (files[first], offset))
+
+  index = NameIndexer (dsm, names, order)
+  if first < len(files)-1:
+    for block in ReadBlocks (ReadRotatedLines (files[first:-1], offset)):
+      index (block)
+    offset = 0
+
+  # New lines of the live file, up to the end of a line. A trailing incomplete line is
+  # left for the next run.
+
+  f = open(path, 'rb')
+  try:
+    st = os.fstat(f.fileno())
+    f.seek(offset)
+    while True:
+      block = f.read(DISCOVERY_BLOCK_SIZE)
+      if not block:
+        break
+      block += f.readline()
+      end = block.rfind(b'\n') + 1
+      index (LogText(block[:end]))
+      offset += end
+      if end < len(block):
+        break
+    signature = ReadSignature(f, offset)
+  finally:
+    f.close()
+
+  tasks = [(name, names[name][0], names[name][1]) for name in order]
+  if statepath is not None:
+    SaveState (statepath, { 'version': STATE_VERSION, 'path': path, 'dsm': dsm, 'inode': st.st_ino,
+                            'size': st.st_size, 'offset': offset, 'signature': signature,
+                            'tasks': [list(task) for task in tasks] })
+  return tasks
+
+
+#============================================================================================
+# Serialize to JSON, with the task names written as in the log (UTF-8 ...)
+#============================================================================================
+
+# JsonDumps escapes each byte of a non-ASCII name as a latin-1 character (see StateString).
+
+def DiscoveryJson (obj):
+  import json
+  if PY3:
+    return json.dumps(obj, ensure_ascii=False)
+  text = json.dumps(obj, ensure_ascii=False, encoding='latin-1')
+  if isinstance(text, unicode):
+    text = text.encode('latin-1')
+  return text
+
+
+#============================================================================================
+# Format the tasks for the monitoring system
+#============================================================================================
+
+# json : list of tasks. lld : Zabbix low-level discovery (also read by Icinga / Nagios
+# auto-configuration scripts). nagios : plugin output, one task per line.
+
+def FormatDiscovery (tasks, fmt):
+
+  if fmt == 'nagios':
+    lines = ["%d backup tasks found|'tasks'=%d" % (len(tasks), len(tasks))]
+    for name, backuptype, ts in tasks:
+      seconds = DecodeTimestamp (ts)
+      lines.append("%s %s (last seen %s)" % (backuptype, name, DisplayDateTime(seconds) if seconds is not None else ts))
+    return "\n".join(lines)
+
+  items = []
+  for name, backuptype, ts in tasks:
+    seconds = DecodeTimestamp (ts)
+    lastseen = UnixTime(seconds) if seconds is not None else None
+    backuptype = backuptype.strip('[]')
+    if fmt == 'lld':
+      items.append({ '{#TASKNAME}': name, '{#BACKUPTYPE}': backuptype, '{#LASTSEEN}': lastseen })
+    else:
+      items.append({ 'task': name, 'type': backuptype, 'last_seen': lastseen,
+                     'last_seen_text': DisplayDateTime(seconds) if seconds is not None else ts })
+  if fmt == 'lld':
+    return DiscoveryJson({ 'data': items })
+  return DiscoveryJson(items)
+
+
+#============================================================================================
+# Print the tasks of the log, then exit
+#============================================================================================
+
+def PrintDiscovery (path, dsm, fmt):
+
+  start = ProfileStart()
+  tasks = DiscoverTasks (path, dsm, StatePath(NAMES_FILENAME) if STATE_DIR else None)
+  if PROFILE is not None:
+    ProfileStop ('discover', start, STATS['lines'], STATS['bytes'])
+  if fmt == 'nagios':
+    nagios_return('OK', FormatDiscovery (tasks, fmt))
+  WriteText (sys.stdout, FormatDiscovery (tasks, fmt) + "\n")
+  sys.exit(NAGIOS_CODES['OK'])
+
+
+################################################################################
+#                                                                              #
+#                  RESIDENT DAEMON (LOG FOLLOWED IN MEMORY)                    #
+#                                                                              # 
+################################################################################    
+
+# With --daemon, the script stays resident : the log is parsed once, then followed
+# (like "tail -F", across rotations) and the jobs are kept in memory. A check run with
+# -S <socket> asks the daemon for the jobs of its tasks over a local Unix socket, and
+# compares them with its own thresholds (-w, -c, -W, -C). If the daemon does not
+# answer, the check parses the log itself.
+#
+# The socket is only reachable by the daemon user and its group (mode 0660), in a
+# directory of the daemon user (the state directory, or a private 0700 directory of
+# /tmp). A check only trusts the answer of a daemon run by root, by its own user or
+# by the owner of the socket directory.
+
+DAEMON_SOCKET = "check_syno_backup.sock"          # Default socket of the daemon (file name)
+DAEMON_SOCKET_DIR = "/tmp/check_syno_backup-%d"  # Its directory without -s (%d : user id)
+DAEMON_POLL_INTERVAL = 1.0        # Seconds between two checks of the log file
+DAEMON_TIMEOUT = 5.0              # Seconds to wait for a request, or an answer
+DAEMON_MAX_REQUEST = 64 * 1024    # Max size of a request (task names)
+DAEMON_COMPACT_JOBS = 1000        # Old jobs are dropped when this number of jobs have been added
+
+
+#============================================================================================
+# Default socket of the daemon : in the state directory, or in a private directory
+#============================================================================================
+
+def DaemonSocketPath ():
+
+  if STATE_DIR:
+    return StatePath(DAEMON_SOCKET)
+
+  # Anyone can create files in /tmp : the directory must be a real one, owned by us
+
+  socketdir = DAEMON_SOCKET_DIR % (os.getuid())
+  try:
+    os.mkdir(socketdir, 0o700)
+  except OSError:
+    pass
+  st = os.lstat(socketdir)
+  if not os.path.isdir(socketdir) or os.path.islink(socketdir) or st.st_uid != os.getuid():
+    nagios_return('UNKNOWN', "%s is not a directory owned by the daemon user" % (socketdir))
+  os.chmod(socketdir, 0o700)
+  return os.path.join(socketdir, DAEMON_SOCKET)
+
+
+#============================================================================================
+# User id of the process at the other end of a Unix socket, or None if unknown
+#============================================================================================
+
+# SO_PEERCRED (Linux) gives the credentials of the daemon itself. Elsewhere, the owner
+# of the socket file is used : it has been created by the daemon.
+
+def SocketPeerUid (sock, socketpath):
+  import socket, struct
+
+  try:
+    ucred = struct.calcsize('3i')
+    pid, uid, gid = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_PEERCRED', 17), ucred))
+    return uid
+  except:
+    PrintDebug ("SO_PEERCRED not available, checking the owner of %s" % (socketpath))
+  try:
+    return os.stat(socketpath).st_uid
+  except OSError:
+    return None
+
+
+#============================================================================================
+# Read one line (JSON message) from a socket
+#============================================================================================
+
+def ReadSocketLine (sock, limit=None):
+
+  data = b""
+  while not data.endswith(b'\n'):
+    block = sock.recv(65536)
+    if not block:
+      break
+    data = data + block
+    if limit is not None and len(data) > limit:
+      raise IOError("Message too long")
+  return LogText(data)
+
+
+#============================================================================================
+# Follow the live log file : open it, and parse its new complete lines
+#============================================================================================
+
+def FollowLogOpen (daemon):
+  daemon['file'] = open(daemon['path'], 'rb')
+  daemon['inode'] = os.fstat(daemon['file'].fileno()).st_ino
+  daemon['offset'] = 0
+  PrintDebug ("Following log file %s (inode %d)" % (daemon['path'], daemon['inode']))
+
+
+# A trailing incomplete line is left for the next call, unless the file is complete
+# (it has been rotated).
+
+def FollowLogRead (daemon, complete=False):
+
+  f = daemon['file']
+  f.seek(daemon['offset'])
+  while True:
+    line = LogText(f.readline())
+    if not line or not (complete or line.endswith('\n')):
+      break
+    daemon['offset'] += len(line)
+    ParseLine (line, daemon['dsm'], daemon['processing'], daemon['finished'])
+
+
+#============================================================================================
+# Bring the jobs in memory up to date with the log file
+#============================================================================================
+
+# Rotation is detected by a new inode behind the log file path : the end of the rotated
+# file is read through the file still opened, then the new live file is read from its
+# beginning. A truncated file (copytruncate) is read again from its beginning.
+
+def FollowLogUpdate (daemon):
+
+  if daemon['file'] is None:
+    if not os.path.exists(daemon['path']):
+      return
+    FollowLogOpen(daemon)
+  FollowLogRead(daemon)
+
+  try:
+    st = os.stat(daemon['path'])
+  except OSError:
+    return                     # Rotation in progress : the new live file is not created yet
+
+  if st.st_ino != daemon['inode']:
+    PrintDebug ("Log file %s has been rotated" % (daemon['path']))
+    FollowLogRead(daemon, complete=True)
+    daemon['file'].close()
+    FollowLogOpen(daemon)
+    FollowLogRead(daemon)
+  elif st.st_size < daemon['offset']:
+    PrintDebug ("Log file %s has been truncated, reading it from the beginning" % (daemon['path']))
+    daemon['offset'] = 0
+    FollowLogRead(daemon)
+
+  CountJobs (daemon['counters'], daemon['finished'][daemon['counted']:])
+  daemon['counted'] = len(daemon['finished'])
+
+  # Only the latest job and the latest good job of each task are needed to answer
+
+  if len(daemon['finished']) > daemon['kept'] + DAEMON_COMPACT_JOBS:
+    daemon['finished'] = KeepLatestJobs(daemon['finished'])
+    daemon['kept'] = daemon['counted'] = len(daemon['finished'])
+
+
+#============================================================================================
+# Initial parsing : rotated files, then the live file which is kept open
+#============================================================================================
 
-  # Is the duration of the last good task within the accepted bounds ?
+def FollowLogStart (path, dsm):
 
-  duration = lasttask['duration'].total_seconds() / 60      # Duration in minutes
-  
-  if duration > MAX_CRITICAL_MINUTES:
-    code_duration = 'CRITICAL'
-    message = message + ", [CRIT] Execution time (%d min) is more than %d minutes" % (duration, MAX_CRITICAL_MINUTES)
+  daemon = { 'path': path,
+             'dsm': dsm,
+             'file': None,
+             'inode': None,
+             'offset': 0,
+             'kept': 0,
+             'counted': 0,
+             'processing': [],
+             'finished': [],
+             'counters': {} }
 
-  elif duration > MAX_WARNING_MINUTES:
-    code_duration = 'WARNING'
-    message = message + ", [WARN] Execution time (%d min) is more than %d minutes" % (duration, MAX_WARNING_MINUTES)
-  
-  elif duration <  0:
-    code_duration = 'UNKNOWN'
-    message = message + ", Error, execution time is negative"
-  
-  else:
-    code_duration = 'OK'
-    message = message + ", Execution time (%d min) is within bounds" % (duration)
-    
-      
-  # Final response code
-      
-  if code_age =='CRITICAL' or code_duration =='CRITICAL' :
-    code ='CRITICAL' 
-  
-  elif code_age == 'WARNING' or code_duration == 'WARNING':
-    code ='WARNING'
+  PrintDebug ("Parsing file %s (and rotated files) with DSM version %d" % (path, dsm))
+  files = [f for f in GetLogFileSet(path) if f != path]
+  for line in ReadLogLines (files):
+    ParseLine (line, dsm, daemon['processing'], daemon['finished'])
+  FollowLogUpdate(daemon)
+  daemon['finished'] = KeepLatestJobs(daemon['finished'])
+  daemon['kept'] = daemon['counted'] = len(daemon['finished'])
+  return daemon
 
-  elif code_age == 'UNKNOWN' or code_duration == 'UNKNOWN':
-    code ='UNKNOWN'
 
-  elif code_age == 'OK' and code_duration == 'OK':
-    code ='OK'
-      
-  else:
-    code ='UNKNOWN'
-    message = "Error in check logic. This should not happen. See source code."
-  
-  
-  # Add performance data to the output string
-  
-  if code == "OK":
-    perfdata = "|'execution_time'=%dm;%d;%d;%d;%d" % (duration, MAX_WARNING_MINUTES, MAX_CRITICAL_MINUTES, 0, 0)
-    message = message + perfdata   
-       
-  return code, message
-  
+#============================================================================================
+# Answer a request : the latest jobs of the requested tasks (or of all tasks)
+#============================================================================================
+
+# Request is {"tasks": [names], "all": true|false}. Answer is {"version": n, "dsm": n,
+# "path": log file, "finished": [jobs], "counters": {name: counters}}, jobs and failure
+# counters being serialized as in the state file.
+
+def DaemonAnswer (daemon, request):
+
+  jobs = daemon['finished']
+  names = None
+  if not request.get('all'):
+    names = {}
+    for name in request.get('tasks', []):
+      names[StateString(name)] = True
+    jobs = [job for job in jobs if job.name in names]
+
+  return { 'version': STATE_VERSION,
+           'dsm': daemon['dsm'],
+           'path': daemon['path'],
+           'finished': [JobToState(j) for j in KeepLatestJobs(jobs)],
+           'counters': CountersToState(daemon['counters'], names) }
+
+
+def DaemonServeClient (daemon, conn):
+  import json
+  try:
+    conn.settimeout(DAEMON_TIMEOUT)
+    request = json.loads(ReadSocketLine(conn, DAEMON_MAX_REQUEST))
+    FollowLogUpdate(daemon)          # Lines written since the last poll are taken into account
+    conn.sendall(LogBytes(JsonDumps(DaemonAnswer(daemon, request)) + '\n'))
+  except:
+    PrintDebug ("Exception answering a client request")
+  conn.close()
+
+
+#============================================================================================
+# Run the daemon : follow the log file, and answer the requests on the Unix socket
+#============================================================================================
+
+def ServeDaemon (path, dsm, socketpath):
+  import socket, select, signal
+
+  # Is another daemon already listening on this socket ? Otherwise, it's a stale one.
+
+  if os.path.exists(socketpath):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      try:
+        sock.connect(socketpath)
+        nagios_return('UNKNOWN', "Another daemon is already listening on %s" % (socketpath))
+      except socket.error:
+        os.remove(socketpath)
+    finally:
+      sock.close()
+
+  daemon = FollowLogStart(path, dsm)
+
+  # The socket is created with its final mode : checks of other users (NRPE) must share
+  # the group of the daemon.
+
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  umask = os.umask(0o117)
+  try:
+    server.bind(socketpath)
+  finally:
+    os.umask(umask)
+  os.chmod(socketpath, 0o660)
+  server.listen(16)
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  PrintDebug ("Daemon listening on %s, %d jobs in memory" % (socketpath, len(daemon['finished'])))
+
+  try:
+    while True:
+      readable = select.select([server], [], [], DAEMON_POLL_INTERVAL)[0]
+      if readable:
+        conn = server.accept()[0]
+        DaemonServeClient(daemon, conn)
+      else:
+        try:
+          FollowLogUpdate(daemon)
+        except (IOError, OSError):
+          PrintDebug ("Exception following log file %s" % (path))
+  finally:
+    server.close()
+    try:
+      os.remove(socketpath)
+    except OSError:
+      pass
+
+
+#============================================================================================
+# Ask the daemon for the jobs of the tasks to check
+#============================================================================================
+
+# Returns a table of jobs (as ParseLogFile), or None if the daemon can't be reached.
+
+def QueryDaemon (socketpath, tasknames, alltasks):
+  import socket, json
+
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.settimeout(DAEMON_TIMEOUT)
+  try:
+    try:
+      sock.connect(socketpath)
+      trusted = [0, os.getuid(), os.stat(os.path.dirname(os.path.abspath(socketpath))).st_uid]
+      uid = SocketPeerUid(sock, socketpath)
+      if uid not in trusted:
+        PrintDebug ("Daemon on %s is run by user id %s, not trusted. Parsing the log" % (socketpath, uid))
+        return None
+      sock.sendall(LogBytes(JsonDumps({'tasks': tasknames, 'all': alltasks}) + '\n'))
+      answer = json.loads(ReadSocketLine(sock))
+      if answer.get('version') != STATE_VERSION:
+        PrintDebug ("Daemon on %s has an unsupported version. Parsing the log" % (socketpath))
+        return None
+      PrintDebug ("Jobs received from the daemon on %s (DSM version %s, log file %s)" % (socketpath, answer['dsm'], answer['path']))
+      TASK_COUNTERS.update(CountersFromState(answer['counters']))
+      return [JobFromState(j) for j in answer['finished']]
+    except:
+      PrintDebug ("Daemon not reachable on %s. Parsing the log" % (socketpath))
+      return None
+  finally:
+    sock.close()
+
+
+################################################################################
+#                                                                              #
+#                      BATCH MODE (LOGS OF SEVERAL NAS)                        #
+#                                                                              # 
+################################################################################    
+
+# With --batch=<dir>, the logs collected from several NAS (rsync ...) are checked from
+# one place. Each subdirectory of <dir> is a host, containing its synobackup.log and/or
+# synonetbkp.log (and rotated files). Hosts are parsed in parallel, in a pool of worker
+# processes (one per core), the largest logs first : the whole set is checked in about
+# the time of the largest log. State directory features (-s) are not used in this mode.
+
+
+#============================================================================================
+# List the hosts of a batch directory, the largest logs first
+#============================================================================================
+
+def GetBatchHosts (batchdir):
+
+  hosts = []
+  for name in os.listdir(batchdir):
+    hostdir = os.path.join(batchdir, name)
+    if os.path.isdir(hostdir):
+      size = 0
+      for filename in os.listdir(hostdir):
+        size += os.path.getsize(os.path.join(hostdir, filename))
+      hosts.append((size, name))
+  hosts.sort(reverse=True)
+  return [name for size, name in hosts]
+
+
+#============================================================================================
+# Check the tasks of one host (run in a worker process)
+#============================================================================================
+
+# 'settings' are the global values set by the command line (thresholds ...), given
+# explicitly as worker processes are not always forked from the main one. They are set
+# by the pool when a worker starts : the globals of the main process are never changed.
+
+def ApplySettings (settings):
+  globals().update(settings)
+
+
+# When the logs can't be checked, each requested task gets an UNKNOWN result (task "*"
+# with -a). Performance data labels are prefixed with the host and task names, except
+# for passive results (one service per task, labels as without --batch).
+
+def EvaluateHost (args):
+
+  global PATH_LOGFILE_DSM50, PATH_LOGFILE_DSM51
+  hostdir, tasknames, alltasks, passive = args
+  PATH_LOGFILE_DSM50 = os.path.join(hostdir, os.path.basename(PATH_LOGFILE_DSM50))
+  PATH_LOGFILE_DSM51 = os.path.join(hostdir, os.path.basename(PATH_LOGFILE_DSM51))
+  unknown = lambda message: [(name, 'UNKNOWN', message) for name in (tasknames or ['*'])]
+
+  try:
+    DSM, PATH = CheckDSMVersion()
+    if DSM == 0:
+      return unknown("Unable to read log files in %s" % (hostdir))
+    since = NowSeconds() - max(MAX_CRITICAL_DAYS, FailureDays()) * 86400
+    table = ReducedTable (ParseLogFileReduced (PATH, DSM, [] if alltasks else tasknames, since))
+
+    if alltasks:
+      tasknames = GetTaskNames (table)
+      if tasknames == []:
+        return [('*', 'UNKNOWN', "Did not find any Backup task in the log")]
+
+    results = []
+    for taskname in tasknames:
+      perfprefix = "" if passive else "%s %s " % (os.path.basename(hostdir), taskname)
+      code, message = EvaluateTask (table, taskname, perfprefix)
+      results.append((taskname, code, message))
+    return results
+  except:
+    return unknown("Exception checking logs in %s" % (hostdir))
+
+
+#============================================================================================
+# Check all the hosts of a batch directory
+#============================================================================================
+
+# Returns a list of (host, results of EvaluateHost), sorted by host name. Hosts are
+# checked in worker processes, even a single one (see ApplySettings).
+
+def EvaluateBatch (batchdir, tasknames, alltasks, passive):
+  import multiprocessing
+
+  hosts = GetBatchHosts(batchdir)
+  settings = { 'MAX_WARNING_DAYS': MAX_WARNING_DAYS, 'MAX_CRITICAL_DAYS': MAX_CRITICAL_DAYS,
+               'MAX_WARNING_MINUTES': MAX_WARNING_MINUTES, 'MAX_CRITICAL_MINUTES': MAX_CRITICAL_MINUTES,
+               'FAILURE_WARNING': FAILURE_WARNING, 'FAILURE_CRITICAL': FAILURE_CRITICAL,
+               'CONSECUTIVE_WARNING': CONSECUTIVE_WARNING, 'CONSECUTIVE_CRITICAL': CONSECUTIVE_CRITICAL,
+               'FAILURE_WINDOW': FAILURE_WINDOW, 'STATE_DIR': "", 'TRACE_LEVEL': 0 }
+  jobs = [(os.path.join(batchdir, host), tasknames, alltasks, passive) for host in hosts]
+  PrintDebug ("Batch mode : %d hosts in %s" % (len(hosts), batchdir))
+
+  results = []
+  if jobs:
+    pool = multiprocessing.Pool(min(len(jobs), multiprocessing.cpu_count()), ApplySettings, (settings,))
+    try:
+      results = pool.map(EvaluateHost, jobs, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+
+  return sorted(zip(hosts, results))
+
+
+#============================================================================================
+# Print the results of a batch : one line per host and task
+#============================================================================================
+
+# Plugin output : "[host / task] CODE: text" lines. Passive check results : the host
+# name is the -P argument, where %s is replaced by the name of the host directory.
+
+def PrintBatchResults (hostresults, passivehost, passiveprefix):
+
+  if passivehost != "":
+    now = int(time.time())
+    for host, results in hostresults:
+      name = passivehost.replace("%s", host)
+      for taskname, code, message in results:
+        WriteText (sys.stdout, PassiveResult(now, name, passiveprefix, taskname, code, message))
+    sys.exit(NAGIOS_CODES['OK'])
+
+  results = []
+  for host, hostresult in hostresults:
+    for taskname, code, message in hostresult:
+      results.append(("%s / %s" % (host, taskname), code, message))
+  if results == []:
+    nagios_return('UNKNOWN', "Did not find any host directory in the batch directory")
+  nagios_return_multi(results)
+
+
+################################################################################
+#                                                                              #
+#                      PROFILING (--profile)                                   #
+#                                                                              # 
+################################################################################    
+
+# With --profile, the wall time, CPU time, number of items and bytes of each stage of the
+# check are recorded, and a report is written when the script exits : to stderr, or to
+# the file given by --profile-file. The output of the plugin (stdout) is unchanged. With
+# --cprofile, the cProfile statistics are also saved (read them with pstats).
+#
+# Stages of the log pipeline are nested : the time of "classify" includes the time
+# spent reading the lines it asks for. The report gives the time of each stage alone.
+
+PROFILE = None            # { stage : [wall, cpu, count, bytes] }, None if not profiling
+
+# Stages, in order of the report : (name, unit of the count, stage nested inside, if any)
+
+PROFILE_STAGES = [
+  ('detect', 'calls', None),          # CheckDSMVersion
+  ('discover', 'lines', None),        # Name index (--discover)
+  ('parse', 'lines', 'reduce'),       # Parsing of the log, whatever the mode
+  ('reduce', 'tasks', 'pair'),        #   Per-task reducers
+  ('pair', 'jobs', 'classify'),       #   Pairing of start / end lines
+  ('classify', 'records', 'read'),    #   Classification of the lines
+  ('read', 'lines', None),            #   Reading (and decompression) of the lines
+  ('evaluate', 'tasks', 'find'),      # Check of the tasks (EvaluateTask)
+  ('find', 'calls', None),            #   FindLatestTask
+]
+
+try:
+  ProcessTime = time.process_time          # Python 3.3+
+except AttributeError:
+  ProcessTime = time.clock
+
+
+#============================================================================================
+# Measure a stage : start, then stop with the number of items and bytes processed
+#============================================================================================
+
+def ProfileStart ():
+  return time.time(), ProcessTime()
+
+def ProfileStop (stage, start, count=1, nbytes=0):
+  entry = PROFILE.setdefault(stage, [0.0, 0.0, 0, 0])
+  entry[0] += time.time() - start[0]
+  entry[1] += ProcessTime() - start[1]
+  entry[2] += count
+  entry[3] += nbytes
+
+
+# Call a function, measured as a stage if profiling
+
+def ProfileCall (stage, function, *args):
+  if PROFILE is None:
+    return function(*args)
+  start = ProfileStart()
+  try:
+    return function(*args)
+  finally:
+    ProfileStop (stage, start)
+
+
+# Iterate, measuring the time spent to get each item ('measure' : bytes = length of items)
+
+def ProfileIterator (stage, iterator, measure=False):
+  entry = PROFILE.setdefault(stage, [0.0, 0.0, 0, 0])
+  iterator = iter(iterator)
+  while True:
+    wall, cpu = time.time(), ProcessTime()
+    try:
+      item = next(iterator)
+    except StopIteration:
+      entry[0] += time.time() - wall
+      entry[1] += ProcessTime() - cpu
+      return
+    entry[0] += time.time() - wall
+    entry[1] += ProcessTime() - cpu
+    entry[2] += 1
+    if measure:
+      entry[3] += len(item)
+    yield item
+
+
+#============================================================================================
+# Format the report
+#============================================================================================
+
+def ProfileReport (total):
+
+  lines = ["%s v%s profile (Python %s)" % (ProgramName, Version, sys.version.split()[0]),
+           "%-10s %10s %10s %12s %8s %14s" % ("stage", "wall (s)", "cpu (s)", "count", "", "bytes")]
+  for stage, unit, nested in PROFILE_STAGES:
+    if stage not in PROFILE:
+      continue
+    wall, cpu, count, nbytes = PROFILE[stage]
+    if nested in PROFILE:
+      wall, cpu = wall - PROFILE[nested][0], cpu - PROFILE[nested][1]
+    indent = "  " if stage in ('reduce', 'pair', 'classify', 'read', 'find') else ""
+    lines.append("%-10s %10.4f %10.4f %12d %-8s %14d" % (indent + stage, wall, cpu, count, unit, nbytes))
+  lines.append("%-10s %10.4f %10.4f" % ("total", total[0], total[1]))
+  lines.append("peak memory : %d KB" % (PeakMemory()))
+  return "\n".join(lines) + "\n"
+
+
+#============================================================================================
+# Start profiling : the report (and cProfile statistics) are written at exit
+#============================================================================================
+
+def StartProfile (reportfile, cprofilefile):
+
+  global PROFILE
+  import atexit
+  PROFILE = {}
+  start = ProfileStart()
+  profiler = None
+  if cprofilefile:
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+  def report ():
+    total = (time.time() - start[0], ProcessTime() - start[1])
+    if profiler is not None:
+      profiler.disable()
+      try:
+        profiler.dump_stats(cprofilefile)
+      except (IOError, OSError):
+        sys.stderr.write("Unable to write cProfile statistics to %s\n" % (cprofilefile))
+    text = ProfileReport (total)
+    try:
+      if reportfile:
+        f = open(reportfile, 'ab')
+        try:
+          f.write(LogBytes(text))
+        finally:
+          f.close()
+      else:
+        WriteText (sys.stderr, text)
+    except (IOError, OSError):
+      pass
+
+  atexit.register(report)
+
 
 ############################################################################################
 #                                                                                          #
@@ -748,12 +3968,63 @@ def CheckThreshold(task):
 #                                                                                          #
 ############################################################################################  
 
-if __name__ == "__main__":
+#============================================================================================
+# Parse the log with the requested method (tasknames empty : all tasks)
+#============================================================================================
+
+# Returns a table. Jobs ended before 'since' may be dropped. With a state directory, only
+# the new lines are parsed, forward and in this process : -r, -m and -j are ignored.
+
+def ParseLog (path, dsm, tasknames, reverse, usemmap, workers, since):
+
+  if STATE_DIR:
+    ignored = [option for option, used in (('-r', reverse), ('-m', usemmap), ('-j', workers != 1)) if used]
+    if ignored:
+      PrintDebug ("%s ignored : with -s, only the new lines of the log are parsed" % (", ".join(ignored)))
+    table = ParseLogFileIncremental (path, dsm, StatePath(STATE_FILENAME))
+  elif reverse and tasknames:
+    table = ParseLogFileReverse (path, dsm, tasknames)
+  elif usemmap and tasknames:
+    table = ParseLogFileFiltered (path, dsm, tasknames)
+  elif workers != 1:
+    table = ParseLogFileParallel (path, dsm, workers)
+  elif IndexEnabled():
+    table = ParseLogFile (path, dsm)           # All the jobs are stored in the index
+  else:
+    table = ReducedTable (ParseLogFileReduced (path, dsm, tasknames, since))
+
+  if IndexEnabled() and not STATE_DIR:
+    IndexJobs (table)                          # Done by the incremental parsing with -s
+  return table
+
+
+def main():
+
+  global TRACE_LEVEL, TRACE_OUTPUT, STATE_DIR, CACHE_TTL, PATH_LOGFILE_DSM50, PATH_LOGFILE_DSM51
+  global MAX_WARNING_DAYS, MAX_CRITICAL_DAYS, MAX_WARNING_MINUTES, MAX_CRITICAL_MINUTES
+  global HISTORY, BASELINE_WARNING, BASELINE_CRITICAL, INDEX_PATH
+  global FAILURE_WARNING, FAILURE_CRITICAL, CONSECUTIVE_WARNING, CONSECUTIVE_CRITICAL, FAILURE_WINDOW, TABLE_COMPLETE
+  import getopt
     
   #---------------------------------------------------------- Variable initialisation
 
-  debug=False
-  taskname = "Empty"
+  tasknames = []           # Tasks to check (-t can be repeated)
+  alltasks = False         # Check all tasks found in the log
+  reverse = False          # Read the log backwards, stop when the tasks are found
+  usemmap = False          # Search the memory-mapped log for the task names, parse only these lines
+  passivehost = ""         # Host name for passive check results (empty : plugin output)
+  passiveprefix = ""       # Prefix of service descriptions for passive check results
+  daemon = False           # Stay resident, follow the log and answer checks on a Unix socket
+  socketpath = ""          # Unix socket of the daemon
+  batchdir = ""            # Directory of the logs of several hosts (one subdirectory per host)
+  workers = 1              # Number of processes parsing the log (0 : one per core)
+  promfile = ""            # Prometheus textfile to write (exporter mode)
+  runsdays = 0             # Print every run of the tasks over the last days (0 : check the tasks)
+  profile = False          # Profile the stages of the check
+  profilefile = ""         # Write the profile report to this file (default : stderr)
+  cprofilefile = ""        # Save cProfile statistics to this file
+  singleflight = False     # Parse the log once for concurrent checks
+  discover = ""            # Format of the list of tasks (discovery mode)
 
   #-------------------------------------------------- Processing command line options
   if len(sys.argv) <=1 :
@@ -761,8 +4032,8 @@ if __name__ == "__main__":
       usage()
         
   try:
-    opts, args = getopt.getopt(sys.argv[1:], "hldvt:w:c:W:C:", ["help","licensing","debug", "verbose", "task=", "warning=", "critical=", "w_execution=", "c_execution="])
-  except getopt.GetoptError, err:
+    opts, args = getopt.getopt(sys.argv[1:], "hldvt:armj:P:S:w:c:W:C:b:B:f:F:s:L:", ["help","licensing","debug", "verbose", "task=", "all-tasks", "reverse", "mmap", "jobs=", "passive=", "passive-prefix=", "daemon", "socket=", "batch=", "prometheus=", "index=", "runs=", "profile", "profile-file=", "cprofile=", "single-flight", "discover=", "warning=", "critical=", "w_execution=", "c_execution=", "w_baseline=", "c_baseline=", "w_failures=", "c_failures=", "w_consecutive=", "c_consecutive=", "failure-window=", "history", "state-dir=", "cache-ttl=", "log-dir=", "trace-level=", "trace-file="])
+  except getopt.GetoptError as err:
     PrintDebug("Exception getting arguments")
     usage()
         
@@ -772,9 +4043,65 @@ if __name__ == "__main__":
     elif option in ("-l", "--licensing"):
       licensing()
     elif option in ("-d", "--debug", "-v", "--verbose"):
-      debug = True
+      TRACE_LEVEL += 1
+    elif option == "--trace-level":
+      try:
+        TRACE_LEVEL = int(value)
+      except:
+        PrintDebug ("Invalid value %s for --trace-level : must be integer. Ignored" % (value))
+    elif option == "--trace-file":
+      try:
+        TRACE_OUTPUT = open(value, 'ab')
+      except:
+        PrintDebug ("Unable to open trace file %s. Ignored" % (value))
     elif option in ("-t", "--task"):
-      taskname = value
+      value = ArgText(value)
+      if value not in tasknames:
+        tasknames.append(value)
+    elif option in ("-a", "--all-tasks"):
+      alltasks = True
+    elif option in ("-r", "--reverse"):
+      reverse = True
+    elif option in ("-m", "--mmap"):
+      usemmap = True
+    elif option in ("-j", "--jobs"):
+      try:
+        workers = int(value)
+      except:
+        PrintDebug ("Invalid value %s for -j (jobs) : must be integer. Ignored" % (value))
+    elif option in ("-P", "--passive"):
+      passivehost = ArgText(value)
+    elif option == "--passive-prefix":
+      passiveprefix = ArgText(value)
+    elif option == "--daemon":
+      daemon = True
+    elif option in ("-S", "--socket"):
+      socketpath = value
+    elif option == "--batch":
+      batchdir = value
+    elif option == "--prometheus":
+      promfile = value
+    elif option == "--index":
+      INDEX_PATH = value
+    elif option == "--profile":
+      profile = True
+    elif option == "--single-flight":
+      singleflight = True
+    elif option == "--discover":
+      if value not in DISCOVERY_FORMATS:
+        nagios_return('UNKNOWN', "Invalid format %s for --discover (%s)" % (value, ", ".join(DISCOVERY_FORMATS)))
+      discover = value
+    elif option == "--profile-file":
+      profile = True
+      profilefile = value
+    elif option == "--cprofile":
+      profile = True
+      cprofilefile = value
+    elif option == "--runs":
+      try:
+        runsdays = int(value)
+      except:
+        PrintDebug ("Invalid value %s for --runs : must be integer. Ignored" % (value))
         
     elif option in ('-w', "--warning"):
       try:
@@ -803,55 +4130,220 @@ if __name__ == "__main__":
         PrintDebug ("Critical execution time threshold is now set to %d minutes" % (MAX_CRITICAL_MINUTES))  
       except:
         PrintDebug( "Invalid value %s for -C (c_execution) : must be integer. Ignored")
+
+    elif option in ('-b', "--w_baseline"):
+      try:
+        BASELINE_WARNING = float(value)
+        PrintDebug ("Warning baseline threshold is now set to %g x usual execution time" % (BASELINE_WARNING))
+      except:
+        PrintDebug ("Invalid value %s for -b (w_baseline) : must be a number. Ignored" % (value))
+
+    elif option in ('-B', "--c_baseline"):
+      try:
+        BASELINE_CRITICAL = float(value)
+        PrintDebug ("Critical baseline threshold is now set to %g x usual execution time" % (BASELINE_CRITICAL))
+      except:
+        PrintDebug ("Invalid value %s for -B (c_baseline) : must be a number. Ignored" % (value))
+
+    elif option in ('-f', "--w_failures"):
+      try:
+        FAILURE_WARNING = float(value)
+        PrintDebug ("Warning failure ratio threshold is now set to %g %%" % (FAILURE_WARNING))
+      except:
+        PrintDebug ("Invalid value %s for -f (w_failures) : must be a number. Ignored" % (value))
+
+    elif option in ('-F', "--c_failures"):
+      try:
+        FAILURE_CRITICAL = float(value)
+        PrintDebug ("Critical failure ratio threshold is now set to %g %%" % (FAILURE_CRITICAL))
+      except:
+        PrintDebug ("Invalid value %s for -F (c_failures) : must be a number. Ignored" % (value))
+
+    elif option == "--w_consecutive":
+      try:
+        CONSECUTIVE_WARNING = int(value)
+        PrintDebug ("Warning consecutive failures threshold is now set to %d jobs" % (CONSECUTIVE_WARNING))
+      except:
+        PrintDebug ("Invalid value %s for --w_consecutive : must be integer. Ignored" % (value))
+
+    elif option == "--c_consecutive":
+      try:
+        CONSECUTIVE_CRITICAL = int(value)
+        PrintDebug ("Critical consecutive failures threshold is now set to %d jobs" % (CONSECUTIVE_CRITICAL))
+      except:
+        PrintDebug ("Invalid value %s for --c_consecutive : must be integer. Ignored" % (value))
+
+    elif option == "--failure-window":
+      try:
+        FAILURE_WINDOW = max(1, min(int(value), FAILURE_RING_DAYS - 1))
+        PrintDebug ("Failure checks window is now set to %d days" % (FAILURE_WINDOW))
+      except:
+        PrintDebug ("Invalid value %s for --failure-window : must be integer. Ignored" % (value))
+
+    elif option == "--history":
+      HISTORY = True
+
+    elif option in ('-L', "--log-dir"):
+      PATH_LOGFILE_DSM50 = os.path.join(value, os.path.basename(PATH_LOGFILE_DSM50))
+      PATH_LOGFILE_DSM51 = os.path.join(value, os.path.basename(PATH_LOGFILE_DSM51))
+      PrintDebug ("Log directory is now set to %s" % (value))
+
+    elif option in ('-s', "--state-dir"):
+      if os.path.isdir(value):
+        STATE_DIR = value
+        PrintDebug ("State directory is now set to %s" % (STATE_DIR))
+      else:
+        PrintDebug ("Invalid value %s for -s (state-dir) : not a directory. Ignored" % (value))
+
+    elif option == "--cache-ttl":
+      try:
+        CACHE_TTL = int(value)
+        PrintDebug ("Cached results are now kept %d seconds" % (CACHE_TTL))
+      except:
+        PrintDebug ("Invalid value %s for --cache-ttl : must be integer. Ignored" % (value))
                 
+  if profile:
+    StartProfile (profilefile, cprofilefile)
+
   #-------------------------------------------------------------- Checking validity of parameters 
   
-  if taskname == "Empty":
+  if tasknames == [] and not alltasks and not daemon and promfile == "" and discover == "":
     nagios_return('UNKNOWN', "Argument missing: name of task - use %s -h for help" % (ProgramName))
-  PrintDebug("Task name to ckeck is: " + taskname)
+  if reverse and FailureChecksEnabled():
+    PrintDebug("-r ignored : the failure checks need all the jobs of the last %d days" % (FAILURE_WINDOW))
+    reverse = False
+  if alltasks:
+    PrintDebug("All tasks found in the log will be checked")
+  else:
+    PrintDebug("Task names to ckeck are: " + ", ".join(tasknames))
 
+  # Batch mode : check the logs of several hosts, then exit
 
-  # Check DSM log file version
+  if batchdir != "":
+    if not os.path.isdir(batchdir):
+      nagios_return('UNKNOWN', "Batch directory %s not found" % (batchdir))
+    PrintBatchResults (EvaluateBatch (batchdir, tasknames, alltasks, passivehost != ""), passivehost, passiveprefix)
 
-  DSM, PATH = CheckDSMVersion()
-  if DSM == 0 :
-    nagios_return('UNKNOWN', 'Unable to read log files. Check Unix permissions on /var/log/synolog (see doc)')
-  
-  PrintDebug ("DSM version is %s, log file to be processed is %s" % (DSM, PATH))
-  
-  
-  #-------------------------------------------------------------- Process DSM log file 
 
-  # Parse file, returns a table of tasks
-  
-  table = ParseLogFile (PATH, DSM)             
-  if debug:
-    PrintTaskNames (table)
-  
-  # Find most recent task of given name whose status is OK
-      
-  exists, lasttask = FindLatestTask (table, taskname)
-  
-  if exists == False:
-    code = "UNKNOWN"
-    message = "Did not find any Backup task with name [%s]" %(taskname)
+  # Ask the resident daemon, if any : the log is then not read by this process
+
+  parsestart = time.time()
+  table = None
+  if socketpath != "" and not daemon:
+    table = QueryDaemon (socketpath, tasknames, alltasks)
+    TABLE_COMPLETE = table is None            # The daemon only sends the latest jobs
+
+  if table is None:
+
+    # Check DSM log file version
+
+    DSM, PATH = ProfileCall ('detect', CheckDSMVersion)
+    if DSM == 0 :
+      nagios_return('UNKNOWN', 'Unable to read log files. Check Unix permissions on /var/log/synolog (see doc)')
     
-  elif lasttask == {}:
-    code = "CRITICAL"
-    message = "Task [%s] found in the log, but all occurrences are FAILED" %(taskname)
-  
-  else:
-    if debug:
-      PrintTasksSince(table, taskname, MAX_CRITICAL_DAYS )
-      print
-      print "Last occurrence of task :"
-      PrintTaskDetails (lasttask)
-      
-    # Check if task duration is within bounds    
-  
-    code, message = CheckThreshold (lasttask)
+    PrintDebug ("DSM version is %s, log file to be processed is %s" % (DSM, PATH))
+
+    if daemon:
+      ServeDaemon (PATH, DSM, socketpath or DaemonSocketPath())
+
+    # Discovery mode : list the tasks of the log, then exit
+
+    if discover != "":
+      PrintDiscovery (PATH, DSM, discover)
+
+    # Exporter mode : the whole log is parsed, metrics are written, then exit
+
+    if promfile != "":
+      if workers != 1:
+        reducers = ReduceJobs (ParseLogFileParallel (PATH, DSM, workers), tasknames, NowSeconds())
+      else:
+        reducers = ParseLogFileReduced (PATH, DSM, tasknames, NowSeconds())
+      ExportPrometheus (promfile, reducers, tasknames)
+    
+    
+    #-------------------------------------------------------------- Process DSM log file 
+
+    # Reuse the jobs cached by a previous check, if the log file has not changed
+
+    cache = None
+    if CACHE_TTL > 0 and STATE_DIR:
+      cache = LoadResultCache (StatePath(CACHE_FILENAME), PATH)
+      table = GetCachedJobs (cache, tasknames, alltasks)
+
+    # Parse file, returns a table of tasks
+    
+    if table is None:
+      if PROFILE is not None:
+        profilestart = ProfileStart()
+      since = NowSeconds() - max(MAX_CRITICAL_DAYS, runsdays, FailureDays()) * 86400
+      names = [] if alltasks else tasknames
+      if singleflight:
+        table = SingleFlight (PATH, DSM, since, names, lambda: ParseLog (PATH, DSM, [], False, False, workers, since))
+      else:
+        table = ParseLog (PATH, DSM, names, reverse, usemmap, workers, since)
+      if PROFILE is not None:
+        ProfileStop ('parse', profilestart, STATS['lines'], STATS['bytes'])
+      if cache is not None:
+        SaveResultCache (StatePath(CACHE_FILENAME), cache, table, tasknames, alltasks)
+
+    # With -s (and the cache, or single-flight), the table only holds the latest jobs of
+    # each task, as with -r : the runs and failures are counted in the failure counters
+    # saved by the check which parsed the log
+
+    if STATE_DIR or (reverse and not alltasks and not singleflight):
+      TABLE_COMPLETE = False
+    if STATE_DIR and not TASK_COUNTERS:
+      LoadCounters (StatePath(STATE_FILENAME))
+    if TRACE_LEVEL >= TRACE_SUMMARY:
+      PrintTaskNames (table)
+
+  # Jobs of the tasks read from the index, which also has the jobs of older logs
+
+  taskorder = table
+  if IndexEnabled():
+    since = NowSeconds() - max(MAX_CRITICAL_DAYS, runsdays, FailureDays()) * 86400
+    indexed = IndexTable ([] if alltasks else tasknames, since)
+    if indexed is not None:
+      taskorder = table + indexed                  # Tasks of the log first, then tasks of older logs
+      table = indexed
+      TABLE_COMPLETE = True
+
+  if runsdays > 0:
+    if not TABLE_COMPLETE:
+      nagios_return('UNKNOWN', "--runs needs all the jobs of the last days : with -s, -r or -S, only the latest jobs are kept. Use --index")
+    PrintRuns (table, [] if alltasks else tasknames, runsdays)
+
+  checkperfdata = CheckPerfData (time.time() - parsestart)
+  if STATS['bad_timestamps']:
+    PrintDebug ("WARNING : %d Backup task lines ignored, their date is unreadable" % (STATS['bad_timestamps']))
+    Trace (TRACE_SUMMARY, "%d Backup task lines ignored (unreadable date)", STATS['bad_timestamps'])
+
+  # List of tasks to check
+
+  if alltasks:
+    tasknames = GetTaskNames (taskorder)
+    if tasknames == []:
+      nagios_return('UNKNOWN', "Did not find any Backup task in the log")
+
+  # Find most recent task of given name whose status is OK, and check it
+
+  if len(tasknames) == 1 and passivehost == "":
+    code, message = ProfileCall ('evaluate', EvaluateTask, table, tasknames[0])
+    nagios_return(code, message, checkperfdata)
+
+  results = []
+  for taskname in tasknames:
+    perfprefix = "" if passivehost != "" else "%s " % (taskname)
+    code, message = ProfileCall ('evaluate', EvaluateTask, table, taskname, perfprefix)
+    results.append((taskname, code, message))
 
 
   #------------------------------------------- exit with return code and message
   
-  nagios_return(code, message)
+  if passivehost != "":
+    PrintPassiveResults(results, passivehost, passiveprefix)
+  nagios_return_multi(results, checkperfdata)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+#============================================================================================
+#  build_zipapp :
+#    Builds check_syno_backup.pyz, a single executable file containing check_syno_backup.py
+#    precompiled for the Python interpreter running this script, so that checks do not
+#    compile the script at each run (it is never cached when run as a script).
+#
+#    The source is also included : another Python version falls back to it.
+#
+#  Usage : python tools/build_zipapp.py [-o <file>] [-p <interpreter>]
+#    then : ./check_syno_backup.pyz -t "My backup task"
+#============================================================================================
+
+from __future__ import print_function
+
+import sys, os, getopt, zipfile, py_compile, tempfile, shutil, stat
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(TOOLS_DIR, '..', 'src', 'check_syno_backup.py')
+MODULE = "check_syno_backup"
+
+MAIN = '''import %s
+%s.main()
+''' % (MODULE, MODULE)
+
+
+#============================================================================================
+# Build the archive : shebang line, then a zip file with __main__.py, module.pyc and module.py
+#============================================================================================
+
+# The compiled module is stored as "check_syno_backup.pyc" at the root of the archive,
+# where zipimport looks for it before the source.
+
+def BuildZipApp (output, interpreter):
+
+  tmpdir = tempfile.mkdtemp(prefix="syno_zipapp_")
+  try:
+    compiled = os.path.join(tmpdir, MODULE + ".pyc")
+    py_compile.compile(SCRIPT, cfile=compiled, dfile=MODULE + ".py", doraise=True)
+
+    f = open(output, 'wb')
+    try:
+      f.write(("#!%s\n" % (interpreter)).encode('utf-8'))
+      z = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
+      try:
+        z.writestr("__main__.py", MAIN)
+        z.write(compiled, MODULE + ".pyc")
+        z.write(SCRIPT, MODULE + ".py")
+      finally:
+        z.close()
+    finally:
+      f.close()
+  finally:
+    shutil.rmtree(tmpdir)
+
+  os.chmod(output, os.stat(output).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+#============================================================================================
+# Main
+#============================================================================================
+
+def usage():
+  print('''Usage : %s [Options]
+      -o<file>, --output : archive to build (default : check_syno_backup.pyz)
+      -p<exe>, --python : interpreter of the shebang line (default : /usr/bin/env python%d)''' % (
+      sys.argv[0], sys.version_info[0]))
+  sys.exit(1)
+
+
+if __name__ == "__main__":
+
+  output = MODULE + ".pyz"
+  interpreter = "/usr/bin/env python%d" % (sys.version_info[0])
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "ho:p:", ["help", "output=", "python="])
+  except getopt.GetoptError:
+    usage()
+
+  for option, value in opts:
+    if option in ("-h", "--help"):
+      usage()
+    elif option in ("-o", "--output"):
+      output = value
+    elif option in ("-p", "--python"):
+      interpreter = value
+
+  BuildZipApp(output, interpreter)
+  print("%s : built for Python %d.%d" % (output, sys.version_info[0], sys.version_info[1]))